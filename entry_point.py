@@ -1,5 +1,6 @@
 import traceback
 import datetime
+import multiprocessing
 import os
 import pathlib
 
@@ -17,6 +18,8 @@ def _get_crash_report_file_name():
 
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()  # for the recording worker process, when running as an exe
+
     version_string = "?"
     try:
         import src.game.gameloop as gameloop
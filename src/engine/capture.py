@@ -0,0 +1,206 @@
+from OpenGL.GL import *
+
+import collections
+import ctypes
+import multiprocessing
+import os
+import queue
+import traceback
+
+
+FORMAT_PNG = "png"
+FORMAT_GIF = "gif"
+
+
+class FrameRecorder:
+    """
+        Records the frames drawn by a RenderEngine. Each frame is copied into a pixel buffer object, which
+        happens asynchronously on the GPU, and is only read back a few frames later when the copy is done.
+        The pixels are then handed to a worker process for encoding, so recording doesn't block the game.
+    """
+
+    def __init__(self, output_path, fmt=FORMAT_PNG, every_nth_frame=1, fps=60, n_buffers=3, max_queued_frames=30):
+        """
+            output_path: the directory to write a png sequence into, or the path of the gif.
+            fmt: FORMAT_PNG or FORMAT_GIF (gifs need Pillow, otherwise a png sequence is written instead).
+            every_nth_frame: only records every nth frame (e.g. 2 to record a 60 fps game at 30 fps).
+            fps: the game's framerate, used to set the gif's frame delay.
+            n_buffers: the number of pixel buffers to cycle through. a frame is read back n_buffers - 1
+                       frames after it was drawn, by which point the GPU has finished copying it.
+            max_queued_frames: if the encoder falls this far behind, frames are dropped from the recording
+                               instead of slowing down the game.
+        """
+        if fmt not in (FORMAT_PNG, FORMAT_GIF):
+            raise ValueError("unrecognized recording format: {}".format(fmt))
+        if n_buffers < 2:
+            raise ValueError("need at least 2 pixel buffers, got: {}".format(n_buffers))
+
+        self.output_path = output_path
+        self.every_nth_frame = max(1, int(every_nth_frame))
+        self.n_buffers = n_buffers
+
+        self._pbo_ids = []
+        self._pbo_size = None          # (w, h) of the frames the buffers are allocated for
+        self._pending = collections.deque()  # indices of buffers that have a frame in flight
+        self._next_pbo = 0
+
+        self._tick = 0
+        self._n_recorded = 0
+        self._n_dropped = 0
+
+        self._frame_queue = multiprocessing.Queue(maxsize=max_queued_frames)
+        self._worker = multiprocessing.Process(target=_encode_frames,
+                                               args=(self._frame_queue, output_path, fmt,
+                                                     fps / self.every_nth_frame),
+                                               daemon=True)
+        self._worker.start()
+        print("INFO: started recording to {}".format(output_path))
+
+    def on_frame_rendered(self, w, h):
+        """call after the frame is drawn and before the buffers are swapped."""
+        self._tick += 1
+        if (self._tick - 1) % self.every_nth_frame != 0:
+            return
+
+        if (w, h) != self._pbo_size:
+            self._read_all_pending()
+            self._allocate_buffers(w, h)
+
+        pbo_idx = self._next_pbo
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, self._pbo_ids[pbo_idx])
+        # BGRA is the native layout for most drivers, so it's the fastest to copy. returns immediately
+        glReadPixels(0, 0, w, h, GL_BGRA, GL_UNSIGNED_BYTE, ctypes.c_void_p(0))
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+
+        self._pending.append(pbo_idx)
+        self._next_pbo = (pbo_idx + 1) % self.n_buffers
+
+        if len(self._pending) >= self.n_buffers:
+            self._read_oldest_pending()
+
+    def on_context_lost(self):
+        """the buffers (and the frames in them) are gone, they'll be recreated on the next frame."""
+        self._pbo_ids = []
+        self._pbo_size = None
+        self._pending.clear()
+        self._next_pbo = 0
+
+    def stop(self):
+        """finishes reading back the frames in flight and waits for the worker to encode everything."""
+        self._read_all_pending()
+        self._delete_buffers()
+
+        self._frame_queue.put(None)
+        self._worker.join()
+
+        print("INFO: finished recording to {} ({} frames, {} dropped)".format(
+            self.output_path, self._n_recorded, self._n_dropped))
+
+    def get_num_dropped_frames(self):
+        return self._n_dropped
+
+    def _allocate_buffers(self, w, h):
+        self._delete_buffers()
+        self._pbo_ids = [int(pbo_id) for pbo_id in glGenBuffers(self.n_buffers)]
+        for pbo_id in self._pbo_ids:
+            glBindBuffer(GL_PIXEL_PACK_BUFFER, pbo_id)
+            glBufferData(GL_PIXEL_PACK_BUFFER, w * h * 4, None, GL_STREAM_READ)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+        self._pbo_size = (w, h)
+
+    def _delete_buffers(self):
+        if len(self._pbo_ids) > 0:
+            glDeleteBuffers(len(self._pbo_ids), self._pbo_ids)
+        self.on_context_lost()
+
+    def _read_all_pending(self):
+        while len(self._pending) > 0:
+            self._read_oldest_pending()
+
+    def _read_oldest_pending(self):
+        pbo_idx = self._pending.popleft()
+        w, h = self._pbo_size
+
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, self._pbo_ids[pbo_idx])
+        pixels = glGetBufferSubData(GL_PIXEL_PACK_BUFFER, 0, w * h * 4)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+
+        try:
+            self._frame_queue.put_nowait((w, h, pixels))
+            self._n_recorded += 1
+        except queue.Full:
+            self._n_dropped += 1
+
+
+def _encode_frames(frame_queue, output_path, fmt, fps):
+    """
+        runs in the worker process. frames are (w, h, pixels) tuples, where pixels is a flat uint8 array
+        of BGRA data with the bottom row first (as glReadPixels gives it). None ends the recording.
+    """
+    import pygame  # only the image module is used, so there's no need to init a display
+
+    pil_image = None
+    if fmt == FORMAT_GIF:
+        try:
+            import PIL.Image as pil_image
+        except ImportError:
+            output_path = os.path.splitext(output_path)[0]
+            print("WARN: Pillow isn't installed, can't encode gifs. writing pngs to {} instead".format(output_path))
+            fmt = FORMAT_PNG
+
+    if fmt == FORMAT_PNG:
+        os.makedirs(output_path, exist_ok=True)
+
+    gif_file = None  # frames are appended as they come in, so they don't pile up in memory
+    gif_size = None
+    n_frames = 0
+    while True:
+        item = frame_queue.get()
+        if item is None:
+            break
+
+        w, h, pixels = item
+        try:
+            rgba = pixels.reshape((h, w, 4))[::-1, :, [2, 1, 0, 3]].tobytes()
+            if fmt == FORMAT_PNG:
+                surface = pygame.image.fromstring(rgba, (w, h), "RGBA")
+                pygame.image.save(surface, os.path.join(output_path, "frame_{:05d}.png".format(n_frames)))
+            else:
+                if gif_file is None:
+                    directory = os.path.dirname(output_path)
+                    if len(directory) > 0:
+                        os.makedirs(directory, exist_ok=True)
+                    gif_file = open(output_path, "wb")
+                    gif_size = (w, h)
+                img = pil_image.frombytes("RGBA", (w, h), rgba)
+                _write_gif_frame(gif_file, img, gif_size, round(1000 / fps), n_frames == 0)
+            n_frames += 1
+        except Exception:
+            print("ERROR: failed to encode frame {}".format(n_frames))
+            traceback.print_exc()
+
+    if gif_file is not None:
+        gif_file.write(b";")  # the gif's trailer
+        gif_file.close()
+
+
+def _write_gif_frame(gif_file, img, size, duration, is_first):
+    """
+        appends a frame to a gif that's being written. the first frame also writes the gif's header.
+        size: the gif's size. frames of a different size (e.g. if the window was resized) are cropped or padded.
+    """
+    import PIL.GifImagePlugin as gif_plugin
+
+    img = img.convert("RGB")
+    if img.size != size:
+        img = img.crop((0, 0, size[0], size[1]))
+    img = img.quantize(256)
+
+    if is_first:
+        header, _ = gif_plugin.getheader(img, info={"loop": 0, "duration": duration})
+        for block in header:
+            gif_file.write(block)
+
+    # every frame is quantized separately, so each one gets its own palette
+    for block in gif_plugin.getdata(img, duration=duration, include_color_table=True):
+        gif_file.write(block)
@@ -3,6 +3,7 @@ from OpenGL.GL import *
 import numpy
 
 import src.engine.sprites as sprites
+import src.engine.renderengine as renderengine
 import src.utils.util as util
 
 
@@ -13,18 +14,21 @@ def assert_int(val):
 
 class _Layer:
 
-    def __init__(self, layer_id, layer_depth, sort_sprites=True, use_color=True):
+    def __init__(self, layer_id, layer_depth, sort_sprites=True, use_color=True, use_palette=False):
         """
             layer_id: The string identifier for this layer.
             layer_depth: The depth of this layer, in relation to other layers in the engine.
             sort_sprites: Whether the sprites in this layer should be sorted by their depth.
             use_color: Whether this layer should use the color information in its sprites.
+            use_palette: Whether this layer should pass its sprites' colors as palette indices
+                         instead of rgb values (see renderengine.Palette). Overrides use_color.
         """
         self._layer_id = layer_id
         self._layer_depth = layer_depth
 
         self._sort_sprites = sort_sprites
-        self._use_color = use_color
+        self._use_palette = use_palette
+        self._use_color = use_color and not use_palette
 
         self._offset = (0, 0)
 
@@ -43,6 +47,9 @@ class _Layer:
     def is_color(self):
         return self._use_color
 
+    def is_palette(self):
+        return self._use_palette
+
     def accepts_sprite_type(self, sprite_type):
         return False
 
@@ -58,6 +65,9 @@ class _Layer:
     def color_stride(self):
         raise NotImplementedError()
 
+    def palette_stride(self):
+        raise NotImplementedError()
+
     def get_layer_depth(self):
         return self._layer_depth
 
@@ -91,8 +101,9 @@ class ImageLayer(_Layer):
         Layer for ImageSprites.
     """
 
-    def __init__(self, layer_id, layer_depth, sort_sprites=True, use_color=True):
-        _Layer.__init__(self, layer_id, layer_depth, sort_sprites=sort_sprites, use_color=use_color)
+    def __init__(self, layer_id, layer_depth, sort_sprites=True, use_color=True, use_palette=False):
+        _Layer.__init__(self, layer_id, layer_depth, sort_sprites=sort_sprites, use_color=use_color,
+                        use_palette=use_palette)
 
         self.images = []  # ordered list of image ids
         self._image_set = set()
@@ -101,25 +112,41 @@ class ImageLayer(_Layer):
         self.vertices = numpy.array([], dtype=float)
         self.tex_coords = numpy.array([], dtype=float)
         self.indices = numpy.array([], dtype=float)
-        self.colors = numpy.array([], dtype=float) if use_color else None
+        self.colors = numpy.array([], dtype=float) if self.is_color() else None
+        self.palette_indices = numpy.array([], dtype=float) if self.is_palette() else None
 
-        self._dirty_sprites = []
-        self._to_remove = []
+        self._dirty_sprites = set()
+        self._to_remove = set()
         self._to_add = []
 
+        # where each sprite was written by the last full rebuild, so changed sprites can be rewritten in place
+        self._slots = {}          # sprite id -> index of its first primitive
+        self._slot_depths = {}    # sprite id -> depth (only for sorted layers)
+        self._slot_sizes = {}     # sprite id -> number of primitives (only for sprites with more than one)
+
     def update(self, sprite_id):
         assert_int(sprite_id)
         if sprite_id in self._image_set:
-            self._dirty_sprites.append(sprite_id)
+            self._dirty_sprites.add(sprite_id)
+        elif sprite_id in self._to_remove:
+            # the sprite was re-added (or its id went to a new sprite) before the removal went through
+            self._to_remove.remove(sprite_id)
+            self._image_set.add(sprite_id)
+            self._dirty_sprites.add(sprite_id)
         else:
             self._image_set.add(sprite_id)
             self._to_add.append(sprite_id)
 
+    def mark_dirty(self, sprite_id):
+        """called by sprite handles when they change. unlike update, this does nothing if the sprite isn't in the layer."""
+        if sprite_id in self._image_set:
+            self._dirty_sprites.add(sprite_id)
+
     def remove(self, sprite_id):
         assert_int(sprite_id)
         if sprite_id in self._image_set:
             self._image_set.remove(sprite_id)
-            self._to_remove.append(sprite_id)
+            self._to_remove.add(sprite_id)
 
     def is_dirty(self):
         return len(self._dirty_sprites) + len(self._to_add) + len(self._to_remove) > 0
@@ -139,7 +166,94 @@ class ImageLayer(_Layer):
     def color_stride(self):
         return 4 * 3
 
+    def palette_stride(self):
+        return 4
+
     def rebuild(self, sprite_lookup):
+        palette = renderengine.get_instance().get_palette() if self.is_palette() else None
+
+        if self._can_rewrite_in_place(sprite_lookup):
+            for sprite_id in self._dirty_sprites:
+                self._write_sprite(self._slots[sprite_id], sprite_lookup[sprite_id], palette)
+            self._dirty_sprites.clear()
+            return
+
+        self._apply_pending_changes(sprite_lookup)
+
+        layer_sprites = [sprite_lookup[sprite_id] for sprite_id in self.images]
+        if all(isinstance(sprite, sprites.ImageSprite) for sprite in layer_sprites):
+            sizes = None  # they're all single quads, and can be written in one go
+            n_primitives = len(layer_sprites)
+        else:
+            sizes = [sprite.num_primitives() for sprite in layer_sprites]
+            n_primitives = sum(sizes)
+
+        # need refcheck to be false or else Pycharm's debugger can cause this to fail (due to holding a ref)
+        self.vertices.resize(self.vertex_stride() * n_primitives, refcheck=False)
+        self.tex_coords.resize(self.texture_stride() * n_primitives, refcheck=False)
+        self.indices.resize(self.index_stride() * n_primitives, refcheck=False)
+        if self.is_color():
+            self.colors.resize(self.color_stride() * n_primitives, refcheck=False)
+        if self.is_palette():
+            self.palette_indices.resize(self.palette_stride() * n_primitives, refcheck=False)
+
+        self._slots.clear()
+        self._slot_depths.clear()
+        self._slot_sizes.clear()
+
+        if sizes is None:
+            sprites.ImageSprite.add_all(layer_sprites, self.vertices, self.tex_coords, self.colors, self.indices)
+            if palette is not None:
+                p_stride = self.palette_stride()
+                self.palette_indices[:] = numpy.repeat([palette.index_of(sprite.color()) for sprite in layer_sprites],
+                                                       p_stride)
+
+            self._slots.update(zip(self.images, range(0, n_primitives)))
+            if self.is_sorted():
+                self._slot_depths.update(zip(self.images, [sprite.depth() for sprite in layer_sprites]))
+            return
+
+        i = 0
+        for sprite_id, sprite, size in zip(self.images, layer_sprites, sizes):
+            self._write_sprite(i, sprite, palette)
+
+            self._slots[sprite_id] = i
+            if self.is_sorted():
+                self._slot_depths[sprite_id] = sprite.depth()
+            if size != 1:
+                self._slot_sizes[sprite_id] = size
+            i += size
+
+    def _can_rewrite_in_place(self, sprite_lookup):
+        """whether the only changes are to sprites that can stay where they are in the arrays."""
+        if len(self._to_add) > 0 or len(self._to_remove) > 0:
+            return False
+        for sprite_id in self._dirty_sprites:
+            sprite = sprite_lookup[sprite_id]
+            if self.is_sorted() and sprite.depth() != self._slot_depths[sprite_id]:
+                return False  # it needs to be re-sorted
+            if sprite.num_primitives() != self._slot_sizes.get(sprite_id, 1):
+                return False  # it won't fit where it was
+        return True
+
+    def _write_sprite(self, i, sprite, palette):
+        sprite.add_urself(
+            i,
+            self.vertices,
+            self.tex_coords,
+            self.colors,
+            self.indices)
+
+        if palette is not None:
+            p_stride = self.palette_stride()
+            if sprite.num_primitives() == 1:
+                self.palette_indices[i * p_stride:(i + 1) * p_stride] = palette.index_of(sprite.color())
+            else:
+                for j, color in enumerate(sprite.primitive_colors()):
+                    self.palette_indices[(i + j) * p_stride:(i + j + 1) * p_stride] = palette.index_of(color)
+
+    def _apply_pending_changes(self, sprite_lookup):
+        """applies the queued adds and removes to the image list, and re-sorts it if necessary."""
         if len(self._to_remove) > 0:
             for sprite_id in self._to_remove:
                 if sprite_id in self._image_set:
@@ -158,24 +272,6 @@ class ImageLayer(_Layer):
         if self.is_sorted():
             self.images.sort(key=lambda x: -sprite_lookup[x].depth())
 
-        n_sprites = len(self.images)
-
-        # need refcheck to be false or else Pycharm's debugger can cause this to fail (due to holding a ref)
-        self.vertices.resize(self.vertex_stride() * n_sprites, refcheck=False)
-        self.tex_coords.resize(self.texture_stride() * n_sprites, refcheck=False)
-        self.indices.resize(self.index_stride() * n_sprites, refcheck=False)
-        if self.is_color():
-            self.colors.resize(self.color_stride() * n_sprites, refcheck=False)
-
-        for i in range(0, n_sprites):
-            sprite = sprite_lookup[self.images[i]]
-            sprite.add_urself(
-                i,
-                self.vertices,
-                self.tex_coords,
-                self.colors,
-                self.indices)
-
     def render(self, engine):
         # split up like this to make it easier to find performance bottlenecks
         self._set_client_states(True, engine)
@@ -188,12 +284,16 @@ class ImageLayer(_Layer):
         engine.set_texture_coords_enabled(enable)
         if self.is_color():
             engine.set_colors_enabled(enable)
+        if self.is_palette():
+            engine.set_palette_indices_enabled(enable)
 
     def _pass_attributes(self, engine):
         engine.set_vertices(self.vertices)
         engine.set_texture_coords(self.tex_coords)
         if self.is_color():
             engine.set_colors(self.colors)
+        if self.is_palette():
+            engine.set_palette_indices(self.palette_indices)
 
     def _draw_elements(self):
         glDrawElements(GL_TRIANGLES, len(self.indices), GL_UNSIGNED_INT, self.indices)
@@ -207,8 +307,9 @@ class ImageLayer(_Layer):
 
 class PolygonLayer(ImageLayer):
 
-    def __init__(self, layer_id, layer_depth, sort_sprites=True):
-        ImageLayer.__init__(self, layer_id, layer_depth, sort_sprites=sort_sprites, use_color=True)
+    def __init__(self, layer_id, layer_depth, sort_sprites=True, use_palette=False):
+        ImageLayer.__init__(self, layer_id, layer_depth, sort_sprites=sort_sprites, use_color=True,
+                            use_palette=use_palette)
 
     def accepts_sprite_type(self, sprite_type):
         return sprite_type == sprites.SpriteTypes.TRIANGLE
@@ -225,6 +326,235 @@ class PolygonLayer(ImageLayer):
     def color_stride(self):
         return 3 * 3
 
+    def palette_stride(self):
+        return 3
+
+
+class TileMapLayer(ImageLayer):
+    """
+        Layer for a regular grid of tiles. The tiles aren't sprites, they're just entries in two 2D
+        arrays (model indices and tint indices), so setting a tile is a single array write and the
+        mesh is (re)built with vectorized numpy ops instead of per-tile python objects.
+
+        Tiles are drawn at (col * cell_w, row * cell_h) using their model's size (times the layer's scale),
+        so models can overhang their cells if they're bigger than them. Use set_offset to position the grid.
+    """
+
+    EMPTY = -1
 
+    def __init__(self, layer_id, layer_depth, grid_size, cell_size, scale=1, models=(), tints=((1, 1, 1),),
+                 use_color=True, use_palette=False):
+        """
+            grid_size: (n_cols, n_rows) of the grid.
+            cell_size: (w, h) of each cell, in game pixels.
+            models: the ImageModels that tiles can use, tiles refer to them by index.
+            tints: the colors that tiles can use, tiles refer to them by index.
+            use_palette: not supported, tints are already indexed.
+        """
+        if use_palette:
+            raise ValueError("TileMapLayer doesn't support palette mode")
+        ImageLayer.__init__(self, layer_id, layer_depth, sort_sprites=False, use_color=use_color)
+
+        self._grid_size = grid_size
+        self._cell_size = cell_size
+        self._scale = scale
+
+        n_cols, n_rows = grid_size
+        self.tile_models = numpy.full((n_rows, n_cols), TileMapLayer.EMPTY, dtype=numpy.int32)
+        self.tile_tints = numpy.zeros((n_rows, n_cols), dtype=numpy.int32)
+
+        self._models = []
+        self._tints = []
+
+        # lookup tables, indexed by model (or tint) index. the last row is all zeros,
+        # so that EMPTY (-1) tiles naturally become zero-sized quads.
+        self._model_tex_coords = numpy.zeros((1, 4), dtype=numpy.float32)  # tx1, ty1, tx2, ty2
+        self._model_sizes = numpy.zeros((1, 2), dtype=numpy.float32)       # w, h
+        self._tint_colors = numpy.zeros((1, 3), dtype=numpy.float32)       # r, g, b
+
+        self.set_models(models)
+        self.set_tints(tints)
+
+        n_cells = n_cols * n_rows
+
+        # one quad per cell, whether it's empty or not, so a cell's data always lives at the same spot
+        self.vertices = numpy.zeros(self.vertex_stride() * n_cells, dtype=numpy.float32)
+        self.tex_coords = numpy.zeros(self.texture_stride() * n_cells, dtype=numpy.float32)
+        self.colors = numpy.zeros(self.color_stride() * n_cells, dtype=numpy.float32) if use_color else None
+
+        quad = numpy.array([0, 1, 2, 0, 2, 3], dtype=numpy.uint32)
+        self.indices = (numpy.arange(n_cells, dtype=numpy.uint32)[:, None] * 4 + quad).ravel()
+
+        self._dirty_cells = []  # flat cell indices
+        self._needs_full_rebuild = True
+
+    def get_grid_size(self):
+        return self._grid_size
+
+    def get_cell_size(self):
+        return self._cell_size
+
+    def get_scale(self):
+        return self._scale
+
+    def set_models(self, models):
+        self._models = list(models)
+        self._rebuild_model_table()
+        return self
+
+    def add_model(self, model):
+        """returns: the index of the model, for use in set_tile."""
+        self._models.append(model)
+        self._rebuild_model_table()
+        return len(self._models) - 1
+
+    def set_tints(self, tints):
+        self._tints = list(tints)
+        self._rebuild_tint_table()
+        return self
+
+    def add_tint(self, color):
+        """returns: the index of the color, for use in set_tile."""
+        self._tints.append(color)
+        self._rebuild_tint_table()
+        return len(self._tints) - 1
+
+    def _rebuild_model_table(self):
+        n = len(self._models)
+        self._model_tex_coords = numpy.zeros((n + 1, 4), dtype=numpy.float32)
+        self._model_sizes = numpy.zeros((n + 1, 2), dtype=numpy.float32)
+        if n > 0:
+            rows = sprites.get_model_table().get_table()[[model.model_id for model in self._models]]
+            self._model_tex_coords[:n] = rows[:, sprites.ModelTable.TX1:sprites.ModelTable.TY2 + 1]
+            self._model_sizes[:n] = rows[:, sprites.ModelTable.W:sprites.ModelTable.H + 1]
+        self._needs_full_rebuild = True
+
+    def _rebuild_tint_table(self):
+        n = len(self._tints)
+        self._tint_colors = numpy.zeros((n + 1, 3), dtype=numpy.float32)
+        for i in range(0, n):
+            self._tint_colors[i] = self._tints[i]
+        self._needs_full_rebuild = True
+
+    def set_tile(self, x, y, model_idx, tint_idx=None):
+        """
+            x, y: the cell's column and row.
+            model_idx: index of the tile's model, or TileMapLayer.EMPTY to clear it.
+            tint_idx: index of the tile's color, or None to leave it unchanged.
+        """
+        self.tile_models[y, x] = model_idx
+        if tint_idx is not None:
+            self.tile_tints[y, x] = tint_idx
+        self._dirty_cells.append(y * self._grid_size[0] + x)
+
+    def get_tile(self, x, y):
+        """returns: (model_idx, tint_idx) of the given cell."""
+        return int(self.tile_models[y, x]), int(self.tile_tints[y, x])
+
+    def clear_tile(self, x, y):
+        self.set_tile(x, y, TileMapLayer.EMPTY)
+
+    def set_all_tiles(self, model_idxs, tint_idxs=None):
+        """
+            model_idxs: 2D array (n_rows, n_cols) of model indices, or a single index to fill the grid with.
+            tint_idxs: 2D array (n_rows, n_cols) of tint indices, a single index, or None to leave them unchanged.
+        """
+        self.tile_models[:, :] = model_idxs
+        if tint_idxs is not None:
+            self.tile_tints[:, :] = tint_idxs
+        self._needs_full_rebuild = True
+
+    def is_dirty(self):
+        return self._needs_full_rebuild or len(self._dirty_cells) > 0
+
+    def accepts_sprite_type(self, sprite_type):
+        return False
+
+    def update(self, sprite_id):
+        raise ValueError("TileMapLayer doesn't accept sprites, use set_tile instead")
+
+    def remove(self, sprite_id):
+        pass  # sprites are never added to begin with
+
+    def rebuild(self, sprite_lookup):
+        if self._needs_full_rebuild:
+            self._write_cells(numpy.arange(self._grid_size[0] * self._grid_size[1]))
+            self._needs_full_rebuild = False
+        elif len(self._dirty_cells) > 0:
+            self._write_cells(numpy.unique(numpy.array(self._dirty_cells, dtype=numpy.int64)))
+        self._dirty_cells.clear()
+
+    def _write_cells(self, cells):
+        """cells: array of flat cell indices to write into the vertex arrays."""
+        n_cols = self._grid_size[0]
+        cell_w, cell_h = self._cell_size
+
+        model_idxs = self.tile_models.ravel()[cells]
+
+        x = (cells % n_cols).astype(numpy.float32) * cell_w
+        y = (cells // n_cols).astype(numpy.float32) * cell_h
+        w = self._model_sizes[model_idxs, 0] * self._scale
+        h = self._model_sizes[model_idxs, 1] * self._scale
+
+        vertices = self.vertices.reshape((-1, 8))
+        vertices[cells] = numpy.stack([x, y, x, y + h, x + w, y + h, x + w, y], axis=1)
+
+        tx1, ty1, tx2, ty2 = self._model_tex_coords[model_idxs].T
+        tex_coords = self.tex_coords.reshape((-1, 8))
+        tex_coords[cells] = numpy.stack([tx1, ty2, tx1, ty1, tx2, ty1, tx2, ty2], axis=1)
+
+        if self.is_color():
+            rgb = self._tint_colors[self.tile_tints.ravel()[cells]]
+            colors = self.colors.reshape((-1, 12))
+            colors[cells] = numpy.tile(rgb, 4)
+
+    def __contains__(self, uid):
+        return False
+
+    def get_num_sprites(self):
+        return int(numpy.count_nonzero(self.tile_models != TileMapLayer.EMPTY))
+
+
+class TextLayer(ImageLayer):
+    """
+        Layer for TextBlockSprites. Each block's glyph quads are laid out with numpy (and cached on the
+        sprite), so a block costs a few array ops instead of one ImageSprite per character.
+    """
+
+    def __init__(self, layer_id, layer_depth, sort_sprites=True, use_color=True, use_palette=False):
+        if use_palette:
+            raise ValueError("TextLayer doesn't support palette mode")
+        ImageLayer.__init__(self, layer_id, layer_depth, sort_sprites=sort_sprites, use_color=use_color)
+        self._n_glyphs = 0
+
+    def accepts_sprite_type(self, sprite_type):
+        return sprite_type == sprites.SpriteTypes.TEXT
+
+    def rebuild(self, sprite_lookup):
+        self._apply_pending_changes(sprite_lookup)
+
+        blocks = [sprite_lookup[uid] for uid in self.images]
+        layouts = [b.get_layout() for b in blocks]
+        self._n_glyphs = sum(len(layout) for layout in layouts)
+
+        if self._n_glyphs == 0:
+            self.vertices = numpy.array([], dtype=numpy.float32)
+            self.tex_coords = numpy.array([], dtype=numpy.float32)
+            self.indices = numpy.array([], dtype=numpy.uint32)
+            self.colors = numpy.array([], dtype=numpy.float32) if self.is_color() else None
+            return
+
+        self.vertices = numpy.concatenate(
+            [layout.vertices + numpy.tile((b.x(), b.y()), 4) for b, layout in zip(blocks, layouts)],
+            axis=0).astype(numpy.float32).ravel()
+        self.tex_coords = numpy.concatenate(
+            [layout.tex_coords for layout in layouts], axis=0).astype(numpy.float32).ravel()
+        if self.is_color():
+            self.colors = numpy.concatenate(
+                [layout.colors for layout in layouts], axis=0).astype(numpy.float32).ravel()
 
+        quad = numpy.array([0, 1, 2, 0, 2, 3], dtype=numpy.uint32)
+        self.indices = (numpy.arange(self._n_glyphs, dtype=numpy.uint32)[:, None] * 4 + quad).ravel()
 
+    def get_num_glyphs(self):
+        return self._n_glyphs
@@ -2,9 +2,22 @@ from OpenGL.GL import *
 from OpenGL.GLU import *
 
 import numpy
+import collections
+import hashlib
 import math
+import os
+import random
 import re
+import struct
+import time
 import traceback
+import weakref
+
+import src.utils.util as util
+import src.engine.sprites as sprites
+import src.engine.capture as capture
+import src.engine.rendertimings as rendertimings
+import src.engine.spritetracker as spritetracker
 
 
 def printOpenGLError():
@@ -15,7 +28,24 @@ def printOpenGLError():
 
 class Shader:
 
-    def __init__(self, vertex_shader_source, fragment_shader_source):
+    def __init__(self, vertex_shader_source, fragment_shader_source, binary_cache=None):
+        """
+            binary_cache: an optional ProgramBinaryCache. if it has a binary for these sources, it's used
+                          instead of compiling them. otherwise the freshly linked program is added to it.
+        """
+        self.vs = None
+        self.fs = None
+        self.program = None
+
+        if binary_cache is not None:
+            self.program = binary_cache.load_program(vertex_shader_source, fragment_shader_source)
+
+        if self.program is None:
+            self._compile_and_link(vertex_shader_source, fragment_shader_source, binary_cache is not None)
+            if binary_cache is not None:
+                binary_cache.save_program(self.program, vertex_shader_source, fragment_shader_source)
+
+    def _compile_and_link(self, vertex_shader_source, fragment_shader_source, retrievable):
         self.program = glCreateProgram()
         printOpenGLError()
 
@@ -37,6 +67,9 @@ class Shader:
         if len(info_log) > 0:
             print("INFO: fragment shader has non-empty info log: {}".format(info_log))
 
+        if retrievable:
+            glProgramParameteri(self.program, GL_PROGRAM_BINARY_RETRIEVABLE_HINT, GL_TRUE)
+
         glLinkProgram(self.program)
         printOpenGLError()
 
@@ -50,23 +83,148 @@ class Shader:
     def end(self):
         glUseProgram(0)
 
+    def delete(self):
+        for shader_id in (self.vs, self.fs):
+            if shader_id is not None:
+                glDeleteShader(shader_id)
+        glDeleteProgram(self.program)
+
+
+class ProgramBinaryCache:
+    """
+        saves linked shader programs to disk, so they can be loaded instead of recompiled at startup
+        and after display mode changes. binaries only work on the driver that made them, so the driver
+        is part of each entry's key, along with the shader sources.
+    """
+
+    _MAGIC = b"GLPB"
+
+    def __init__(self, directory, driver_key):
+        self.directory = directory
+        self.driver_key = driver_key
+        self._binaries = {}  # key -> (binary_format, data), or None if there's no usable binary
+
+    @staticmethod
+    def is_supported(caps):
+        """caps: a GLCapabilities"""
+        if not (caps.supports_gl(4, 1) or caps.has_extension("GL_ARB_get_program_binary")):
+            return False
+        try:
+            # drivers can support the extension without supporting any formats
+            return int(glGetIntegerv(GL_NUM_PROGRAM_BINARY_FORMATS)) > 0
+        except Exception:
+            return False
+
+    def _get_key(self, vertex_shader_source, fragment_shader_source):
+        hasher = hashlib.sha1()
+        for text in (self.driver_key, vertex_shader_source, fragment_shader_source):
+            hasher.update(text.encode("utf-8"))
+            hasher.update(b"\0")
+        return hasher.hexdigest()
+
+    def _get_path(self, key):
+        return os.path.join(self.directory, key + ".bin")
+
+    def load_program(self, vertex_shader_source, fragment_shader_source):
+        """returns: the id of a linked program, or None if there's no usable binary for these sources."""
+        key = self._get_key(vertex_shader_source, fragment_shader_source)
+        if key not in self._binaries:
+            self._binaries[key] = self._read_binary(key)
+
+        if self._binaries[key] is None:
+            return None
+
+        binary_format, data = self._binaries[key]
+        program = glCreateProgram()
+        try:
+            glProgramBinary(program, binary_format, data, len(data))
+            linked = glGetProgramiv(program, GL_LINK_STATUS) == GL_TRUE
+        except Exception:
+            linked = False
+
+        if linked:
+            return program
+        else:
+            # happens when the driver is updated without its version string changing
+            print("INFO: shader binary was rejected by the driver, recompiling: {}".format(key))
+            glDeleteProgram(program)
+            self._binaries[key] = None
+            return None
+
+    def save_program(self, program, vertex_shader_source, fragment_shader_source):
+        if glGetProgramiv(program, GL_LINK_STATUS) != GL_TRUE:
+            return
+
+        key = self._get_key(vertex_shader_source, fragment_shader_source)
+        try:
+            length = int(glGetProgramiv(program, GL_PROGRAM_BINARY_LENGTH))
+            buf = numpy.zeros(length, dtype=numpy.uint8)
+            out_length = numpy.zeros(1, dtype=numpy.int32)
+            out_format = numpy.zeros(1, dtype=numpy.uint32)
+            glGetProgramBinary(program, length, out_length, out_format, buf)
+            binary_format, data = int(out_format[0]), buf[:out_length[0]].tobytes()
+        except Exception:
+            print("WARN: failed to get shader binary: {}".format(key))
+            traceback.print_exc()
+            return
+
+        self._binaries[key] = (binary_format, data)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self._get_path(key), "wb") as f:
+                f.write(ProgramBinaryCache._MAGIC + struct.pack("<I", binary_format) + data)
+        except OSError:
+            print("WARN: failed to save shader binary: {}".format(self._get_path(key)))
+            traceback.print_exc()
+
+    def _read_binary(self, key):
+        path = self._get_path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, "rb") as f:
+                raw = f.read()
+        except OSError:
+            print("WARN: failed to read shader binary: {}".format(path))
+            return None
+
+        header_len = len(ProgramBinaryCache._MAGIC) + 4
+        if len(raw) <= header_len or not raw.startswith(ProgramBinaryCache._MAGIC):
+            print("WARN: ignoring malformed shader binary: {}".format(path))
+            return None
+
+        binary_format = struct.unpack("<I", raw[len(ProgramBinaryCache._MAGIC):header_len])[0]
+        return (binary_format, raw[header_len:])
+
 
 _SINGLETON = None
 
 
-def create_instance():
-    """intializes the RenderEngine singleton."""
+def create_instance(benchmark=False, cache_path=None, shader_cache_dir=None):
+    """
+        intializes the RenderEngine singleton.
+        benchmark: whether to time the supported backends on an offscreen target and use the fastest one.
+        cache_path: json file where the benchmark's pick is saved per GPU and driver, so that later launches
+                    can skip the probe. if None, nothing is loaded or saved.
+        shader_cache_dir: directory to save linked shader programs in, if the driver supports it.
+    """
     global _SINGLETON
     if _SINGLETON is None:
-        vstring = glGetString(GL_VERSION)
-        vstring = vstring.decode() if vstring is not None else None
-        print("INFO: running OpenGL version: {}".format(vstring))
-
-        glsl_version = glGetString(GL_SHADING_LANGUAGE_VERSION)
-        glsl_version = glsl_version.decode() if glsl_version is not None else None
-        print("INFO: with shading language version: {}".format(glsl_version))
+        caps = GLCapabilities.detect()
+        print("INFO: running OpenGL version: {}".format(caps.version))
+        print("INFO: with shading language version: {}".format(caps.glsl_version))
+        print("INFO: on renderer: {} ({})".format(caps.renderer, caps.vendor))
+
+        engine_class = _choose_render_engine_class(caps, benchmark, cache_path)
+        _SINGLETON = engine_class()
+        _SINGLETON.capabilities = caps
+
+        if shader_cache_dir is not None:
+            if ProgramBinaryCache.is_supported(caps):
+                _SINGLETON.shader_binary_cache = ProgramBinaryCache(shader_cache_dir, caps.get_driver_key())
+            else:
+                print("INFO: shader binaries aren't supported, shaders will be compiled from source")
 
-        _SINGLETON = _get_best_render_engine(glsl_version)
         return _SINGLETON
     else:
         raise ValueError("There is already a RenderEngine initialized.")
@@ -77,13 +235,14 @@ def get_instance():
     return _SINGLETON
 
 
-def _get_best_render_engine(glsl_version):
+def _parse_version(version_str):
+    """returns: (major, minor) from a string like "##.##.## <Anything>", or (1, 0) if it can't be parsed."""
     major_vers = 1
     minor_vers = 0
 
     try:
         # it's formatted like "##.##.## <Anything>", so we split on periods and spaces
-        chunks = re.split("[. ]", glsl_version)
+        chunks = re.split("[. ]", version_str)
         chunks = [c for c in chunks if len(c) > 0]
 
         if len(chunks) >= 1:
@@ -92,19 +251,496 @@ def _get_best_render_engine(glsl_version):
             minor_vers = int(chunks[1])
 
     except Exception:
-        print("ERROR: failed to parse glsl_version: {}".format(glsl_version))
+        print("ERROR: failed to parse version: {}".format(version_str))
         traceback.print_exc()
 
-    if major_vers <= 1 and minor_vers < 30:
-        return RenderEngine120()
-    else:
-        return RenderEngine130()
+    return (major_vers, minor_vers)
+
+
+def _decode_gl_string(name):
+    res = glGetString(name)
+    return res.decode() if res is not None else None
+
+
+class GLCapabilities:
+    """the version strings and extensions of the current OpenGL context."""
+
+    def __init__(self, vendor, renderer, version, glsl_version, extensions):
+        self.vendor = vendor
+        self.renderer = renderer
+        self.version = version
+        self.glsl_version = glsl_version
+        self.extensions = frozenset(extensions)
+
+        self.gl_version_tuple = _parse_version(version)
+        self.glsl_version_tuple = _parse_version(glsl_version)
+
+    @staticmethod
+    def detect():
+        extensions = set()
+        try:
+            ext_str = _decode_gl_string(GL_EXTENSIONS)
+        except Exception:
+            ext_str = None  # not allowed in core profiles
+
+        if ext_str is not None:
+            extensions.update(ext_str.split())
+        else:
+            try:
+                for i in range(int(glGetIntegerv(GL_NUM_EXTENSIONS))):
+                    extensions.add(glGetStringi(GL_EXTENSIONS, i).decode())
+            except Exception:
+                print("WARN: failed to query OpenGL extensions")
+                traceback.print_exc()
+
+        return GLCapabilities(_decode_gl_string(GL_VENDOR),
+                              _decode_gl_string(GL_RENDERER),
+                              _decode_gl_string(GL_VERSION),
+                              _decode_gl_string(GL_SHADING_LANGUAGE_VERSION),
+                              extensions)
+
+    def has_extension(self, name):
+        return name in self.extensions
+
+    def supports_gl(self, major, minor):
+        return self.gl_version_tuple >= (major, minor)
+
+    def supports_glsl(self, major, minor):
+        return self.glsl_version_tuple >= (major, minor)
+
+    def has_framebuffers(self):
+        return self.supports_gl(3, 0) or self.has_extension("GL_ARB_framebuffer_object")
+
+    def has_buffer_objects(self):
+        return self.supports_gl(1, 5) or self.has_extension("GL_ARB_vertex_buffer_object")
+
+    def get_driver_key(self):
+        """returns: a string that identifies the GPU and driver."""
+        return "{} | {} | {}".format(self.vendor, self.renderer, self.version)
+
+
+def _get_best_render_engine_class(caps):
+    for engine_class in (RenderEngine130, RenderEngine120):
+        if engine_class.is_supported(caps):
+            return engine_class
+    raise ValueError("no supported render engine for OpenGL {} with GLSL {} (GLSL 1.20 or newer is required)".format(
+        caps.version, caps.glsl_version))
+
+
+def _choose_render_engine_class(caps, benchmark, cache_path):
+    candidates = [engine_class for engine_class in RENDER_ENGINE_CLASSES if engine_class.is_supported(caps)]
+    driver_key = caps.get_driver_key()
+
+    cache = _load_backend_cache(cache_path)
+    if driver_key in cache:
+        cached_name = cache[driver_key].get("engine", None)
+        for engine_class in candidates:
+            if engine_class.__name__ == cached_name:
+                print("INFO: using cached render engine choice: {}".format(cached_name))
+                return engine_class
+        print("WARN: cached render engine isn't supported, ignoring it: {}".format(cached_name))
+
+    if benchmark and len(candidates) > 1 and caps.has_framebuffers():
+        print("INFO: benchmarking render engines: {}".format([c.__name__ for c in candidates]))
+        timings = _benchmark_render_engines(candidates)
+        finished = [c for c in candidates if timings[c] is not None]
+        if len(finished) > 0:
+            best = min(finished, key=lambda c: timings[c])
+            for c in candidates:
+                ms = "failed" if timings[c] is None else "{:.3f}ms".format(timings[c] * 1000)
+                print("INFO:   {}: {}".format(c.__name__, ms))
+            print("INFO: fastest render engine is: {}".format(best.__name__))
+
+            if cache_path is not None:
+                cache[driver_key] = {
+                    "engine": best.__name__,
+                    "frame_times": {c.__name__: timings[c] for c in candidates}
+                }
+                _save_backend_cache(cache, cache_path)
+            return best
+
+    return _get_best_render_engine_class(caps)
+
+
+def _load_backend_cache(cache_path):
+    if cache_path is None or not os.path.exists(cache_path):
+        return {}
+    try:
+        return util.Utils.load_json_from_path(cache_path)
+    except Exception:
+        print("WARN: failed to load render engine cache: {}".format(cache_path))
+        traceback.print_exc()
+        return {}
+
+
+def _save_backend_cache(cache, cache_path):
+    try:
+        util.Utils.save_json_to_path(cache, cache_path)
+    except Exception:
+        print("WARN: failed to save render engine cache: {}".format(cache_path))
+        traceback.print_exc()
+
+
+def _benchmark_render_engines(engine_classes, size=(320, 240), n_sprites=2500, n_frames=30):
+    """
+        renders the same scene with each engine into an offscreen framebuffer.
+        returns: engine_class -> average seconds per frame, or None if it failed.
+    """
+    import src.engine.layers as layers  # (._.) layers imports this module
+
+    w, h = size
+    fbo, target_tex = _create_offscreen_target(w, h)
+
+    results = {}
+    model = None
+    try:
+        if glCheckFramebufferStatus(GL_FRAMEBUFFER) != GL_FRAMEBUFFER_COMPLETE:
+            print("WARN: offscreen framebuffer is incomplete, skipping render engine benchmark")
+            return {c: None for c in engine_classes}
+
+        tex_size = 16
+        tex_data = b"\xff" * (tex_size * tex_size * 4)
+        model = sprites.ImageModel(0, 0, 8, 8, texture_size=(tex_size, tex_size))
+
+        for engine_class in engine_classes:
+            rand = random.Random(12345)  # same scene for each engine
+            engine = engine_class()
+            bench_sprites = []
+            try:
+                engine.init(w, h)
+                engine.set_texture(tex_data, tex_size, tex_size)
+                engine.add_layer(layers.ImageLayer("benchmark", 0, False, True))
+                for _ in range(n_sprites):
+                    color = (rand.random(), rand.random(), rand.random())
+                    bench_sprites.append(sprites.ImageSprite(model, rand.randint(0, w), rand.randint(0, h), "benchmark",
+                                                             scale=rand.randint(1, 4), color=color))
+                    engine.update(bench_sprites[-1])
+
+                engine.render_layers()  # the first frame builds the layer, which costs the same for every engine
+                glFinish()
+
+                start_time = time.perf_counter()
+                for _ in range(n_frames):
+                    engine.render_layers()
+                glFinish()
+                results[engine_class] = (time.perf_counter() - start_time) / n_frames
+
+            except Exception:
+                print("WARN: render engine failed to benchmark: {}".format(engine_class.__name__))
+                traceback.print_exc()
+                results[engine_class] = None
+            finally:
+                for spr in bench_sprites:
+                    engine.remove(spr)
+                if "benchmark" in engine.layers:
+                    engine.remove_layer("benchmark")  # it holds the removed sprites' ids until it's rebuilt
+                engine.delete_gl_objects()
+    finally:
+        if model is not None:
+            sprites.get_model_table().free(model.model_id)
+        _delete_offscreen_target(fbo, target_tex)
+
+    return results
+
+
+def benchmark_fill_rate(engine_class=None, size=(1280, 720), pixel_scales=(1, 2, 4, 8), overdraw=8, n_frames=30):
+    """
+        measures how fast an engine can fill the screen, by covering an offscreen framebuffer with overlapping
+        screen-sized sprites at each pixel scale. this is bound by the fragment shader, unlike the backend benchmark.
+        it changes GL state, so it should be run before the real engine is initialized (like the backend benchmark).
+        engine_class: the engine to test, or None to use the current instance's class.
+        returns: pixel_scale -> average seconds per frame.
+    """
+    import src.engine.layers as layers  # (._.) layers imports this module
+
+    if engine_class is None:
+        engine_class = type(get_instance())
+
+    w, h = size
+    fbo, target_tex = _create_offscreen_target(w, h)
+
+    results = {}
+    engine = engine_class()
+    model = None
+    bench_sprites = []
+    try:
+        tex_size = 16
+        tex_data = bytes([(i * 37) % 256 for i in range(tex_size * tex_size * 4)])  # a mix of bright and dark texels
+        model = sprites.ImageModel(0, 0, tex_size, tex_size, texture_size=(tex_size, tex_size))
+
+        engine.init(w, h)
+        engine.set_texture(tex_data, tex_size, tex_size)
+        engine.add_layer(layers.ImageLayer("benchmark", 0, False, True))
+        for i in range(overdraw):
+            bench_sprites.append(sprites.ImageSprite(model, 0, 0, "benchmark", scale=math.ceil(max(w, h) / tex_size),
+                                                     color=(1 - i / overdraw, 0.5, i / overdraw)))
+            engine.update(bench_sprites[-1])
+
+        for pixel_scale in pixel_scales:
+            engine.set_pixel_scale(pixel_scale)
+            engine.render_layers()
+            glFinish()
+
+            start_time = time.perf_counter()
+            for _ in range(n_frames):
+                engine.render_layers()
+            glFinish()
+            results[pixel_scale] = (time.perf_counter() - start_time) / n_frames
+
+            print("INFO: {} fill rate at pixel scale {}: {:.3f} ms/frame ({:.1f} Mpx/s)".format(
+                engine_class.__name__, pixel_scale, results[pixel_scale] * 1000,
+                overdraw * w * h / results[pixel_scale] / 1e6))
+    finally:
+        for spr in bench_sprites:
+            engine.remove(spr)
+        if "benchmark" in engine.layers:
+            engine.remove_layer("benchmark")  # it holds the removed sprites' ids until it's rebuilt
+        engine.delete_gl_objects()
+        if model is not None:
+            sprites.get_model_table().free(model.model_id)
+        _delete_offscreen_target(fbo, target_tex)
+
+    return results
+
+
+def _create_offscreen_target(w, h):
+    """returns: (framebuffer id, texture id) of a w x h framebuffer, which is left bound."""
+    fbo = glGenFramebuffers(1)
+    target_tex = glGenTextures(1)
+    glBindTexture(GL_TEXTURE_2D, target_tex)
+    glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, w, h, 0, GL_RGBA, GL_UNSIGNED_BYTE, None)
+    glBindFramebuffer(GL_FRAMEBUFFER, fbo)
+    glFramebufferTexture2D(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_TEXTURE_2D, target_tex, 0)
+    return fbo, target_tex
+
+
+def _delete_offscreen_target(fbo, target_tex):
+    glBindFramebuffer(GL_FRAMEBUFFER, 0)
+    glDeleteFramebuffers(1, [fbo])
+    glDeleteTextures([target_tex])
+    glActiveTexture(GL_TEXTURE0)
+
+
+class Palette:
+    """
+        A table of (up to 256) colors that's mirrored into a 256x1 texture. Layers in palette mode only
+        send each sprite's palette index to the GPU, so changing an entry recolors every sprite using it.
+        Registered colors keep their index even if the entry is changed afterwards.
+    """
+
+    SIZE = 256
+
+    def __init__(self):
+        self._texels = numpy.zeros((Palette.SIZE, 4), dtype=numpy.uint8)
+        self._colors = [(0, 0, 0)] * Palette.SIZE
+        self._n_colors = 0
+        self._lookup = {}  # (r, g, b) -> index
+
+        self._dirty_range = None  # (first, last) indices that need to be re-uploaded
+
+        self.register((1, 1, 1))  # 0 is white, same as the default vertex color
+
+    def register(self, color):
+        """returns: the index of the color, adding it to the palette if necessary."""
+        color = tuple(color)
+        if color in self._lookup:
+            return self._lookup[color]
+        elif self._n_colors >= Palette.SIZE:
+            raise ValueError("palette is full, can't add color: {}".format(color))
+        else:
+            idx = self._n_colors
+            self._n_colors += 1
+            self._lookup[color] = idx
+            self.set_color(idx, color)
+            return idx
+
+    def index_of(self, color):
+        """color: an (r, g, b) tuple or a palette index."""
+        if isinstance(color, int):
+            return color
+        else:
+            return self.register(color)
+
+    def set_color(self, idx, color):
+        """changes a palette entry. this recolors all the sprites using it, without rebuilding any layers."""
+        if not 0 <= idx < Palette.SIZE:
+            raise ValueError("palette index out of range: {}".format(idx))
+        r, g, b = color
+        self._colors[idx] = (r, g, b)
+        self._texels[idx] = (round(255 * r), round(255 * g), round(255 * b), 255)
+
+        if self._dirty_range is None:
+            self._dirty_range = (idx, idx)
+        else:
+            self._dirty_range = (min(idx, self._dirty_range[0]), max(idx, self._dirty_range[1]))
+
+    def get_color(self, idx):
+        return self._colors[idx]
+
+    def __len__(self):
+        return self._n_colors
+
+    def mark_all_dirty(self):
+        self._dirty_range = (0, Palette.SIZE - 1)
+
+    def pop_dirty_texels(self):
+        """returns: (first_idx, texel data) of the entries that changed since the last call, or None."""
+        if self._dirty_range is None:
+            return None
+        else:
+            first, last = self._dirty_range
+            self._dirty_range = None
+            return first, self._texels[first:last + 1].tobytes()
+
+
+class SpriteLookup:
+    """
+        Maps sprite ids to sprites. Ids are dense (see sprites.IdAllocator), so this is a list indexed by id
+        rather than a dict.
+    """
+
+    def __init__(self):
+        self._sprites = []
+        self._count = 0
+
+    def __getitem__(self, uid):
+        spr = self._sprites[uid] if 0 <= uid < len(self._sprites) else None
+        if spr is None:
+            raise KeyError(uid)
+        return spr
+
+    def __setitem__(self, uid, sprite):
+        if uid >= len(self._sprites):
+            new_len = max(uid + 1, sprites.get_id_capacity(), 2 * len(self._sprites))
+            self._sprites.extend([None] * (new_len - len(self._sprites)))
+        if self._sprites[uid] is None:
+            self._count += 1
+        self._sprites[uid] = sprite
+
+    def __delitem__(self, uid):
+        if uid not in self:
+            raise KeyError(uid)
+        self._sprites[uid] = None
+        self._count -= 1
+
+    def __contains__(self, uid):
+        return 0 <= uid < len(self._sprites) and self._sprites[uid] is not None
+
+    def __iter__(self):
+        for uid, spr in enumerate(self._sprites):
+            if spr is not None:
+                yield uid
+
+    def __len__(self):
+        return self._count
+
+    def clear(self):
+        self._sprites.clear()
+        self._count = 0
+
+
+class SpritePool:
+    """
+        Spare ImageSprites that multi-sprites (like TextSprite) reuse instead of making new ones. Pooled
+        sprites aren't in any layer, but they keep their ids. Each layer's pool is capped, and sprites
+        that sit in it unused for too long are dropped (and their ids freed).
+    """
+
+    def __init__(self, engine, max_per_layer=256, max_idle_frames=600):
+        self._engine = engine
+        self.max_per_layer = max_per_layer
+        self.max_idle_frames = max_idle_frames
+        self._pools = {}  # layer_id -> deque of (frame it was released, sprite), oldest first
+
+    def acquire(self, layer_id):
+        """returns: a hidden ImageSprite for the layer. it isn't added to the engine."""
+        pool = self._pools.get(layer_id)
+        if pool is not None and len(pool) > 0:
+            return pool.pop()[1]
+        return sprites.ImageSprite.new_sprite(layer_id)
+
+    def release(self, sprite):
+        """removes the sprite from the engine, and keeps it for reuse if there's room."""
+        layer_id = sprite.layer_id()
+        if layer_id not in self._pools:
+            self._pools[layer_id] = collections.deque()
+        pool = self._pools[layer_id]
+
+        self._engine.remove(sprite)
+        if len(pool) < self.max_per_layer:
+            pool.append((self._engine.get_frame_count(), sprite.update(new_model=False)))
+
+    def trim(self):
+        """drops the sprites that have been idle for too long."""
+        cur_frame = self._engine.get_frame_count()
+        for pool in self._pools.values():
+            while len(pool) > 0 and cur_frame - pool[0][0] > self.max_idle_frames:
+                pool.popleft()
+
+    def clear(self):
+        self._pools.clear()
+
+    def __len__(self):
+        return sum(len(pool) for pool in self._pools.values())
+
+
+class GLResources:
+    """
+        Keeps track of how to recreate the GL objects an engine owns, in case the context is lost.
+        Whether it was lost is detected with a sentinel texture: if the context that made it is gone, the
+        name won't refer to a texture anymore. (on Windows, pygame.display.set_mode can replace the context,
+        but on other platforms it usually survives, and there's nothing to restore.)
+    """
+
+    def __init__(self):
+        self._restore_funcs = {}  # name -> function that recreates the resource
+        self._ordered_names = []  # restored in the order they were registered
+        self._sentinel_tex_id = None
+
+    def register(self, name, restore_func):
+        """restore_func: called with no args after the context is lost. it should assume all the old GL ids are invalid."""
+        if name not in self._restore_funcs:
+            self._ordered_names.append(name)
+        self._restore_funcs[name] = restore_func
+
+    def unregister(self, name):
+        if name in self._restore_funcs:
+            del self._restore_funcs[name]
+            self._ordered_names.remove(name)
+
+    def create_sentinel(self):
+        prev_binding = glGetIntegerv(GL_TEXTURE_BINDING_2D)
+        self._sentinel_tex_id = glGenTextures(1)
+        glBindTexture(GL_TEXTURE_2D, self._sentinel_tex_id)  # names only become textures once they're bound
+        glBindTexture(GL_TEXTURE_2D, prev_binding)
+
+    def delete_sentinel(self):
+        if self._sentinel_tex_id is not None:
+            glDeleteTextures([self._sentinel_tex_id])
+            self._sentinel_tex_id = None
+
+    def is_context_lost(self):
+        return self._sentinel_tex_id is None or not glIsTexture(self._sentinel_tex_id)
+
+    def restore_if_lost(self):
+        """returns: True if the context was lost (and everything was restored), False otherwise."""
+        if not self.is_context_lost():
+            return False
+
+        print("INFO: gl context was lost, restoring: {}".format(self._ordered_names))
+        self.create_sentinel()
+        for name in self._ordered_names:
+            self._restore_funcs[name]()
+        return True
 
 
 class RenderEngine:
 
     def __init__(self):
-        self.sprite_lookup = {}  # (int) id -> _Sprite
+        self.sprite_lookup = SpriteLookup()  # (int) id -> _Sprite
+        self.sprite_pool = SpritePool(self)
+        self._published_groups = weakref.WeakKeyDictionary()  # MultiSprite -> version of its children in the layers
+        self._frame_count = 0
         self.camera_pos = [0, 0]
         self.size = (0, 0)
         self.min_size = (0, 0)
@@ -116,9 +752,24 @@ class RenderEngine:
 
         self.tex_id = None
 
-        self.raw_texture_data = (None, 0, 0)  # data, width, height
+        self.raw_texture_data = (None, 0, 0)  # list of pages' data, width, height
+
+        self.palette = Palette()
+        self.palette_tex_id = None
+
+        self.capabilities = None  # GLCapabilities
+        self.shader_binary_cache = None  # ProgramBinaryCache
+
+        self._recorder = None  # capture.FrameRecorder
+        self._timings = None  # rendertimings.RenderTimings
+        self._sprite_tracker = None  # spritetracker.SpriteTracker
 
         self._surface = None  # only storing this for (rare, hopefully) pygame-style draw calls
+
+        self.resources = GLResources()
+        self.resources.register("shader", self._restore_shader)
+        self.resources.register("textures", self._restore_textures)
+        self.resources.register("tools", self._restore_tools)
         
     def add_layer(self, layer):
         self.layers[layer.get_layer_id()] = layer
@@ -126,6 +777,9 @@ class RenderEngine:
         self.ordered_layers = list(self.layers.values())
         self.ordered_layers.sort(key=lambda x: x.get_layer_depth())
         
+    def get_layer(self, layer_id):
+        return self.layers[layer_id]
+
     def remove_layer(self, layer_id):
         del self.layers[layer_id]
         
@@ -147,6 +801,9 @@ class RenderEngine:
             for l in self.layers.values():
                 l.remove(uid)
         self.sprite_lookup.clear()
+        self._published_groups.clear()
+        if self._sprite_tracker is not None:
+            self._sprite_tracker.clear()
         
     def clear_sprites(self, sprites):
         for spr in sprites:
@@ -186,6 +843,11 @@ class RenderEngine:
     def set_pixel_scale(self, val):
         self.resize(self.size[0], self.size[1], px_scale=val)
 
+    @staticmethod
+    def is_supported(caps):
+        """caps: a GLCapabilities"""
+        raise NotImplementedError()
+
     def get_glsl_version(self):
         raise NotImplementedError()
 
@@ -219,9 +881,18 @@ class RenderEngine:
     def set_colors(self, data):
         raise NotImplementedError()
 
+    def set_palette_indices_enabled(self, val):
+        raise NotImplementedError()
+
+    def set_palette_indices(self, data):
+        raise NotImplementedError()
+
     def get_shader(self):
         return self.shader
 
+    def get_palette(self):
+        return self.palette
+
     def init(self, w, h):
         glShadeModel(GL_FLAT)
         glClearColor(0.5, 0.5, 0.5, 0.0)
@@ -231,49 +902,155 @@ class RenderEngine:
         self.shader.begin()
         self.setup_shader()
 
+        self._create_palette_texture()
+        self.resources.create_sentinel()
+
         self.resize(w, h)
 
     def reset_for_display_mode_change(self, new_surface):
         """
            XXX on Windows, when pygame.display.set_mode is called, it seems to wipe away the active
            gl context, so we get around that by rebuilding the shader program and rebinding the texture...
+           but only if the context actually was replaced (see GLResources).
         """
-        self.shader.end()
+        self._surface = new_surface
+        self.resources.restore_if_lost()
+
+    def _restore_shader(self):
+        glShadeModel(GL_FLAT)
 
         self.shader = self.build_shader()
         self.shader.begin()
         self.setup_shader()
+        self.resize_internal()
 
-        img_data, w, h = self.raw_texture_data
-        if img_data is not None:
-            self.set_texture(img_data, w, h, tex_id=self.tex_id)
+    def _restore_textures(self):
+        pages, w, h = self.raw_texture_data
+        if pages is not None:
+            self.set_texture_pages(pages, w, h)
 
-        self._surface = new_surface
+        self._create_palette_texture()
+
+    def _restore_tools(self):
+        if self._recorder is not None:
+            self._recorder.on_context_lost()
+        if self._timings is not None:
+            self._timings.on_context_lost()
 
     def set_texture(self, img_data, width, height, tex_id=None):
         """
             img_data: image data in string RGBA format.
         """
+        self.set_texture_pages([img_data], width, height, tex_id=tex_id)
+
+    def set_texture_pages(self, pages, width, height, tex_id=None):
+        """
+            pages: list of image data in string RGBA format, one per atlas page. they must all be the same size.
+                   numpy arrays work too, including memory-mapped ones (see spritesheets.AtlasCache).
+                   the pages are stored in a texture array, and sprites pick theirs via their model (see ImageModel).
+                   engines without texture arrays only take one page, which is stored in a plain 2D texture.
+        """
+        pages = list(pages)
+        if len(pages) > self.get_max_texture_pages():
+            raise ValueError("too many texture pages: {} (max is {})".format(len(pages), self.get_max_texture_pages()))
+
         if tex_id is None:
             tex_id = glGenTextures(1)
             self.tex_id = tex_id
 
-        glBindTexture(GL_TEXTURE_2D, tex_id)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
-        glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, width, height, 0, GL_RGBA, GL_UNSIGNED_BYTE, img_data)
-        glEnable(GL_TEXTURE_2D)
+        if self.uses_texture_array():
+            glBindTexture(GL_TEXTURE_2D_ARRAY, tex_id)
+            glTexParameteri(GL_TEXTURE_2D_ARRAY, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+            glTexParameteri(GL_TEXTURE_2D_ARRAY, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+            data = pages[0] if len(pages) == 1 else b"".join(pages)
+            glTexImage3D(GL_TEXTURE_2D_ARRAY, 0, GL_RGBA, width, height, len(pages), 0, GL_RGBA, GL_UNSIGNED_BYTE, data)
+        else:
+            glBindTexture(GL_TEXTURE_2D, tex_id)
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+            glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, width, height, 0, GL_RGBA, GL_UNSIGNED_BYTE, pages[0])
+            glEnable(GL_TEXTURE_2D)
 
         glEnable(GL_BLEND)
         glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
 
-        self.raw_texture_data = (img_data, width, height)
+        self.raw_texture_data = (pages, width, height)
 
         self.set_texture_internal()
 
+    def update_texture_region(self, page, x, y, w, h, img_data):
+        """
+            overwrites part of one atlas page, without re-uploading the rest of it.
+            x, y: the region's bottom left corner, in texels (GL's y-axis points up).
+            img_data: the region's image data in string RGBA format, bottom row first.
+        """
+        pages, tex_w, tex_h = self.raw_texture_data
+        if pages is None:
+            raise ValueError("there's no texture to update")
+        if not (0 <= page < len(pages) and 0 <= x and x + w <= tex_w and 0 <= y and y + h <= tex_h):
+            raise ValueError("region is outside the texture: page={}, rect={}".format(page, (x, y, w, h)))
+
+        region = numpy.frombuffer(img_data, dtype=numpy.uint8).reshape((h, w, 4))
+
+        # keep the copy that's used to restore the texture in sync
+        if not isinstance(pages[page], numpy.ndarray) or not pages[page].flags.writeable:
+            pages[page] = numpy.frombuffer(pages[page], dtype=numpy.uint8).reshape((tex_h, tex_w, 4)).copy()
+        pages[page][y:y + h, x:x + w] = region
+
+        glActiveTexture(GL_TEXTURE0)
+        if self.uses_texture_array():
+            glBindTexture(GL_TEXTURE_2D_ARRAY, self.tex_id)
+            glTexSubImage3D(GL_TEXTURE_2D_ARRAY, 0, x, y, page, w, h, 1, GL_RGBA, GL_UNSIGNED_BYTE, region)
+        else:
+            glBindTexture(GL_TEXTURE_2D, self.tex_id)
+            glTexSubImage2D(GL_TEXTURE_2D, 0, x, y, w, h, GL_RGBA, GL_UNSIGNED_BYTE, region)
+        printOpenGLError()
+
+    def get_num_texture_pages(self):
+        pages = self.raw_texture_data[0]
+        return len(pages) if pages is not None else 0
+
+    def get_max_texture_size(self):
+        return int(glGetIntegerv(GL_MAX_TEXTURE_SIZE))
+
+    def get_max_texture_pages(self):
+        if not self.uses_texture_array():
+            return 1
+        return int(glGetIntegerv(GL_MAX_ARRAY_TEXTURE_LAYERS))
+
+    def uses_texture_array(self):
+        """whether the atlas is a GL_TEXTURE_2D_ARRAY (one layer per page), or a single-page GL_TEXTURE_2D."""
+        return True
+
     def set_texture_internal(self):
         pass
 
+    def _create_palette_texture(self, tex_id=None):
+        """the palette lives in texture unit 1, the sprite atlas is in unit 0."""
+        if tex_id is None:
+            tex_id = glGenTextures(1)
+            self.palette_tex_id = tex_id
+
+        glActiveTexture(GL_TEXTURE1)
+        glBindTexture(GL_TEXTURE_2D, tex_id)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+        glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, Palette.SIZE, 1, 0, GL_RGBA, GL_UNSIGNED_BYTE, None)
+        glActiveTexture(GL_TEXTURE0)
+
+        self.palette.mark_all_dirty()
+
+    def _upload_palette_if_dirty(self):
+        dirty = self.palette.pop_dirty_texels()
+        if dirty is not None:
+            first_idx, texel_data = dirty
+            glActiveTexture(GL_TEXTURE1)
+            glBindTexture(GL_TEXTURE_2D, self.palette_tex_id)
+            glTexSubImage2D(GL_TEXTURE_2D, 0, first_idx, 0, len(texel_data) // 4, 1,
+                            GL_RGBA, GL_UNSIGNED_BYTE, texel_data)
+            glActiveTexture(GL_TEXTURE0)
+            printOpenGLError()
+
     def set_camera_pos(self, x, y, center=False):
         self.camera_pos[0] = x - (self.size[0] // 2) if center else 0
         self.camera_pos[1] = y - (self.size[1] // 2) if center else 0
@@ -283,53 +1060,170 @@ class RenderEngine:
             return
 
         if sprite.is_parent():
+            self._published_groups.pop(sprite, None)
             for child_sprite in sprite.all_sprites():
                 self.remove(child_sprite)
         else:
             uid = sprite.uid()
             if uid in self.sprite_lookup:
                 del self.sprite_lookup[uid]
+            if self._sprite_tracker is not None:
+                self._sprite_tracker.on_removed(uid)
 
             self.layers[sprite.layer_id()].remove(uid)
+            if sprite.is_handle():
+                sprite.attach(None)
         
     def update(self, sprite):
         if sprite is None:
             return
 
         if sprite.is_parent():
-            for child_sprite in sprite.all_sprites():
-                self.update(child_sprite)
+            version = sprite.get_version()
+            if version is None:
+                for child_sprite in sprite.all_sprites():
+                    self.update(child_sprite)
+            elif self._published_groups.get(sprite) != version:
+                # the children are already flattened, so the whole group goes out in one pass
+                for child_sprite in sprite.all_sprites():
+                    self._update_leaf(child_sprite)
+                self._published_groups[sprite] = version
+            elif self._sprite_tracker is not None:
+                # nothing to publish, but the children are still in use
+                for child_sprite in sprite.all_sprites():
+                    self._sprite_tracker.on_published(child_sprite)
         else:
-            uid = sprite.uid()
-            self.sprite_lookup[uid] = sprite
+            self._update_leaf(sprite)
 
-            layer = self.layers[sprite.layer_id()]
+    def _update_leaf(self, sprite):
+        uid = sprite.uid()
+        self.sprite_lookup[uid] = sprite
+
+        layer = self.layers[sprite.layer_id()]
+
+        if layer.accepts_sprite_type(sprite.sprite_type()):
+            layer.update(uid)
+            if sprite.is_handle():
+                sprite.attach(layer)
+            if self._sprite_tracker is not None:
+                self._sprite_tracker.on_published(sprite)
+        else:
+            raise ValueError("Incompatible sprite types: sprite's is {}, and layer's is {}".format(
+                sprite.sprite_type(), layer.get_sprite_type()))
 
-            if layer.accepts_sprite_type(sprite.sprite_type()):
-                layer.update(uid)
-            else:
-                raise ValueError("Incompatible sprite types: sprite's is {}, and layer's is {}".format(
-                    sprite.sprite_type(), layer.get_sprite_type()))
-        
     def render_layers(self):
+        timings = self._timings
+        if timings is not None:
+            timings.begin_frame()
+
         glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
 
+        if self._sprite_tracker is not None:
+            self._sprite_tracker.begin_frame(self._frame_count, self)
+
         for layer in self.ordered_layers:
+            layer_id = layer.get_layer_id()
             if layer.is_dirty():
+                start_time = time.perf_counter()
                 layer.rebuild(self.sprite_lookup)
+                if timings is not None:
+                    timings.add_rebuild_time(layer_id, time.perf_counter() - start_time)
+            elif timings is not None:
+                timings.add_rebuild_time(layer_id, 0)
 
-            if layer.get_layer_id() in self.hidden_layers:
+            # rebuilding can register new colors
+            self._upload_palette_if_dirty()
+
+            if layer_id in self.hidden_layers:
                 continue
 
             offs = layer.get_offset()
 
             self.set_matrix_offset(-offs[0], -offs[1])
-            
+
+            if timings is not None:
+                timings.begin_section(layer_id)
+
             layer.render(self)
 
+            if timings is not None:
+                timings.end_section(layer_id)
+
+        if timings is not None:
+            timings.end_frame()
+
+        if self._recorder is not None:
+            self._recorder.on_frame_rendered(*self.size)
+
+        self._frame_count += 1
+        self.sprite_pool.trim()
+
+    def get_frame_count(self):
+        """returns: the number of frames rendered so far."""
+        return self._frame_count
+
+    def start_recording(self, output_path, fmt=capture.FORMAT_PNG, every_nth_frame=1):
+        """starts saving every frame rendered (see capture.FrameRecorder)."""
+        if self._recorder is not None:
+            raise ValueError("already recording to: {}".format(self._recorder.output_path))
+        self._recorder = capture.FrameRecorder(output_path, fmt=fmt, every_nth_frame=every_nth_frame)
+
+    def stop_recording(self):
+        if self._recorder is not None:
+            self._recorder.stop()
+            self._recorder = None
+
+    def is_recording(self):
+        return self._recorder is not None
+
+    def set_timings_enabled(self, val):
+        """toggles per-layer CPU and GPU timing (see rendertimings.RenderTimings)."""
+        if val and self._timings is None:
+            gpu_queries = self.capabilities is not None and (self.capabilities.supports_gl(3, 3) or
+                                                             self.capabilities.has_extension("GL_ARB_timer_query"))
+            if not gpu_queries:
+                print("INFO: timer queries aren't supported, only CPU times will be measured")
+            self._timings = rendertimings.RenderTimings(use_gpu_queries=gpu_queries)
+        elif not val and self._timings is not None:
+            self._timings.delete_gl_objects()
+            self._timings = None
+
+    def get_timings(self):
+        """returns: the RenderTimings, or None if timing isn't enabled."""
+        return self._timings
+
+    def set_sprite_tracking_enabled(self, val, report_after=300, expire_after=None, capture_stacks=True):
+        """
+            toggles reporting (and optionally removing) sprites that stopped being republished, see
+            spritetracker.SpriteTracker. only sprites published after it's enabled are tracked.
+        """
+        if val and self._sprite_tracker is None:
+            self._sprite_tracker = spritetracker.SpriteTracker(report_after=report_after, expire_after=expire_after,
+                                                               capture_stacks=capture_stacks)
+        elif not val:
+            self._sprite_tracker = None
+
+    def get_sprite_tracker(self):
+        """returns: the SpriteTracker, or None if tracking isn't enabled."""
+        return self._sprite_tracker
+
     def cleanup(self):
+        self.stop_recording()
         self.shader.end()
 
+    def delete_gl_objects(self):
+        """deletes the shader program and textures owned by this engine."""
+        if self.shader is not None:
+            self.shader.end()
+            self.shader.delete()
+            self.shader = None
+        textures = [t for t in (self.tex_id, self.palette_tex_id) if t is not None]
+        if len(textures) > 0:
+            glDeleteTextures(textures)
+        self.tex_id = None
+        self.palette_tex_id = None
+        self.resources.delete_sentinel()
+
     def count_sprites(self):
         res = 0
         for layer in self.layers.values():
@@ -365,17 +1259,23 @@ class RenderEngine130(RenderEngine):
     def __init__(self):
         super().__init__()
         self._tex_uniform_loc = None
-        self._tex_size_uniform_loc = None
+        self._palette_uniform_loc = None
+        self._use_palette_uniform_loc = None
         self._modelview_matrix_uniform_loc = None
         self._proj_matrix_uniform_loc = None
 
         self._position_attrib_loc = None
         self._texture_pos_attrib_loc = None
         self._color_attrib_loc = None
+        self._palette_idx_attrib_loc = None
 
         self._modelview_matrix = numpy.identity(4, dtype=numpy.float32)
         self._proj_matrix = numpy.identity(4, dtype=numpy.float32)
 
+    @staticmethod
+    def is_supported(caps):
+        return caps.supports_glsl(1, 30)
+
     def get_glsl_version(self):
         return "130"
 
@@ -393,11 +1293,15 @@ class RenderEngine130(RenderEngine):
             
             in vec3 vColor;
             out vec3 color;
+
+            in float vPaletteIdx;
+            flat out float paletteIdx;
     
             void main()
             {
                 texCoord = vTexCoord;
                 color = vColor;
+                paletteIdx = vPaletteIdx;
                 gl_Position = proj * modelview * vec4(position.x, position.y, 0.0, 1.0);
             }
             ''',
@@ -405,25 +1309,26 @@ class RenderEngine130(RenderEngine):
             #version 130
             in vec2 texCoord;
             in vec3 color;
+            flat in float paletteIdx;
             
-            uniform vec2 texSize;
-            uniform sampler2D tex0;
+            uniform sampler2DArray tex0;
+            uniform sampler2D palette;
+            uniform float usePalette;
 
             void main(void) {
-                vec2 texPos = vec2(texCoord.x / texSize.x, texCoord.y / texSize.y);
-                vec4 tcolor = texture2D(tex0, texPos);
-                
-                for (int i = 0; i < 3; i++) {
-                    if (tcolor[i] >= 0.99) {
-                        gl_FragColor[i] = tcolor[i] * color[i];
-                    } else {
-                        gl_FragColor[i] = tcolor[i] * color[i] * color[i];                    
-                    }
-                }
-                
-                gl_FragColor.w = tcolor.w;
+                // the page is encoded in the y coord, see ImageModel
+                float page = floor(texCoord.y * 0.5);
+                vec4 tcolor = texture(tex0, vec3(texCoord.x, texCoord.y - 2.0 * page, page));
+
+                vec3 pcolor = texture2D(palette, vec2((paletteIdx + 0.5) / 256.0, 0.5)).rgb;
+                vec3 c = mix(color, pcolor, usePalette);
+
+                // bright channels are multiplied by the color, the rest by its square
+                vec3 tint = mix(c * c, c, step(0.99, tcolor.rgb));
+                gl_FragColor = vec4(tcolor.rgb * tint, tcolor.a);
             }
-            '''
+            ''',
+            binary_cache=self.shader_binary_cache
         )
 
     def _assert_valid_var(self, varname, loc):
@@ -438,8 +1343,14 @@ class RenderEngine130(RenderEngine):
         glUniform1i(self._tex_uniform_loc, 0)
         printOpenGLError()
 
-        self._tex_size_uniform_loc = glGetUniformLocation(prog_id, "texSize")
-        self._assert_valid_var("texSize", self._tex_size_uniform_loc)
+        self._palette_uniform_loc = glGetUniformLocation(prog_id, "palette")
+        self._assert_valid_var("palette", self._palette_uniform_loc)
+        glUniform1i(self._palette_uniform_loc, 1)
+        printOpenGLError()
+
+        self._use_palette_uniform_loc = glGetUniformLocation(prog_id, "usePalette")
+        self._assert_valid_var("usePalette", self._use_palette_uniform_loc)
+        glUniform1f(self._use_palette_uniform_loc, 0.0)
         printOpenGLError()
 
         self._modelview_matrix_uniform_loc = glGetUniformLocation(prog_id, "modelview")
@@ -465,6 +1376,11 @@ class RenderEngine130(RenderEngine):
         glVertexAttrib3f(self._color_attrib_loc, 1.0, 1.0, 1.0)
         printOpenGLError()
 
+        self._palette_idx_attrib_loc = glGetAttribLocation(prog_id, "vPaletteIdx")
+        self._assert_valid_var("vPaletteIdx", self._palette_idx_attrib_loc)
+        glVertexAttrib1f(self._palette_idx_attrib_loc, 0.0)
+        printOpenGLError()
+
     def set_matrix_offset(self, x, y):
         self._modelview_matrix = numpy.identity(4, dtype=numpy.float32)
         trans = translation_matrix(x, y)
@@ -501,14 +1417,6 @@ class RenderEngine130(RenderEngine):
             h += (px_scale - h % px_scale)
         return (w, h)
 
-    def set_texture_internal(self):
-        if self.raw_texture_data is not None:
-            tex_w = self.raw_texture_data[1]
-            tex_h = self.raw_texture_data[2]
-
-            glUniform2f(self._tex_size_uniform_loc, float(tex_w), float(tex_h))
-            printOpenGLError()
-
     def set_vertices_enabled(self, val):
         if val:
             glEnableVertexAttribArray(self._position_attrib_loc)
@@ -542,12 +1450,31 @@ class RenderEngine130(RenderEngine):
         glVertexAttribPointer(self._color_attrib_loc, 3, GL_FLOAT, GL_FALSE, 0, data)
         printOpenGLError()
 
+    def set_palette_indices_enabled(self, val):
+        if val:
+            glEnableVertexAttribArray(self._palette_idx_attrib_loc)
+        else:
+            glDisableVertexAttribArray(self._palette_idx_attrib_loc)
+        glUniform1f(self._use_palette_uniform_loc, 1.0 if val else 0.0)
+        printOpenGLError()
+
+    def set_palette_indices(self, data):
+        glVertexAttribPointer(self._palette_idx_attrib_loc, 1, GL_FLOAT, GL_FALSE, 0, data)
+        printOpenGLError()
+
 
 class RenderEngine120(RenderEngine130):
 
+    @staticmethod
+    def is_supported(caps):
+        return caps.supports_glsl(1, 20)
+
     def get_glsl_version(self):
         return "120"
 
+    def uses_texture_array(self):
+        return False  # GLSL 1.20 drivers don't all have GL_EXT_texture_array, so the atlas is one page
+
     def build_shader(self):
         return Shader(
             '''
@@ -563,10 +1490,14 @@ class RenderEngine120(RenderEngine130):
             attribute vec3 vColor;
             varying vec3 color;
 
+            attribute float vPaletteIdx;
+            varying float paletteIdx;
+
             void main()
             {
                 texCoord = vTexCoord;
                 color = vColor;
+                paletteIdx = vPaletteIdx;
                 gl_Position = proj * modelview * vec4(position.x, position.y, 0.0, 1.0);
             }
             ''',
@@ -574,22 +1505,72 @@ class RenderEngine120(RenderEngine130):
             #version 120
             varying vec2 texCoord;
             varying vec3 color;
+            varying float paletteIdx;
 
-            uniform vec2 texSize;
             uniform sampler2D tex0;
+            uniform sampler2D palette;
+            uniform float usePalette;
 
             void main(void) {
-                vec2 texPos = vec2(texCoord.x / texSize.x, texCoord.y / texSize.y);
-                vec4 tcolor = texture2D(tex0, texPos);
-                for (int i = 0; i < 3; i++) {
-                    if (tcolor[i] >= 0.99) {
-                        gl_FragColor[i] = tcolor[i] * color[i];
-                    } else {
-                        gl_FragColor[i] = tcolor[i] * color[i] * color[i];                    
-                    }
-                }
-                gl_FragColor.w = tcolor.w;
+                // there's only one page, so the y coord needs no decoding (see ImageModel)
+                vec4 tcolor = texture2D(tex0, texCoord);
+
+                vec3 pcolor = texture2D(palette, vec2((floor(paletteIdx + 0.5) + 0.5) / 256.0, 0.5)).rgb;
+                vec3 c = mix(color, pcolor, usePalette);
+
+                // bright channels are multiplied by the color, the rest by its square
+                vec3 tint = mix(c * c, c, step(0.99, tcolor.rgb));
+                gl_FragColor = vec4(tcolor.rgb * tint, tcolor.a);
             }
-            '''
+            ''',
+            binary_cache=self.shader_binary_cache
         )
 
+
+class RenderEngine130VBO(RenderEngine130):
+    """
+        same shaders as RenderEngine130, but vertex attributes are streamed through buffer objects
+        instead of being read from client memory at draw time, which is faster on some drivers.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._attrib_buffer_ids = {}  # attrib loc -> buffer id
+        self.resources.register("attrib buffers", self._attrib_buffer_ids.clear)
+
+    @staticmethod
+    def is_supported(caps):
+        return RenderEngine130.is_supported(caps) and caps.has_buffer_objects()
+
+    def delete_gl_objects(self):
+        super().delete_gl_objects()
+        if len(self._attrib_buffer_ids) > 0:
+            glDeleteBuffers(len(self._attrib_buffer_ids), list(self._attrib_buffer_ids.values()))
+        self._attrib_buffer_ids.clear()
+
+    def _stream_attrib(self, attrib_loc, size, data):
+        if attrib_loc not in self._attrib_buffer_ids:
+            self._attrib_buffer_ids[attrib_loc] = glGenBuffers(1)
+
+        data = numpy.ascontiguousarray(data, dtype=numpy.float32)
+        glBindBuffer(GL_ARRAY_BUFFER, self._attrib_buffer_ids[attrib_loc])
+        glBufferData(GL_ARRAY_BUFFER, data.nbytes, data, GL_STREAM_DRAW)
+        glVertexAttribPointer(attrib_loc, size, GL_FLOAT, GL_FALSE, 0, None)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+        printOpenGLError()
+
+    def set_vertices(self, data):
+        self._stream_attrib(self._position_attrib_loc, 2, data)
+
+    def set_texture_coords(self, data):
+        self._stream_attrib(self._texture_pos_attrib_loc, 2, data)
+
+    def set_colors(self, data):
+        self._stream_attrib(self._color_attrib_loc, 3, data)
+
+    def set_palette_indices(self, data):
+        self._stream_attrib(self._palette_idx_attrib_loc, 1, data)
+
+
+# the backends create_instance can choose between
+RENDER_ENGINE_CLASSES = [RenderEngine130, RenderEngine130VBO, RenderEngine120]
@@ -0,0 +1,192 @@
+from OpenGL.GL import *
+from OpenGL.raw.GL.VERSION.GL_3_3 import glGetQueryObjectui64v as _raw_glGetQueryObjectui64v
+
+import collections
+import ctypes
+import time
+import traceback
+
+
+FRAME = "<frame>"  # the label used for the whole of render_layers
+
+
+class _PendingFrame:
+
+    def __init__(self):
+        self.labels = []       # label of each section, in the order they were rendered
+        self.query_ids = []    # (start, end) timestamp query ids for each section
+
+
+class RenderTimings:
+    """
+        Measures how long each layer takes, on the CPU and on the GPU.
+        CPU times are split into rebuilding (updating the layer's arrays) and rendering (issuing GL calls).
+        GPU times come from timestamp queries placed before and after each section. Their results are read
+        back once they're available, which is usually a few frames later, so measuring never stalls the
+        pipeline. Each time is averaged over the last few frames.
+    """
+
+    def __init__(self, use_gpu_queries=True, history=60, max_pending_frames=8):
+        """
+            use_gpu_queries: whether to measure GPU times (needs GL 3.3 or GL_ARB_timer_query).
+            history: the number of frames to average over.
+            max_pending_frames: if the GPU falls this far behind, the oldest queries are thrown away.
+        """
+        self.use_gpu_queries = use_gpu_queries
+        self.history = history
+        self.max_pending_frames = max_pending_frames
+
+        self._cpu_rebuild_times = {}  # label -> deque of seconds
+        self._cpu_render_times = {}
+        self._gpu_times = {}
+        self._ordered_labels = []
+
+        self._query_pool = []
+        self._all_query_ids = []
+        self._pending_frames = collections.deque()
+        self._current_frame = None
+
+        self._frame_start_time = None
+        self._frame_rebuild_time = 0
+        self._section_start_time = None
+        self._query_result = ctypes.c_uint64(0)
+
+    def begin_frame(self):
+        self._collect_gpu_results()
+        self._frame_start_time = time.perf_counter()
+        self._frame_rebuild_time = 0
+        if self.use_gpu_queries:
+            self._current_frame = _PendingFrame()
+            self._begin_gpu_section(FRAME)
+
+    def add_rebuild_time(self, label, seconds):
+        """should be called every frame for every layer, with 0 if it didn't need rebuilding."""
+        self._record(self._cpu_rebuild_times, label, seconds)
+        self._frame_rebuild_time += seconds
+
+    def begin_section(self, label):
+        self._section_start_time = time.perf_counter()
+        if self.use_gpu_queries:
+            self._begin_gpu_section(label)
+
+    def end_section(self, label):
+        self._record(self._cpu_render_times, label, time.perf_counter() - self._section_start_time)
+        if self.use_gpu_queries:
+            self._end_gpu_section()
+
+    def end_frame(self):
+        self._record(self._cpu_render_times, FRAME, time.perf_counter() - self._frame_start_time)
+        self._record(self._cpu_rebuild_times, FRAME, self._frame_rebuild_time)
+        if self.use_gpu_queries:
+            self._current_frame.query_ids[0] = (self._current_frame.query_ids[0][0], self._next_query_id())
+            glQueryCounter(self._current_frame.query_ids[0][1], GL_TIMESTAMP)
+
+            self._pending_frames.append(self._current_frame)
+            self._current_frame = None
+            while len(self._pending_frames) > self.max_pending_frames:
+                self._release_queries(self._pending_frames.popleft())
+
+    def on_context_lost(self):
+        """the queries are gone, any results that haven't been collected yet are lost too."""
+        self._query_pool = []
+        self._all_query_ids = []
+        self._pending_frames.clear()
+        self._current_frame = None
+
+    def delete_gl_objects(self):
+        if len(self._all_query_ids) > 0:
+            glDeleteQueries(len(self._all_query_ids), self._all_query_ids)
+        self.on_context_lost()
+
+    def get_cpu_rebuild_time(self, label=FRAME):
+        """returns: the average time per frame in seconds, or None if it hasn't been measured."""
+        return self._average(self._cpu_rebuild_times, label)
+
+    def get_cpu_render_time(self, label=FRAME):
+        """for FRAME, this is the whole of render_layers (so it includes the rebuilds)."""
+        return self._average(self._cpu_render_times, label)
+
+    def get_gpu_time(self, label=FRAME):
+        return self._average(self._gpu_times, label)
+
+    def get_labels(self):
+        """returns: the labels that have been measured, in the order they were rendered."""
+        return list(self._ordered_labels)
+
+    def get_summary(self):
+        """returns: label -> {"cpu_rebuild": secs, "cpu_render": secs, "gpu": secs}, with None for unknown values."""
+        return {label: {"cpu_rebuild": self.get_cpu_rebuild_time(label),
+                        "cpu_render": self.get_cpu_render_time(label),
+                        "gpu": self.get_gpu_time(label)} for label in [FRAME] + self.get_labels()}
+
+    def dump(self):
+        """prints the summary as a table, in milliseconds."""
+        def _ms(val):
+            return "{:>9}".format("-" if val is None else "{:.3f}".format(val * 1000))
+
+        summary = self.get_summary()
+        label_width = max(len(label) for label in summary)
+        print("INFO: render timings (ms, averaged over {} frames):".format(self.history))
+        print("INFO:   {}  {:>9}  {:>9}  {:>9}".format("layer".ljust(label_width), "rebuild", "render", "gpu"))
+        for label in summary:
+            times = summary[label]
+            print("INFO:   {}  {}  {}  {}".format(label.ljust(label_width), _ms(times["cpu_rebuild"]),
+                                                  _ms(times["cpu_render"]), _ms(times["gpu"])))
+
+    def _record(self, table, label, seconds):
+        if label not in table:
+            table[label] = collections.deque(maxlen=self.history)
+            if label != FRAME and label not in self._ordered_labels:
+                self._ordered_labels.append(label)
+        table[label].append(seconds)
+
+    def _average(self, table, label):
+        if label not in table or len(table[label]) == 0:
+            return None
+        return sum(table[label]) / len(table[label])
+
+    def _next_query_id(self):
+        if len(self._query_pool) == 0:
+            new_ids = [int(query_id) for query_id in glGenQueries(16)]
+            self._all_query_ids.extend(new_ids)
+            self._query_pool.extend(new_ids)
+        return self._query_pool.pop()
+
+    def _begin_gpu_section(self, label):
+        query_id = self._next_query_id()
+        glQueryCounter(query_id, GL_TIMESTAMP)
+        self._current_frame.labels.append(label)
+        self._current_frame.query_ids.append((query_id, None))
+
+    def _end_gpu_section(self):
+        query_id = self._next_query_id()
+        glQueryCounter(query_id, GL_TIMESTAMP)
+        start_id = self._current_frame.query_ids[-1][0]
+        self._current_frame.query_ids[-1] = (start_id, query_id)
+
+    def _collect_gpu_results(self):
+        while len(self._pending_frames) > 0:
+            frame = self._pending_frames[0]
+            last_query_id = frame.query_ids[0][1]  # the frame's end is the last timestamp written
+            if not glGetQueryObjectiv(last_query_id, GL_QUERY_RESULT_AVAILABLE):
+                return
+            self._pending_frames.popleft()
+            try:
+                for label, (start_id, end_id) in zip(frame.labels, frame.query_ids):
+                    elapsed = self._get_query_result(end_id) - self._get_query_result(start_id)
+                    self._record(self._gpu_times, label, elapsed / 1e9)
+            except Exception:
+                print("WARN: failed to read timer queries")
+                traceback.print_exc()
+            self._release_queries(frame)
+
+    def _get_query_result(self, query_id):
+        # PyOpenGL's wrapper for this can't allocate its output array, so it's called directly
+        _raw_glGetQueryObjectui64v(query_id, GL_QUERY_RESULT, ctypes.byref(self._query_result))
+        return self._query_result.value
+
+    def _release_queries(self, frame):
+        for start_id, end_id in frame.query_ids:
+            self._query_pool.append(start_id)
+            if end_id is not None:
+                self._query_pool.append(end_id)
@@ -1,27 +1,95 @@
 import pygame
 
+import heapq
 import math
+import numpy
+import threading
 
-from src.utils.util import Utils
+from src.utils.util import Utils, LRUCache
 
 
-UNIQUE_ID_CTR = 0
+class IdAllocator:
+    """
+        Hands out integer ids, starting from 0. Freed ids are reused (lowest first), so the ids in use stay
+        dense and can be used as array indices. It's threadsafe.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()  # reentrant, since ids can be freed by the garbage collector (see _UniqueId)
+        self._next_id = 0
+        self._free_heap = []
+        self._free_set = set()
+
+    def allocate(self):
+        with self._lock:
+            if len(self._free_heap) > 0:
+                uid = heapq.heappop(self._free_heap)
+                self._free_set.remove(uid)
+                return uid
+            self._next_id += 1
+            return self._next_id - 1
+
+    def free(self, uid):
+        """does nothing if the id is already free."""
+        with self._lock:
+            if 0 <= uid < self._next_id and uid not in self._free_set:
+                self._free_set.add(uid)
+                heapq.heappush(self._free_heap, uid)
+
+    def capacity(self):
+        """returns: one more than the largest id that's been handed out."""
+        return self._next_id
+
+    def num_allocated(self):
+        with self._lock:
+            return self._next_id - len(self._free_set)
+
+
+_ID_ALLOCATOR = IdAllocator()
+
+
+class _UniqueId(int):
+    """
+        A sprite id. A sprite's copies (see ImageSprite.update) all share the same _UniqueId, and the id
+        is only freed once none of them are left. So a removed sprite can be re-added for as long as it exists.
+    """
+
+    __slots__ = ()
+
+    def __del__(self):
+        _ID_ALLOCATOR.free(int(self))
 
 
 def gen_unique_id():
-    """Note: this ain't threadsafe"""
-    global UNIQUE_ID_CTR
-    UNIQUE_ID_CTR += 1
-    return UNIQUE_ID_CTR - 1
+    return _UniqueId(_ID_ALLOCATOR.allocate())
+
+
+def get_id_capacity():
+    return _ID_ALLOCATOR.capacity()
+
+
+def resolve_color(color):
+    """
+        color: an (r, g, b) tuple, or an int index into the render engine's palette.
+        returns: the (r, g, b) value of the color.
+    """
+    if isinstance(color, int):
+        import src.engine.renderengine as renderengine  # (-_-)
+        return renderengine.get_instance().get_palette().get_color(color)
+    else:
+        return color
 
 
 class SpriteTypes:
     IMAGE = "IMAGE"
     TRIANGLE = "TRIANGLE"
+    TEXT = "TEXT"
 
 
 class _Sprite:
 
+    __slots__ = ("_sprite_type", "_layer_id", "_uid")
+
     def __init__(self, sprite_type, layer_id, uid=None):
         self._sprite_type = sprite_type
         self._layer_id = layer_id
@@ -39,6 +107,14 @@ class _Sprite:
     def is_parent(self):
         return False
 
+    def is_handle(self):
+        """whether the sprite is mutable (see ImageSpriteHandle)."""
+        return False
+
+    def num_primitives(self):
+        """the number of quads (or triangles, in polygon layers) the sprite takes up in its layer."""
+        return 1
+
     def all_sprites(self):
         yield
 
@@ -48,13 +124,10 @@ class _Sprite:
 
 class TriangleSprite(_Sprite):
 
+    __slots__ = ("_p1", "_p2", "_p3", "_color", "_depth")
+
     def __init__(self, layer_id, p1=(0, 0), p2=(0, 0), p3=(0, 0), color=(1, 1, 1), depth=1, uid=None):
         _Sprite.__init__(self, SpriteTypes.TRIANGLE, layer_id, uid=uid)
-
-        # (._.)
-        import src.engine.spritesheets as spritesheets
-        self._model = spritesheets.get_instance().get_sheet(spritesheets.WhiteSquare.SHEET_ID).white_box
-
         self._p1 = p1
         self._p2 = p2
         self._p3 = p3
@@ -93,7 +166,7 @@ class TriangleSprite(_Sprite):
                 depth == self._depth):
             return self
         else:
-            return TriangleSprite(self.layer_id(), color=color, depth=depth, p1=p1, p2=p2, p3=p3, uid=self.uid())
+            return TriangleSprite(self._layer_id, p1, p2, p3, color, depth, self._uid)
 
     def add_urself(self, i, vertices, texts, colors, indices):
         p1 = self.p1()
@@ -108,15 +181,13 @@ class TriangleSprite(_Sprite):
         vertices[i * 6 + 5] = p3[1]
 
         if colors is not None:
-            rgb = self.color()
+            rgb = resolve_color(self.color())
             for j in range(0, 9):
                 colors[i * 9 + j] = rgb[j % 3]
 
-        model = self._model
+        model = _WHITE_BOX
         if model is not None:
-            for j in range(0, 3):
-                texts[i * 6 + j * 2] = (model.tx1 + model.tx2) // 2
-                texts[i * 6 + j * 2 + 1] = (model.ty1 + model.ty2) // 2
+            texts[i * 6:(i + 1) * 6] = model.tex_center * 3
 
         indices[3 * i + 0] = 3 * i
         indices[3 * i + 1] = 3 * i + 1
@@ -125,10 +196,70 @@ class TriangleSprite(_Sprite):
     def __repr__(self):
         return "TriangleSprite({}, {}, {}, {}, {})".format(
              self.points(), self.layer_id(), self.color(), self.depth(), self.uid())
+
+
+class TriangleSpriteHandle(TriangleSprite):
+    """
+        A mutable TriangleSprite (see ImageSpriteHandle).
+    """
+
+    __slots__ = ("_layer",)
+
+    def __init__(self, layer_id, p1=(0, 0), p2=(0, 0), p3=(0, 0), color=(1, 1, 1), depth=1, uid=None):
+        TriangleSprite.__init__(self, layer_id, p1, p2, p3, color, depth, uid)
+        self._layer = None
+
+    def is_handle(self):
+        return True
+
+    def attach(self, layer):
+        self._layer = layer
+
+    def set_points(self, p1, p2, p3):
+        self.set_p1(p1)
+        self.set_p2(p2)
+        self.set_p3(p3)
+
+    def set_p1(self, p1):
+        _set_handle_field(self, "_p1", p1)
+
+    def set_p2(self, p2):
+        _set_handle_field(self, "_p2", p2)
+
+    def set_p3(self, p3):
+        _set_handle_field(self, "_p3", p3)
+
+    def set_color(self, color):
+        _set_handle_field(self, "_color", color)
+
+    def set_depth(self, depth):
+        _set_handle_field(self, "_depth", depth)
+
+    def update(self, new_points=None, new_p1=None, new_p2=None, new_p3=None, new_color=None, new_depth=None):
+        """changes the sprite in place. returns: the handle itself."""
+        if new_points is not None:
+            self.set_points(*new_points)
+        if new_p1 is not None:
+            self.set_p1(new_p1)
+        if new_p2 is not None:
+            self.set_p2(new_p2)
+        if new_p3 is not None:
+            self.set_p3(new_p3)
+        if new_color is not None:
+            self.set_color(new_color)
+        if new_depth is not None:
+            self.set_depth(new_depth)
+        return self
+
+    def __repr__(self):
+        return "TriangleSpriteHandle({}, {}, {}, {}, {})".format(
+             self.points(), self.layer_id(), self.color(), self.depth(), self.uid())
     
 
 class ImageSprite(_Sprite):
 
+    __slots__ = ("_model", "_x", "_y", "_scale", "_depth", "_xflip", "_rotation", "_color", "_ratio")
+
     @staticmethod
     def new_sprite(layer_id, scale=1, depth=0):
         return ImageSprite(None, 0, 0, layer_id, scale=scale, depth=depth)
@@ -148,34 +279,32 @@ class ImageSprite(_Sprite):
     def update(self, new_model=None, new_x=None, new_y=None, new_scale=None, new_depth=None,
                new_xflip=None, new_color=None, new_rotation=None, new_ratio=None):
 
-        if isinstance(new_model, bool) and new_model is False:
+        if new_model is False:
             model = None
         else:
-            model = self.model() if new_model is None else new_model
-
-        x = self.x() if new_x is None else new_x
-        y = self.y() if new_y is None else new_y
-        scale = self.scale() if new_scale is None else new_scale
-        depth = self.depth() if new_depth is None else new_depth
-        xflip = self.xflip() if new_xflip is None else new_xflip
-        color = self.color() if new_color is None else new_color
-        rotation = self.rotation() if new_rotation is None else new_rotation
-        ratio = self.ratio() if new_ratio is None else new_ratio
-        
-        if (model == self.model() and 
-                x == self.x() and 
-                y == self.y() and
-                scale == self.scale() and
-                depth == self.depth() and 
-                xflip == self.xflip() and
-                color == self.color() and
-                ratio == self.ratio() and
-                rotation == self.rotation()):
+            model = self._model if new_model is None else new_model
+
+        x = self._x if new_x is None else new_x
+        y = self._y if new_y is None else new_y
+        scale = self._scale if new_scale is None else new_scale
+        depth = self._depth if new_depth is None else new_depth
+        xflip = self._xflip if new_xflip is None else new_xflip
+        color = self._color if new_color is None else new_color
+        rotation = self._rotation if new_rotation is None else new_rotation
+        ratio = self._ratio if new_ratio is None else new_ratio
+
+        if (model is self._model and
+                x == self._x and
+                y == self._y and
+                scale == self._scale and
+                depth == self._depth and
+                xflip == self._xflip and
+                color == self._color and
+                ratio == self._ratio and
+                rotation == self._rotation):
             return self
         else:
-            res = ImageSprite(model, x, y, self.layer_id(), scale=scale, depth=depth, xflip=xflip, rotation=rotation,
-                              color=color, ratio=ratio, uid=self.uid())
-            return res
+            return ImageSprite(model, x, y, self._layer_id, scale, depth, xflip, rotation, color, ratio, self._uid)
         
     def model(self):
         return self._model
@@ -254,29 +383,18 @@ class ImageSprite(_Sprite):
         vertices[i*8 + 7] = y
 
         if colors is not None:
-            rgb = self.color()
+            rgb = resolve_color(self.color())
             for j in range(0, 12):
                 colors[i * 12 + j] = rgb[j % 3]
 
         if model is not None:
-            corners = [
-                model.tx1, model.ty2,
-                model.tx1, model.ty1,
-                model.tx2, model.ty1,
-                model.tx2, model.ty2
-            ]
-
-            if self.xflip():
-                corners[0] = model.tx2
-                corners[2] = model.tx2
-                corners[4] = model.tx1
-                corners[6] = model.tx1
+            corners = model.tex_corners_xflipped if self.xflip() else model.tex_corners
 
-            for _ in range(0, self.rotation()):
-                corners = corners[2:] + corners[:2]
+            rotation = self.rotation() % 4
+            if rotation != 0:
+                corners = corners[2 * rotation:] + corners[:2 * rotation]
 
-            for j in range(0, 8):
-                texts[i * 8 + j] = corners[j]
+            texts[i * 8:(i + 1) * 8] = corners
 
         indices[6 * i + 0] = 4 * i
         indices[6 * i + 1] = 4 * i + 1
@@ -285,18 +403,220 @@ class ImageSprite(_Sprite):
         indices[6 * i + 4] = 4 * i + 2
         indices[6 * i + 5] = 4 * i + 3
 
+    @staticmethod
+    def add_all(image_sprites, vertices, texts, colors, indices):
+        """
+            writes the sprites to the start of the arrays, the same as calling add_urself on each of them in order.
+            but their models are looked up in the ModelTable all at once, and the quads are built with numpy.
+        """
+        n = len(image_sprites)
+        if n == 0:
+            return
+
+        fields = numpy.array([(-1 if spr._model is None else spr._model.model_id, spr._x, spr._y, spr._scale,
+                               spr._ratio[0], spr._ratio[1], spr._xflip, spr._rotation) for spr in image_sprites],
+                             dtype=float)
+        model_ids = fields[:, 0].astype(numpy.intp)
+        has_model = model_ids >= 0
+        rows = _MODEL_TABLE.get_table()[numpy.where(has_model, model_ids, 0)]
+
+        x = fields[:, 1]
+        y = fields[:, 2]
+        w = numpy.where(has_model, rows[:, ModelTable.W] * fields[:, 3] * fields[:, 4], 0)
+        h = numpy.where(has_model, rows[:, ModelTable.H] * fields[:, 3] * fields[:, 5], 0)
+
+        rotation = fields[:, 7].astype(numpy.intp)
+        is_sideways = (rotation == 1) | (rotation == 3)
+        w, h = numpy.where(is_sideways, h, w), numpy.where(is_sideways, w, h)
+
+        vertices[:n * 8] = numpy.stack([x, y, x, y + h, x + w, y + h, x + w, y], axis=1).ravel()
+
+        if colors is not None:
+            rgb = numpy.array([resolve_color(spr._color) for spr in image_sprites], dtype=float)
+            colors[:n * 12] = numpy.tile(rgb, 4).ravel()
+
+        xflip = fields[:, 6] != 0
+        left = numpy.where(xflip, rows[:, ModelTable.TX2], rows[:, ModelTable.TX1])
+        right = numpy.where(xflip, rows[:, ModelTable.TX1], rows[:, ModelTable.TX2])
+        ty1 = rows[:, ModelTable.TY1]
+        ty2 = rows[:, ModelTable.TY2]
+        corners = numpy.stack([left, ty2, left, ty1, right, ty1, right, ty2], axis=1).reshape((n, 4, 2))
+
+        rotation %= 4
+        if numpy.any(rotation != 0):
+            corner_idxs = (numpy.arange(4)[None, :] + rotation[:, None]) % 4
+            corners = corners[numpy.arange(n)[:, None], corner_idxs]
+
+        texts[:n * 8] = numpy.where(has_model[:, None], corners.reshape((n, 8)), 0).ravel()
+
+        quad = numpy.array([0, 1, 2, 0, 2, 3])
+        indices[:n * 6] = (numpy.arange(n)[:, None] * 4 + quad).ravel()
+
     def __repr__(self):
         return "ImageSprite({}, {}, {}, {}, {}, {}, {}, {}, {}. {})".format(
                 self.model(), self.x(), self.y(), self.layer_id(),
                 self.scale(), self.depth(), self.xflip(), self.color(), self.ratio(), self.uid())
 
 
+class ImageSpriteHandle(ImageSprite):
+    """
+        A mutable ImageSprite. Once it's been added to the render engine, its setters change it in place and
+        mark it dirty in its layer, which rewrites just its part of the layer's arrays on the next render
+        (instead of rebuilding the whole layer). There's no need to re-add it to the engine after changing it.
+
+        update() also changes it in place and returns the handle itself, so code written for ImageSprites
+        (e.g. spr = spr.update(new_x=5); engine.update(spr)) works with handles too.
+    """
+
+    __slots__ = ("_layer",)
+
+    def __init__(self, model, x, y, layer_id, scale=1, depth=1, xflip=False, rotation=0, color=(1, 1, 1), ratio=(1, 1), uid=None):
+        ImageSprite.__init__(self, model, x, y, layer_id, scale, depth, xflip, rotation, color, ratio, uid)
+        self._layer = None
+
+    def is_handle(self):
+        return True
+
+    def attach(self, layer):
+        """called by the render engine when the sprite is added to (or removed from) a layer."""
+        self._layer = layer
+
+    def set_model(self, model):
+        _set_handle_field(self, "_model", model)
+
+    def set_x(self, x):
+        _set_handle_field(self, "_x", x)
+
+    def set_y(self, y):
+        _set_handle_field(self, "_y", y)
+
+    def set_xy(self, x, y):
+        self.set_x(x)
+        self.set_y(y)
+
+    def set_scale(self, scale):
+        _set_handle_field(self, "_scale", scale)
+
+    def set_depth(self, depth):
+        _set_handle_field(self, "_depth", depth)
+
+    def set_xflip(self, xflip):
+        _set_handle_field(self, "_xflip", xflip)
+
+    def set_rotation(self, rotation):
+        _set_handle_field(self, "_rotation", rotation)
+
+    def set_color(self, color):
+        _set_handle_field(self, "_color", color)
+
+    def set_ratio(self, ratio):
+        _set_handle_field(self, "_ratio", ratio)
+
+    def update(self, new_model=None, new_x=None, new_y=None, new_scale=None, new_depth=None,
+               new_xflip=None, new_color=None, new_rotation=None, new_ratio=None):
+        """changes the sprite in place. returns: the handle itself."""
+        if new_model is not None:
+            self.set_model(None if new_model is False else new_model)
+        if new_x is not None:
+            self.set_x(new_x)
+        if new_y is not None:
+            self.set_y(new_y)
+        if new_scale is not None:
+            self.set_scale(new_scale)
+        if new_depth is not None:
+            self.set_depth(new_depth)
+        if new_xflip is not None:
+            self.set_xflip(new_xflip)
+        if new_color is not None:
+            self.set_color(new_color)
+        if new_rotation is not None:
+            self.set_rotation(new_rotation)
+        if new_ratio is not None:
+            self.set_ratio(new_ratio)
+        return self
+
+    def __repr__(self):
+        return "ImageSpriteHandle({}, {}, {}, {}, {}, {}, {}, {}, {}. {})".format(
+                self.model(), self.x(), self.y(), self.layer_id(),
+                self.scale(), self.depth(), self.xflip(), self.color(), self.ratio(), self.uid())
+
+
+def _set_handle_field(handle, field, value):
+    if getattr(handle, field) != value:
+        setattr(handle, field, value)
+        if handle._layer is not None:
+            handle._layer.mark_dirty(handle._uid)
+
+
 _CURRENT_ATLAS_SIZE = None  # XXX this is a mega hack, just look away please
+_CURRENT_ATLAS_PAGE = 0
+
+_WHITE_BOX = None  # the solid white model that triangles are drawn with, set by the WhiteSquare sheet
+
+
+class ModelTable:
+    """
+        The texture coords and size of every ImageModel, in one numpy array indexed by model id. This lets
+        layers look up the models of many sprites at once (with fancy indexing) instead of one at a time.
+        Models add themselves when they're created. Their rows are never changed, since models are immutable.
+    """
+
+    TX1, TY1, TX2, TY2, W, H = range(0, 6)
+
+    def __init__(self, initial_capacity=256):
+        self._ids = IdAllocator()
+        self._lock = threading.Lock()
+        self._table = numpy.zeros((initial_capacity, 6), dtype=float)
+        self._recorded_ids = None
+
+    def add(self, model):
+        """returns: the model's id."""
+        model_id = self._ids.allocate()
+        if self._recorded_ids is not None:
+            self._recorded_ids.append(model_id)
+        with self._lock:
+            if model_id >= len(self._table):
+                new_table = numpy.zeros((max(model_id + 1, 2 * len(self._table)), 6), dtype=float)
+                new_table[:len(self._table)] = self._table
+                self._table = new_table
+            self._table[model_id] = (model.tx1, model.ty1, model.tx2, model.ty2, model.w, model.h)
+        return model_id
+
+    def free(self, model_id):
+        """lets the id be reused by a new model. sprites shouldn't use the old model after this."""
+        self._ids.free(model_id)
+
+    def start_recording(self):
+        """starts remembering the ids of new models, e.g. so everything a sprite atlas creates can be freed at once."""
+        self._recorded_ids = []
+
+    def stop_recording(self):
+        """returns: the ids of the models created since start_recording."""
+        res = self._recorded_ids if self._recorded_ids is not None else []
+        self._recorded_ids = None
+        return res
+
+    def get_table(self):
+        """returns: array of (tx1, ty1, tx2, ty2, w, h) rows. it's replaced (not resized) when it grows."""
+        return self._table
+
+    def __len__(self):
+        return self._ids.num_allocated()
+
+
+_MODEL_TABLE = ModelTable()
+
+
+def get_model_table():
+    return _MODEL_TABLE
 
 
 class ImageModel:
 
-    def __init__(self, x, y, w, h, offset=(0, 0), texture_size=None):
+    __slots__ = ("x", "y", "w", "h", "_rect", "page", "tx1", "ty1", "tx2", "ty2",
+                 "tex_corners", "tex_corners_xflipped", "tex_center", "model_id")
+
+    def __init__(self, x, y, w, h, offset=(0, 0), texture_size=None, page=None):
         # sheet coords, origin top left corner
         self.x = x + offset[0]
         self.y = y + offset[1]
@@ -308,11 +628,29 @@ class ImageModel:
         if tex_size is None:
             raise ValueError("can't construct an ImageModel without a texture size")
 
-        # texture coords, origin bottom left corner
-        self.tx1 = self.x
-        self.ty1 = tex_size[1] - (self.y + self.h)
-        self.tx2 = self.x + self.w
-        self.ty2 = tex_size[1] - self.y
+        # which page of the atlas it's on
+        self.page = page if page is not None else _CURRENT_ATLAS_PAGE
+
+        # normalized texture coords, origin bottom left corner. the page is encoded in the y coord (each
+        # page is 2 units apart, so that no point in the model is on a page boundary), which lets the
+        # shader pick the page without an extra vertex attribute.
+        tex_w, tex_h = tex_size
+        page_y = self.page * 2
+        self.tx1 = self.x / tex_w
+        self.ty1 = page_y + (tex_h - (self.y + self.h)) / tex_h
+        self.tx2 = (self.x + self.w) / tex_w
+        self.ty2 = page_y + (tex_h - self.y) / tex_h
+
+        # the coords of each corner, in the order sprites put their vertices in
+        self.tex_corners = (self.tx1, self.ty2, self.tx1, self.ty1, self.tx2, self.ty1, self.tx2, self.ty2)
+        self.tex_corners_xflipped = (self.tx2, self.ty2, self.tx2, self.ty1, self.tx1, self.ty1, self.tx1, self.ty2)
+
+        # the texel at the model's center, for sprites that only sample a single point
+        self.tex_center = ((self.x + self.w // 2) / tex_w,
+                           page_y + (tex_h - (self.y + self.h) + self.h // 2) / tex_h)
+
+        # index of the model's row in the ModelTable
+        self.model_id = _MODEL_TABLE.add(self)
         
     def rect(self):
         return self._rect
@@ -327,19 +665,45 @@ class ImageModel:
         return self.h
         
     def __repr__(self):
-        return "ImageModel({}, {}, {}, {})".format(self.x, self.y, self.w, self.h)
+        return "ImageModel({}, {}, {}, {}, page={})".format(self.x, self.y, self.w, self.h, self.page)
 
 
 class MultiSprite(_Sprite):
 
+    NO_ID = -1
+
     def __init__(self, sprite_type, layer_id):
-        _Sprite.__init__(self, sprite_type, layer_id)
+        # parents are never stored in the render engine (their children are), so they don't need an id
+        _Sprite.__init__(self, sprite_type, layer_id, uid=MultiSprite.NO_ID)
+
+        self._children = []
+        self._version = None  # bumped whenever the children change, see _set_children
 
     def is_parent(self):
         return True
 
     def all_sprites(self):
-        raise NotImplementedError()
+        return iter(self._children)
+
+    def get_version(self):
+        """
+            returns: a number that changes whenever the children do, so the render engine can skip
+                     republishing an unchanged group. None if the subclass doesn't use _set_children.
+        """
+        return self._version
+
+    def _set_children(self, children):
+        """subclasses should call this whenever their sprites change. Nones are skipped and parents are flattened."""
+        flat_children = []
+        for child in children:
+            if child is None:
+                continue
+            elif child.is_parent():
+                flat_children.extend(child.all_sprites())
+            else:
+                flat_children.append(child)
+        self._children = flat_children
+        self._version = 0 if self._version is None else self._version + 1
 
     def __repr__(self):
         return type(self).__name__ + "({}, {})".format(self.sprite_type(), self.layer_id())
@@ -360,10 +724,6 @@ class LineSprite(MultiSprite):
         self._triangle2 = TriangleSprite(self.layer_id())
         self._update_triangles()
 
-    def all_sprites(self):
-        yield self._triangle1
-        yield self._triangle2
-
     def p1(self):
         return self._p1
 
@@ -432,18 +792,209 @@ class LineSprite(MultiSprite):
             self._triangle1 = self._triangle1.update(new_points=(r1, r2, r4), new_color=color, new_depth=self.depth())
             self._triangle2 = self._triangle2.update(new_points=(r3, r4, r2), new_color=color, new_depth=self.depth())
 
+        self._set_children((self._triangle1, self._triangle2))
+
     def __repr__(self):
         return type(self).__name__ + "({}, {})".format(self.p1(), self.p2())
 
 
+class LineBatch(_Sprite):
+    """
+        Many lines as a single sprite, for use in PolygonLayers. Each line is two triangles (like a LineSprite),
+        but all their corners are calculated in one numpy pass, and only when the lines themselves change.
+        When joined is True, consecutive lines that share an endpoint are mitered together so there's no gap
+        between them (see LineBatch.polyline).
+    """
+
+    MITER_LIMIT = 4  # joints sharper than this (as a multiple of the line's half-thickness) are left unjoined
+
+    def __init__(self, layer_id, p1s=(), p2s=(), thickness=1, color=(1, 1, 1), depth=1, joined=False,
+                 uid=None, geometry=None, rgb=None):
+        """
+            p1s, p2s: arrays (or sequences) of the lines' start and end points, with shape (n, 2).
+            thickness: the lines' thickness, or an array with one per line.
+            color: an (r, g, b) tuple or palette index for all the lines, or a sequence of (r, g, b) tuples
+                   (or an (n, 3) array) with one per line.
+        """
+        _Sprite.__init__(self, SpriteTypes.TRIANGLE, layer_id, uid=uid)
+        self._p1s = numpy.asarray(p1s, dtype=float).reshape((-1, 2))
+        self._p2s = numpy.asarray(p2s, dtype=float).reshape((-1, 2))
+        if len(self._p1s) != len(self._p2s):
+            raise ValueError("mismatched number of endpoints: {} and {}".format(len(self._p1s), len(self._p2s)))
+        self._thickness = thickness
+        self._color = color
+        self._depth = depth
+        self._joined = joined
+
+        # calculated lazily, and kept by updates that don't change them
+        self._geometry = geometry  # triangle vertices, shape (n, 12)
+        self._rgb = rgb            # vertex colors, shape (n, 18)
+
+    @staticmethod
+    def polyline(layer_id, points, thickness=1, color=(1, 1, 1), depth=1, closed=False, joined=True):
+        """a strip of lines through the given points. if closed, the last point is connected back to the first."""
+        points = numpy.asarray(points, dtype=float).reshape((-1, 2))
+        p1s = points if closed else points[:-1]
+        p2s = numpy.roll(points, -1, axis=0) if closed else points[1:]
+        return LineBatch(layer_id, p1s, p2s, thickness=thickness, color=color, depth=depth, joined=joined)
+
+    def p1s(self):
+        return self._p1s
+
+    def p2s(self):
+        return self._p2s
+
+    def thickness(self):
+        return self._thickness
+
+    def color(self):
+        return self._color
+
+    def depth(self):
+        return self._depth
+
+    def is_joined(self):
+        return self._joined
+
+    def num_lines(self):
+        return len(self._p1s)
+
+    def num_primitives(self):
+        return 2 * len(self._p1s)
+
+    def primitive_colors(self):
+        if self._is_per_line_color():
+            return [tuple(c) for c in numpy.asarray(self._color).tolist() for _ in range(0, 2)]
+        else:
+            return [self._color] * self.num_primitives()
+
+    def update(self, new_p1s=None, new_p2s=None, new_thickness=None, new_color=None, new_depth=None,
+               new_joined=None):
+        """the endpoints aren't compared (they're usually big arrays), passing them always makes a new sprite."""
+        same_geometry = (new_p1s is None and new_p2s is None and
+                         (new_thickness is None or numpy.array_equal(new_thickness, self._thickness)) and
+                         (new_joined is None or new_joined == self._joined))
+        same_color = new_color is None or numpy.array_equal(new_color, self._color)
+        same_depth = new_depth is None or new_depth == self._depth
+
+        if same_geometry and same_color and same_depth:
+            return self
+        else:
+            return LineBatch(self.layer_id(),
+                             self._p1s if new_p1s is None else new_p1s,
+                             self._p2s if new_p2s is None else new_p2s,
+                             thickness=self._thickness if new_thickness is None else new_thickness,
+                             color=self._color if new_color is None else new_color,
+                             depth=self._depth if new_depth is None else new_depth,
+                             joined=self._joined if new_joined is None else new_joined,
+                             uid=self.uid(),
+                             geometry=self._geometry if same_geometry else None,
+                             rgb=self._rgb if same_color else None)
+
+    def _is_per_line_color(self):
+        return not isinstance(self._color, int) and numpy.ndim(self._color) == 2
+
+    def get_geometry(self):
+        if self._geometry is None:
+            self._geometry = self._calc_geometry()
+        return self._geometry
+
+    def _calc_geometry(self):
+        p1s = self._p1s
+        p2s = self._p2s
+        line_vecs = p2s - p1s
+        lengths = numpy.hypot(line_vecs[:, 0], line_vecs[:, 1])
+        dirs = line_vecs / numpy.where(lengths > 0, lengths, 1)[:, None]
+
+        # same rounding as LineSprite, the extra pixel of odd thicknesses goes below the line
+        thickness = numpy.broadcast_to(numpy.asarray(self._thickness, dtype=float), (len(p1s),))
+        up_lengths = numpy.floor(thickness / 2)[:, None]
+        down_lengths = numpy.floor(0.5 + thickness / 2)[:, None]
+
+        normals = numpy.stack([-dirs[:, 1], dirs[:, 0]], axis=1)
+        start_normals = normals
+        end_normals = normals
+
+        if self._joined and len(p1s) > 1:
+            # line i is joined to line i + 1 (wrapping around) if it ends where the next one starts
+            next_idxs = numpy.roll(numpy.arange(len(p1s)), -1)
+            is_joint = numpy.all(p2s == p1s[next_idxs], axis=1) & (lengths > 0) & (lengths[next_idxs] > 0)
+            if not numpy.array_equal(p2s[-1], p1s[0]):
+                is_joint[-1] = False
+
+            miters = normals + normals[next_idxs]
+            miter_lengths = numpy.hypot(miters[:, 0], miters[:, 1])
+            miters = miters / numpy.where(miter_lengths > 0, miter_lengths, 1)[:, None]
+
+            # scaled so the joined edges stay the line's thickness apart
+            cos_half_angle = numpy.sum(miters * normals, axis=1)
+            is_joint &= cos_half_angle > 1 / LineBatch.MITER_LIMIT
+            miters = miters / numpy.where(is_joint, cos_half_angle, 1)[:, None]
+
+            end_normals = numpy.where(is_joint[:, None], miters, normals)
+            start_normals = normals.copy()
+            start_normals[next_idxs[is_joint]] = miters[is_joint]
+
+        #  r1-------r2
+        #  p1     - p2
+        #  |  -      |
+        #  r4-------r3
+        r1 = p1s + start_normals * up_lengths
+        r2 = p2s + end_normals * up_lengths
+        r3 = p2s - end_normals * down_lengths
+        r4 = p1s - start_normals * down_lengths
+
+        # degenerate lines collapse to a point, like in LineSprite
+        is_point = (lengths == 0)[:, None]
+        r1, r2, r3, r4 = [numpy.where(is_point, p1s, r) for r in (r1, r2, r3, r4)]
+
+        return numpy.concatenate([r1, r2, r4, r3, r4, r2], axis=1)
+
+    def get_rgb(self):
+        if self._rgb is None:
+            if self._is_per_line_color():
+                rgb = numpy.array([resolve_color(c) for c in self._color], dtype=float).reshape((-1, 3))
+            else:
+                rgb = numpy.empty((self.num_lines(), 3), dtype=float)
+                rgb[:] = resolve_color(self._color)
+            self._rgb = numpy.tile(rgb, 6)
+        return self._rgb
+
+    def add_urself(self, i, vertices, texts, colors, indices):
+        """
+            i: the index of the batch's first triangle in the arrays (it takes up two per line).
+        """
+        n_triangles = self.num_primitives()
+        if n_triangles == 0:
+            return
+
+        vertices[i * 6:(i + n_triangles) * 6] = self.get_geometry().ravel()
+
+        if colors is not None:
+            colors[i * 9:(i + n_triangles) * 9] = self.get_rgb().ravel()
+
+        model = _WHITE_BOX
+        if model is not None:
+            texts[i * 6:(i + n_triangles) * 6] = numpy.tile(model.tex_center * 3, n_triangles)
+
+        indices[i * 3:(i + n_triangles) * 3] = numpy.arange(i * 3, (i + n_triangles) * 3)
+
+    def __repr__(self):
+        return type(self).__name__ + "({} lines, {}, {})".format(self.num_lines(), self.layer_id(), self.uid())
+
+
 class TextSprite(MultiSprite):
 
     DEFAULT_X_KERNING = 0
     DEFAULT_Y_KERNING = 0
 
     def __init__(self, layer_id, x, y, text, scale=1.0, depth=0, color=(1, 1, 1), color_lookup=None, font_lookup=None,
-                 x_kerning=DEFAULT_X_KERNING, y_kerning=DEFAULT_Y_KERNING):
-
+                 x_kerning=DEFAULT_X_KERNING, y_kerning=DEFAULT_Y_KERNING, color_spans=None):
+        """
+            color_spans: list of (start, end, color) spans of characters that aren't the base color, e.g. the
+                         spans of a TextBuilder. color_lookup (a dict of index -> color) is the old way of doing
+                         the same thing, and is ignored if color_spans is given.
+        """
         MultiSprite.__init__(self, SpriteTypes.IMAGE, layer_id)
         self._x = x
         self._y = y
@@ -451,7 +1002,7 @@ class TextSprite(MultiSprite):
         self._scale = scale
         self._depth = depth
         self._base_color = color
-        self._color_lookup = color_lookup if color_lookup is not None else {}
+        self._color_spans = _to_color_spans(color_spans, color_lookup)
         self._x_kerning = x_kerning
         self._y_kerning = y_kerning
 
@@ -462,9 +1013,9 @@ class TextSprite(MultiSprite):
             self._font_lookup = spritesheets.get_instance().get_sheet(spritesheets.DefaultFont.SHEET_ID)
 
         # this stuff is calculated by _build_character_sprites
+        self._layout = None
         self._character_sprites = []
         self._bounding_rect = [0, 0, 0, 0]
-        self._unused_sprites = []
 
         self._build_character_sprites()
 
@@ -475,67 +1026,58 @@ class TextSprite(MultiSprite):
         return (self._bounding_rect[2], self._bounding_rect[3])
 
     def _build_character_sprites(self):
-        a_character = self._font_lookup.get_char("a")
-        char_size = a_character.size()
-
-        # we're going to reuse these if possible
-        old_sprites = []
-        old_sprites.extend(self._unused_sprites)
-        self._unused_sprites.clear()
+        layout = _get_character_layout(self._text, self._scale, self._base_color, self._color_spans,
+                                       self._font_lookup, self._x_kerning, self._y_kerning)
+        self._layout = layout
 
-        self._character_sprites.reverse()
-        old_sprites.extend(self._character_sprites)
-        self._character_sprites.clear()
+        pool = _get_sprite_pool()
 
-        self._bounding_rect = [self._x, self._y, 0, 0]
-
-        cur_x = self._x
-        cur_y = self._y
+        # we're going to reuse these if possible
+        old_sprites = self._character_sprites
+        old_sprites.reverse()
+        self._character_sprites = []
 
-        for idx in range(0, len(self._text)):
-            character = self._text[idx]
-            if character == "\n":
-                cur_x = self._x
-                cur_y += math.ceil(char_size[1] * self._scale) + self._y_kerning
+        for (char_model, dx, dy, char_color) in layout.chars:
+            if len(old_sprites) > 0:
+                next_sprite = old_sprites.pop()
+            elif pool is not None:
+                next_sprite = pool.acquire(self.layer_id())
             else:
-                char_model = self._font_lookup.get_char(character)
-                if char_model is not None:
-                    if len(old_sprites) > 0:
-                        next_sprite = old_sprites.pop()
-                    else:
-                        next_sprite = ImageSprite.new_sprite(self.layer_id())
+                next_sprite = ImageSprite.new_sprite(self.layer_id())
 
-                    char_color = self._base_color if idx not in self._color_lookup else self._color_lookup[idx]
+            char_sprite = next_sprite.update(new_model=char_model, new_x=self._x + dx, new_y=self._y + dy,
+                                             new_scale=self._scale, new_depth=self._depth,
+                                             new_color=char_color)
+            self._character_sprites.append(char_sprite)
 
-                    char_sprite = next_sprite.update(new_model=char_model, new_x=cur_x, new_y=cur_y,
-                                                     new_scale=self._scale, new_depth=self._depth,
-                                                     new_color=char_color)
+        self._bounding_rect = [self._x, self._y, layout.size[0], layout.size[1]]
 
-                    self._character_sprites.append(char_sprite)
+        # the text got shorter, these are removed from their layer
+        if pool is not None:
+            for spr in old_sprites:
+                pool.release(spr)
 
-                    self._bounding_rect[2] = max(self._bounding_rect[2], char_sprite.x() + char_sprite.width() - self._bounding_rect[0])
-                    self._bounding_rect[3] = max(self._bounding_rect[3], char_sprite.y() + char_sprite.height() - self._bounding_rect[1])
-                    cur_x += char_sprite.width() + self._x_kerning
-                else:
-                    self._bounding_rect[2] = max(self._bounding_rect[2], cur_x + math.ceil(char_size[0] * self._scale) - self._bounding_rect[0])
-                    self._bounding_rect[3] = max(self._bounding_rect[3], cur_y + math.ceil(char_size[1] * self._scale) - self._bounding_rect[1])
-                    cur_x += math.ceil(char_size[0] * self._scale) + self._x_kerning
+        self._set_children(self._character_sprites)
 
-        for spr in old_sprites:
-            spr = spr.update(new_model=False, new_x=self._bounding_rect[0], new_y=self._bounding_rect[1] + 16)
-            self._unused_sprites.append(spr)
+    def _move_character_sprites(self):
+        """moves the characters to the sprite's current position, keeping the same layout."""
+        self._character_sprites = [spr.update(new_x=self._x + dx, new_y=self._y + dy)
+                                   for (spr, (_, dx, dy, _)) in zip(self._character_sprites, self._layout.chars)]
+        self._bounding_rect = [self._x, self._y, self._layout.size[0], self._layout.size[1]]
+        self._set_children(self._character_sprites)
 
     def update(self, new_x=None, new_y=None, new_text=None, new_scale=None, new_depth=None,
                new_color=None, new_color_lookup=None, new_font_lookup=None,
-               new_x_kerning=None, new_y_kerning=None):
+               new_x_kerning=None, new_y_kerning=None, new_color_spans=None):
 
+        did_move = False
         did_change = False
 
         if new_x is not None and new_x != self._x:
-            did_change = True
+            did_move = True
             self._x = new_x
         if new_y is not None and new_y != self._y:
-            did_change = True
+            did_move = True
             self._y = new_y
         if new_text is not None and new_text != self._text:
             did_change = True
@@ -549,9 +1091,11 @@ class TextSprite(MultiSprite):
         if new_color is not None and new_color != self._base_color:
             did_change = True
             self._base_color = new_color
-        if new_color_lookup is not None and new_color_lookup != self._color_lookup:
-            did_change = True
-            self._color_lookup = new_color_lookup
+        if new_color_spans is not None or new_color_lookup is not None:
+            color_spans = _to_color_spans(new_color_spans, new_color_lookup)
+            if color_spans != self._color_spans:
+                did_change = True
+                self._color_spans = color_spans
         if new_font_lookup is not None and new_font_lookup != self._font_lookup:
             did_change = True
             self._font_lookup = new_font_lookup
@@ -564,83 +1108,410 @@ class TextSprite(MultiSprite):
 
         if did_change:
             self._build_character_sprites()
+        elif did_move:
+            self._move_character_sprites()
 
         return self
 
-    def all_sprites(self):
-        for spr in self._character_sprites:
-            yield spr
-        for spr in self._unused_sprites:  # big yikes
-            yield spr
-
     def __repr__(self):
         return type(self).__name__ + "({}, {}, {})".format(self._x, self._y, self._text.replace("\n", "\\n"))
 
     @staticmethod
     def wrap_text_to_fit(text, width, scale=1, font_lookup=None, x_kerning=DEFAULT_X_KERNING):
+        """
+            splits the text into lines that are at most width pixels wide when drawn (words longer than that
+            get a line to themselves). repeated spaces are collapsed. results are cached.
+            returns: list of lines.
+        """
+        metrics = TextMetrics.get(font_lookup, scale=scale, x_kerning=x_kerning)
+        key = (text, width, metrics)
+        res = _WRAPPED_TEXT_CACHE.get(key)
+        if res is None:
+            res = tuple(metrics.iter_wrapped_lines(text, width))
+            _WRAPPED_TEXT_CACHE.put(key, res)
+        return list(res)
+
+    @staticmethod
+    def iter_wrapped_lines(text, width, scale=1, font_lookup=None, x_kerning=DEFAULT_X_KERNING):
+        """same as wrap_text_to_fit, but yields the lines one at a time without caching them (for huge texts)."""
+        return TextMetrics.get(font_lookup, scale=scale, x_kerning=x_kerning).iter_wrapped_lines(text, width)
+
 
+class TextMetrics:
+    """
+        Measures text using a font's real glyph widths. Each line's advances are turned into a prefix-sum
+        table, so the width of any word (or run of words) is a single subtraction.
+    """
+
+    _INSTANCES = {}  # (font_lookup, scale, x_kerning) -> TextMetrics
+
+    @staticmethod
+    def get(font_lookup=None, scale=1, x_kerning=0):
+        """returns: the shared TextMetrics for the font (or the default font if it's None)."""
         if font_lookup is None:
             import src.engine.spritesheets as spritesheets  # (.-.)
             font_lookup = spritesheets.get_instance().get_sheet(spritesheets.DefaultFont.SHEET_ID)
 
-        if "\n" in text:
-            lines = text.split("\n")
-            res = []
-            for line in lines:
-                for subline in TextSprite.wrap_text_to_fit(line, width, scale=scale, font_lookup=font_lookup, x_kerning=x_kerning):
-                    res.append(subline)
-            return res
-        else:
-            # at this point, text contains no newlines
-            res = []
-            letter_width = font_lookup.get_char("a").width() * scale + x_kerning
+        key = (font_lookup, scale, x_kerning)
+        if key not in TextMetrics._INSTANCES:
+            TextMetrics._INSTANCES[key] = TextMetrics(font_lookup, scale=scale, x_kerning=x_kerning)
+        return TextMetrics._INSTANCES[key]
+
+    def __init__(self, font_lookup, scale=1, x_kerning=0):
+        self.font_lookup = font_lookup
+        self.scale = scale
+        self.x_kerning = x_kerning
+
+    def advances(self, text):
+        """returns: array of how far each character moves the cursor (matches TextSprite's layout)."""
+        glyph_table = self.font_lookup.get_glyph_table()
+        return self._advances(glyph_table, glyph_table.glyph_indices(glyph_table.codepoints(text)))
+
+    def _advances(self, glyph_table, glyphs):
+        # characters without a model still take up space
+        missing_w = math.ceil(glyph_table.char_size[0] * self.scale)
+        widths = numpy.where(glyph_table.has_model[glyphs], glyph_table.sizes[glyphs, 0] * self.scale, missing_w)
+        return widths + self.x_kerning
+
+    def measure(self, line):
+        """returns: the width of a single line of text, in pixels."""
+        if len(line) == 0:
+            return 0
+        return float(numpy.sum(self.advances(line))) - self.x_kerning
+
+    def iter_wrapped_lines(self, text, width):
+        """yields the lines of text wrapped to fit in width, one paragraph at a time."""
+        start = 0
+        while start <= len(text):
+            end = text.find("\n", start)
+            if end == -1:
+                end = len(text)
+            yield from self._wrap_paragraph(text[start:end], width)
+            start = end + 1
+
+    def _wrap_paragraph(self, paragraph, width):
+        if len(paragraph) == 0:
+            return
+
+        glyph_table = self.font_lookup.get_glyph_table()
+        codepoints = glyph_table.codepoints(paragraph)
+        advances = self._advances(glyph_table, glyph_table.glyph_indices(codepoints))
+        space_width = float(self._advances(glyph_table, glyph_table.glyph_indices(glyph_table.codepoints(" ")))[0])
+
+        prefix_sums = numpy.zeros(len(paragraph) + 1)
+        numpy.cumsum(advances, out=prefix_sums[1:])
+
+        # find the words, they're the runs of non-space characters
+        is_word = numpy.zeros(len(paragraph) + 2, dtype=numpy.int8)
+        is_word[1:-1] = codepoints != ord(" ")
+        edges = numpy.flatnonzero(numpy.diff(is_word))
+        word_starts = edges[0::2]
+        word_ends = edges[1::2]
+        word_widths = (prefix_sums[word_ends] - prefix_sums[word_starts]).tolist()
+        word_starts = word_starts.tolist()
+        word_ends = word_ends.tolist()
+
+        # if the words are separated by single spaces, lines can be sliced out of the paragraph directly
+        single_spaced = "  " not in paragraph
+
+        def _line(first, last):
+            if single_spaced:
+                return paragraph[word_starts[first]:word_ends[last]]
+            else:
+                return " ".join(paragraph[word_starts[i]:word_ends[i]] for i in range(first, last + 1))
+
+        max_width = width + self.x_kerning  # the widths include the kerning after the last character
+        first_word = 0
+        cur_width = 0
+        for i, word_width in enumerate(word_widths):
+            if i == first_word:
+                cur_width = word_width
+            elif cur_width + space_width + word_width > max_width:
+                yield _line(first_word, i - 1)
+                first_word = i
+                cur_width = word_width
+            else:
+                cur_width += space_width + word_width
+
+        if len(word_widths) > 0:
+            yield _line(first_word, len(word_widths) - 1)
+
+
+_WRAPPED_TEXT_CACHE = LRUCache(128)  # (text, width, TextMetrics) -> tuple of lines
+
+
+def clear_text_caches():
+    """should be called when fonts are redrawn, since the cached layouts refer to their models."""
+    _CHARACTER_LAYOUT_CACHE.clear()
+    _WRAPPED_TEXT_CACHE.clear()
+
+
+def _get_sprite_pool():
+    import src.engine.renderengine as renderengine  # (-_-)
+    engine = renderengine.get_instance()
+    return engine.sprite_pool if engine is not None else None
+
+
+class _CharacterLayout:
+    """where each of a TextSprite's characters goes, relative to its top left corner."""
 
-            words = text.split(" ")  # FYI if you have repeated spaces this will delete them
-            cur_line = []
-            cur_width = 0
+    def __init__(self, text, scale, base_color, color_spans, font_lookup, x_kerning, y_kerning):
+        self.chars = []     # list of (model, dx, dy, color)
+        self.size = (0, 0)
 
-            for w in words:
-                if len(w) == 0:
-                    continue
+        char_size = font_lookup.get_char("a").size()
+        size = [0, 0]
+
+        char_colors = [base_color] * len(text)
+        for (start, end, color) in color_spans:
+            char_colors[start:end] = [color] * (min(end, len(text)) - min(start, len(text)))
+
+        cur_x = 0
+        cur_y = 0
+
+        for idx in range(0, len(text)):
+            character = text[idx]
+            if character == "\n":
+                cur_x = 0
+                cur_y += math.ceil(char_size[1] * scale) + y_kerning
+            else:
+                char_model = font_lookup.get_char(character)
+                if char_model is not None:
+                    self.chars.append((char_model, cur_x, cur_y, char_colors[idx]))
+
+                    char_w = char_model.width() * scale
+                    size[0] = max(size[0], cur_x + char_w)
+                    size[1] = max(size[1], cur_y + char_model.height() * scale)
+                    cur_x += char_w + x_kerning
                 else:
-                    word_width = len(w) * letter_width
-                    if len(cur_line) == 0:
-                        cur_line.append(w)
-                        cur_width = word_width
-                    elif cur_width + letter_width + word_width > width / scale:
-                        # gotta wrap
-                        res.append(" ".join(cur_line))
-                        cur_line.clear()
-                        cur_line.append(w)
-                        cur_width = word_width
-                    else:
-                        cur_line.append(w)
-                        cur_width += letter_width + word_width
-
-            if len(cur_line) > 0:
-                res.append(" ".join(cur_line))
-
-            return res
+                    size[0] = max(size[0], cur_x + math.ceil(char_size[0] * scale))
+                    size[1] = max(size[1], cur_y + math.ceil(char_size[1] * scale))
+                    cur_x += math.ceil(char_size[0] * scale) + x_kerning
+
+        self.size = tuple(size)
+
+
+_CHARACTER_LAYOUT_CACHE = LRUCache(256)  # key -> _CharacterLayout
+
+
+def _get_character_layout(text, scale, base_color, color_spans, font_lookup, x_kerning, y_kerning):
+    key = (text, scale, _color_key(base_color), color_spans, font_lookup, x_kerning, y_kerning)
+
+    layout = _CHARACTER_LAYOUT_CACHE.get(key)
+    if layout is None:
+        layout = _CharacterLayout(text, scale, base_color, color_spans, font_lookup, x_kerning, y_kerning)
+        _CHARACTER_LAYOUT_CACHE.put(key, layout)
+    return layout
+
+
+def _color_key(color):
+    return color if isinstance(color, (int, tuple)) else tuple(color)
+
+
+def _to_color_spans(color_spans, color_lookup):
+    """
+        returns: the spans as a tuple of (start, end, color) tuples (so they can be compared and hashed).
+                 if color_spans is None, they're made from color_lookup (a dict of index -> color) instead.
+    """
+    if color_spans is not None:
+        return tuple((start, end, _color_key(color)) for (start, end, color) in color_spans)
+    elif color_lookup is None or len(color_lookup) == 0:
+        return ()
+
+    spans = []
+    for idx in sorted(color_lookup):
+        color = _color_key(color_lookup[idx])
+        if len(spans) > 0 and spans[-1][1] == idx and spans[-1][2] == color:
+            spans[-1] = (spans[-1][0], idx + 1, color)
+        else:
+            spans.append((idx, idx + 1, color))
+    return tuple(spans)
+
+
+class TextBlockSprite(_Sprite):
+    """
+        A whole block of text as a single sprite, for use in TextLayers. Unlike TextSprite, this doesn't
+        create any per-character sprites, its glyphs are laid out in one numpy pass (and only when the
+        text or its style changes, moving the block reuses the layout).
+    """
+
+    def __init__(self, layer_id, x, y, text, scale=1, depth=0, color=(1, 1, 1), color_lookup=None, font_lookup=None,
+                 x_kerning=TextSprite.DEFAULT_X_KERNING, y_kerning=TextSprite.DEFAULT_Y_KERNING, uid=None, layout=None,
+                 color_spans=None):
+        """
+            color_spans: see TextSprite.
+        """
+        _Sprite.__init__(self, SpriteTypes.TEXT, layer_id, uid=uid)
+        self._x = x
+        self._y = y
+        self._text = text
+        self._scale = scale
+        self._depth = depth
+        self._color = color
+        self._color_spans = _to_color_spans(color_spans, color_lookup)
+        self._x_kerning = x_kerning
+        self._y_kerning = y_kerning
+
+        if font_lookup is not None:
+            self._font_lookup = font_lookup
+        else:
+            import src.engine.spritesheets as spritesheets  # (.-.)
+            self._font_lookup = spritesheets.get_instance().get_sheet(spritesheets.DefaultFont.SHEET_ID)
+
+        self._layout = layout  # calculated lazily, relative to (x, y)
+
+    def x(self):
+        return self._x
+
+    def y(self):
+        return self._y
+
+    def text(self):
+        return self._text
+
+    def scale(self):
+        return self._scale
+
+    def depth(self):
+        return self._depth
+
+    def color(self):
+        return self._color
+
+    def color_spans(self):
+        return self._color_spans
+
+    def get_rect(self):
+        size = self.get_size()
+        return [self._x, self._y, size[0], size[1]]
+
+    def get_size(self):
+        return self.get_layout().size
+
+    def update(self, new_x=None, new_y=None, new_text=None, new_scale=None, new_depth=None,
+               new_color=None, new_color_lookup=None, new_font_lookup=None,
+               new_x_kerning=None, new_y_kerning=None, new_color_spans=None):
+
+        x = self._x if new_x is None else new_x
+        y = self._y if new_y is None else new_y
+        text = self._text if new_text is None else new_text
+        scale = self._scale if new_scale is None else new_scale
+        depth = self._depth if new_depth is None else new_depth
+        color = self._color if new_color is None else new_color
+        if new_color_spans is None and new_color_lookup is None:
+            color_spans = self._color_spans
+        else:
+            color_spans = _to_color_spans(new_color_spans, new_color_lookup)
+        font_lookup = self._font_lookup if new_font_lookup is None else new_font_lookup
+        x_kerning = self._x_kerning if new_x_kerning is None else new_x_kerning
+        y_kerning = self._y_kerning if new_y_kerning is None else new_y_kerning
+
+        same_layout = (text == self._text and
+                       scale == self._scale and
+                       color == self._color and
+                       color_spans == self._color_spans and
+                       font_lookup == self._font_lookup and
+                       x_kerning == self._x_kerning and
+                       y_kerning == self._y_kerning)
+
+        if same_layout and x == self._x and y == self._y and depth == self._depth:
+            return self
+        else:
+            return TextBlockSprite(self.layer_id(), x, y, text, scale=scale, depth=depth, color=color,
+                                   font_lookup=font_lookup, x_kerning=x_kerning, y_kerning=y_kerning, uid=self.uid(),
+                                   layout=self._layout if same_layout else None, color_spans=color_spans)
+
+    def get_layout(self):
+        if self._layout is None:
+            self._layout = _TextLayout(self._text, self._scale, self._color, self._color_spans,
+                                       self._font_lookup.get_glyph_table(), self._x_kerning, self._y_kerning)
+        return self._layout
+
+    def __repr__(self):
+        return type(self).__name__ + "({}, {}, {})".format(self._x, self._y, self._text.replace("\n", "\\n"))
+
+
+class _TextLayout:
+    """the glyph quads of a block of text, relative to its top left corner. matches TextSprite's layout."""
+
+    def __init__(self, text, scale, color, color_spans, glyph_table, x_kerning, y_kerning):
+        codepoints = glyph_table.codepoints(text)
+        glyphs = glyph_table.glyph_indices(codepoints)
+        n = len(glyphs)
+
+        is_newline = codepoints == ord("\n")
+        has_model = glyph_table.has_model[glyphs]
+
+        # characters without a model still take up space
+        char_w, char_h = glyph_table.char_size
+        glyph_w = numpy.where(has_model, glyph_table.sizes[glyphs, 0] * scale, math.ceil(char_w * scale))
+        glyph_h = numpy.where(has_model, glyph_table.sizes[glyphs, 1] * scale, math.ceil(char_h * scale))
+
+        advances = numpy.where(is_newline, 0, glyph_w + x_kerning)
+        x_ends = numpy.cumsum(advances)
+        x_starts = x_ends - advances
+
+        # each line's x values start from wherever the previous line's left off, so subtract that back out
+        line_idxs = numpy.cumsum(is_newline) - is_newline
+        line_starts = numpy.concatenate(([0], numpy.flatnonzero(is_newline) + 1))
+        line_x_starts = numpy.append(x_starts, x_ends[-1] if n > 0 else 0)[line_starts]
+
+        x = x_starts - line_x_starts[line_idxs]
+        y = line_idxs * (math.ceil(char_h * scale) + y_kerning)
+
+        if n > 0 and not numpy.all(is_newline):
+            self.size = (max(0, float((x + glyph_w)[~is_newline].max())),
+                         max(0, float((y + glyph_h)[~is_newline].max())))
+        else:
+            self.size = (0, 0)
+
+        rgb = numpy.empty((n, 3), dtype=float)
+        rgb[:] = resolve_color(color)
+        for (start, end, span_color) in color_spans:
+            rgb[start:end] = resolve_color(span_color)
+
+        visible = ~is_newline & has_model
+        x = x[visible]
+        y = y[visible]
+        w = glyph_w[visible]
+        h = glyph_h[visible]
+        tx1, ty1, tx2, ty2 = glyph_table.tex_coords[glyphs[visible]].T
+
+        self.vertices = numpy.stack([x, y, x, y + h, x + w, y + h, x + w, y], axis=1)
+        self.tex_coords = numpy.stack([tx1, ty2, tx1, ty1, tx2, ty1, tx2, ty2], axis=1)
+        self.colors = numpy.tile(rgb[visible], 4)
+
+    def __len__(self):
+        return len(self.vertices)
 
 
 class TextBuilder:
 
     def __init__(self):
         self.text = ""
-        self.colors = {}
+        self.spans = []  # list of (start, end, color), for use as a TextSprite's color_spans
 
     def add(self, new_text, color=None):
-        if color is not None:
-            for i in range(0, len(new_text)):
-                self.colors[len(self.text) + i] = color
+        start = len(self.text)
+        end = start + len(new_text)
+        if color is not None and end > start:
+            if len(self.spans) > 0 and self.spans[-1][1] == start and self.spans[-1][2] == color:
+                self.spans[-1] = (self.spans[-1][0], end, color)
+            else:
+                self.spans.append((start, end, color))
         self.text += new_text
         return self
 
     def addLine(self, new_text, color=None):
         return self.add(new_text + "\n", color=color)
 
+    @property
+    def colors(self):
+        """the spans as a dict of index -> color, for code that still uses color lookups."""
+        return {idx: color for (start, end, color) in self.spans for idx in range(start, end)}
+
     def __repr__(self):
-        return "TextBuilder({}, {})".format(self.text, self.colors)
+        return "TextBuilder({}, {})".format(self.text, self.spans)
 
 
 class BorderBoxSprite(MultiSprite):
@@ -768,6 +1639,10 @@ class BorderBoxSprite(MultiSprite):
         self._top_sprite = self._anchor_horz_side_to(self._top_model, 1, self._top_sprite, y1)
         self._bottom_sprite = self._anchor_horz_side_to(self._bottom_model, 0, self._bottom_sprite, y2)
 
+        self._set_children((self._top_left_sprite, self._top_sprite, self._top_right_sprite,
+                            self._left_sprite, self._center_sprite, self._right_sprite,
+                            self._bottom_left_sprite, self._bottom_sprite, self._bottom_right_sprite))
+
     def update(self, new_rect=None, new_scale=None, new_color=None, new_depth=None, new_bg_color=None):
         did_change = False
         if new_rect is not None and self._rect != new_rect:
@@ -791,35 +1666,189 @@ class BorderBoxSprite(MultiSprite):
 
         return self
 
-    def all_sprites(self):
-        if self._top_left_sprite is not None:
-            yield self._top_left_sprite
-        if self._top_sprite is not None:
-            yield self._top_sprite
-        if self._top_right_sprite is not None:
-            yield self._top_right_sprite
 
-        if self._left_sprite is not None:
-            yield self._left_sprite
-        if self._center_sprite is not None:
-            yield self._center_sprite
-        if self._right_sprite is not None:
-            yield self._right_sprite
+class NineSliceSprite(_Sprite):
+    """
+        A BorderBoxSprite as a single sprite. Its nine pieces are written to its layer as nine quads in one
+        numpy pass, so moving or resizing the box only rewrites its vertices (and doesn't re-sort the layer).
+        Missing pieces are drawn as empty quads, so the sprite always takes up the same space in the layer.
+    """
+
+    def __init__(self, layer_id, rect,
+                 top_left=None, top=None, top_right=None,
+                 left=None, center=None, right=None,
+                 bottom_left=None, bottom=None, bottom_right=None,
+                 all_borders=None,
+                 scale=1, color=(1, 1, 1), depth=0, bg_color=None, uid=None, layout=None):
+        """
+        rect: the inner rectangle of the box
+        all_borders: the nine models in row order (top_left, top, ..., bottom_right), overrides the others.
+        color: the corners' color. the sides aren't tinted, same as BorderBoxSprite.
+        bg_color: the center's color, defaults to color.
+        """
+        _Sprite.__init__(self, SpriteTypes.IMAGE, layer_id, uid=uid)
+        self._rect = rect
+        self._models = tuple(all_borders) if all_borders is not None else (
+            top_left, top, top_right, left, center, right, bottom_left, bottom, bottom_right)
+        self._scale = scale
+        self._color = color
+        self._bg_color = color if bg_color is None else bg_color
+        self._depth = depth
+
+        self._layout = layout  # calculated lazily, only depends on the models, scale and colors
+
+    def rect(self):
+        return self._rect
+
+    def size(self):
+        return (self._rect[2], self._rect[3])
+
+    def models(self):
+        return self._models
+
+    def scale(self):
+        return self._scale
+
+    def color(self):
+        return self._color
+
+    def bg_color(self):
+        return self._bg_color
+
+    def depth(self):
+        return self._depth
+
+    def num_primitives(self):
+        return 9
+
+    def primitive_colors(self):
+        white = (1, 1, 1)
+        return (self._color, white, self._color, white, self._bg_color, white, self._color, white, self._color)
+
+    def update(self, new_rect=None, new_scale=None, new_color=None, new_depth=None, new_bg_color=None,
+               new_models=None):
+        rect = self._rect if new_rect is None else new_rect
+        scale = self._scale if new_scale is None else new_scale
+        color = self._color if new_color is None else new_color
+        bg_color = self._bg_color if new_bg_color is None else new_bg_color
+        depth = self._depth if new_depth is None else new_depth
+        models = self._models if new_models is None else tuple(new_models)
+
+        same_layout = (scale == self._scale and
+                       color == self._color and
+                       bg_color == self._bg_color and
+                       models == self._models)
+
+        if same_layout and rect == self._rect and depth == self._depth:
+            return self
+        else:
+            return NineSliceSprite(self.layer_id(), rect, all_borders=models, scale=scale, color=color,
+                                   depth=depth, bg_color=bg_color, uid=self.uid(),
+                                   layout=self._layout if same_layout else None)
+
+    def get_layout(self):
+        if self._layout is None:
+            self._layout = _NineSliceLayout(self._models, self._scale, self._color, self._bg_color)
+        return self._layout
+
+    def add_urself(self, i, vertices, texts, colors, indices):
+        """
+            i: the index of the sprite's first quad in the arrays (it takes up nine).
+        """
+        layout = self.get_layout()
+        x, y, w, h = self._rect
+
+        # pieces in the right column start at the rect's right edge, pieces in the middle column stretch across it
+        x1 = x + w * _NineSliceLayout.X_ANCHORS - layout.sizes[:, 0] * _NineSliceLayout.X_BEFORE
+        y1 = y + h * _NineSliceLayout.Y_ANCHORS - layout.sizes[:, 1] * _NineSliceLayout.Y_BEFORE
+        x2 = x1 + numpy.where(_NineSliceLayout.X_STRETCH, w * layout.has_model, layout.sizes[:, 0])
+        y2 = y1 + numpy.where(_NineSliceLayout.Y_STRETCH, h * layout.has_model, layout.sizes[:, 1])
+
+        vertices[i * 8:(i + 9) * 8] = numpy.stack([x1, y1, x1, y2, x2, y2, x2, y1], axis=1).ravel()
+        texts[i * 8:(i + 9) * 8] = layout.tex_coords
+        if colors is not None:
+            colors[i * 12:(i + 9) * 12] = layout.colors
+        indices[i * 6:(i + 9) * 6] = _NineSliceLayout.INDICES + 4 * i
+
+    def __repr__(self):
+        return type(self).__name__ + "({}, {}, {})".format(self._rect, self.layer_id(), self.uid())
+
+
+class _NineSliceLayout:
+    """the parts of a NineSliceSprite's quads that don't depend on its rect, in row order (top_left first)."""
+
+    X_ANCHORS = numpy.array([0, 0, 1] * 3)           # 1 if the piece starts at the rect's right edge
+    X_BEFORE = numpy.array([1, 0, 0] * 3)            # 1 if the piece sits to the left of its anchor
+    X_STRETCH = numpy.array([False, True, False] * 3)
+    Y_ANCHORS = numpy.repeat([0, 0, 1], 3)
+    Y_BEFORE = numpy.repeat([1, 0, 0], 3)
+    Y_STRETCH = numpy.repeat([False, True, False], 3)
+
+    INDICES = (numpy.arange(9)[:, None] * 4 + numpy.array([0, 1, 2, 0, 2, 3])).ravel()
+    SIDES = [1, 3, 5, 7]
+
+    def __init__(self, models, scale, color, bg_color):
+        self.has_model = numpy.array([m is not None for m in models])
+        self.sizes = numpy.array([(m.w * scale, m.h * scale) if m is not None else (0, 0) for m in models],
+                                 dtype=float)
+        self.tex_coords = numpy.array([m.tex_corners if m is not None else (0,) * 8 for m in models],
+                                      dtype=float).ravel()
+        rgb = numpy.tile(numpy.array(resolve_color(color), dtype=float), (9, 4))
+        rgb[_NineSliceLayout.SIDES] = 1  # like BorderBoxSprite, the sides aren't tinted
+        rgb[4] = resolve_color(bg_color) * 4
+        self.colors = rgb.ravel()
+
+
+
+
+
+
+
+
+
+
 
-        if self._bottom_left_sprite is not None:
-            yield self._bottom_left_sprite
-        if self._bottom_sprite is not None:
-            yield self._bottom_sprite
-        if self._bottom_right_sprite is not None:
-            yield self._bottom_right_sprite
 
 
 
+def benchmark_allocations(n_sprites=100000):
+    """
+        creates n_sprites image sprites and n_sprites triangle sprites, then updates each of them once.
+        returns: {"create": secs, "update": secs, "bytes_per_sprite": average bytes allocated per created sprite}
+    """
+    import time
+    import tracemalloc  # only needed here, so they're not imported with the rest of the module
 
+    model = ImageModel(0, 0, 8, 8, texture_size=(16, 16))
 
+    def _create():
+        return ([ImageSprite(model, i, i, "benchmark") for i in range(n_sprites)],
+                [TriangleSprite("benchmark", (0, 0), (i, 0), (0, i)) for i in range(n_sprites)])
 
+    def _update(images, triangles):
+        return ([spr.update(new_x=spr.x() + 1) for spr in images],
+                [spr.update(new_color=(1, 0, 0)) for spr in triangles])
 
+    start_time = time.perf_counter()
+    images, triangles = _create()
+    create_time = time.perf_counter() - start_time
 
+    start_time = time.perf_counter()
+    _update(images, triangles)
+    update_time = time.perf_counter() - start_time
 
+    # measured separately, because tracing slows down allocations a lot
+    images = triangles = None
+    tracemalloc.start()
+    try:
+        images, triangles = _create()
+        n_bytes = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
 
+    _MODEL_TABLE.free(model.model_id)
 
+    res = {"create": create_time, "update": update_time, "bytes_per_sprite": n_bytes / (2 * n_sprites)}
+    print("INFO: {} sprites: created in {:.3f}s, updated in {:.3f}s, {:.0f} bytes per sprite".format(
+        2 * n_sprites, res["create"], res["update"], res["bytes_per_sprite"]))
+    return res
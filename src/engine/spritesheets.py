@@ -1,7 +1,14 @@
 import pygame
 import traceback
+import numpy
+import hashlib
+import types
+import os
+import random
+import time
 
 import src.engine.sprites as sprites
+import src.engine.renderengine as renderengine
 import src.utils.util as util
 
 
@@ -33,6 +40,11 @@ class SpriteSheet:
         return img_size
 
     def draw_to_atlas(self, atlas, sheet, start_pos=(0, 0)):
+        """
+        draws the sheet onto the atlas and creates its ImageModels.
+        :param atlas: the page Surface to draw onto, or None if the page came from the atlas cache, in which
+                      case only the models should be created (and sheet is a blank Surface of the image's size).
+        """
         if atlas is not None and sheet is not None:
             atlas.blit(sheet, start_pos)
 
@@ -43,6 +55,51 @@ class FontCharacterSpriteLookup:
         """returns: an ImageSprite for the character c, or None if one isn't defined."""
         return None
 
+    def get_char_mappings(self):
+        """returns: map of characters to the characters that should be drawn in their place."""
+        return {}
+
+    def get_glyph_table(self):
+        """returns: a GlyphTable for this font. subclasses should cache it, it's expensive to build."""
+        return GlyphTable(self)
+
+
+class GlyphTable:
+    """
+        Flattened copy of a font's character models, so strings can be converted into
+        texture coords with numpy instead of a get_char call per character.
+    """
+
+    N_CODEPOINTS = 256
+
+    def __init__(self, font_lookup):
+        n = GlyphTable.N_CODEPOINTS
+
+        # index n is for codepoints outside the table
+        self.tex_coords = numpy.zeros((n + 1, 4), dtype=float)  # tx1, ty1, tx2, ty2
+        self.sizes = numpy.zeros((n + 1, 2), dtype=float)        # w, h
+        self.has_model = numpy.zeros(n + 1, dtype=bool)
+
+        for i in range(0, n + 1):
+            model = font_lookup.get_char(chr(i) if i < n else "\uFFFD")
+            if model is not None:
+                self.tex_coords[i] = (model.tx1, model.ty1, model.tx2, model.ty2)
+                self.sizes[i] = (model.w, model.h)
+                self.has_model[i] = True
+
+        a_character = font_lookup.get_char("a")
+        self.char_size = a_character.size() if a_character is not None else (0, 0)
+
+        self._translation = str.maketrans(font_lookup.get_char_mappings())
+
+    def codepoints(self, text):
+        """returns: array of the text's codepoints, after the font's character mappings are applied."""
+        return numpy.frombuffer(text.translate(self._translation).encode("utf-32-le"), dtype=numpy.uint32)
+
+    def glyph_indices(self, codepoints):
+        """returns: array of indices into this table's arrays for the given codepoints."""
+        return numpy.minimum(codepoints, GlyphTable.N_CODEPOINTS).astype(numpy.intp)
+
 
 class DefaultFont(SpriteSheet, FontCharacterSpriteLookup):
 
@@ -59,6 +116,8 @@ class DefaultFont(SpriteSheet, FontCharacterSpriteLookup):
             "↓": chr(25)
         }
 
+        self._glyph_table = None
+
     def get_char(self, c):
         """returns: an ImageSprite for the character c, or None if one isn't defined."""
         if c in self._char_mappings:
@@ -71,8 +130,18 @@ class DefaultFont(SpriteSheet, FontCharacterSpriteLookup):
         else:
             return None
 
+    def get_char_mappings(self):
+        return self._char_mappings
+
+    def get_glyph_table(self):
+        if self._glyph_table is None:
+            self._glyph_table = GlyphTable(self)
+        return self._glyph_table
+
     def draw_to_atlas(self, atlas, sheet, start_pos=(0, 0)):
         super().draw_to_atlas(atlas, sheet, start_pos=start_pos)
+        self._glyph_table = None  # models are about to change
+
         if sheet is None:
             return
 
@@ -100,19 +169,255 @@ class WhiteSquare(SpriteSheet):
 
     def draw_to_atlas(self, atlas, sheet, start_pos=(0, 0)):
         w, h = self.get_size((0, 0))
-        rect = [start_pos[0], start_pos[1], w, h]
-        pygame.draw.rect(atlas, (255, 255, 255), rect)
+        if atlas is not None:
+            pygame.draw.rect(atlas, (255, 255, 255), [start_pos[0], start_pos[1], w, h])
 
         self.white_box = sprites.ImageModel(0, 0, w, h, offset=start_pos)
+        sprites._WHITE_BOX = self.white_box
+
+
+class ShelfAllocator:
+    """
+        Hands out rectangles from a fixed-size region, in horizontal "shelves". Each shelf is as tall as
+        the first thing put on it, and later allocations go on the shortest shelf they fit on (to waste as
+        little height as possible). Freed space is reused by later allocations of the same height or less.
+    """
+
+    def __init__(self, w, h):
+        self.w = w
+        self.h = h
+        self._shelves = []  # list of [y, height, free_spans], where free_spans is a sorted list of (x, w)
+
+    def allocate(self, w, h):
+        """returns: (x, y) of a free w x h rect in the region, or None if there isn't room."""
+        if w <= 0 or h <= 0:
+            raise ValueError("invalid size: {}".format((w, h)))
+
+        best_shelf = None
+        for shelf in self._shelves:
+            if shelf[1] >= h and (best_shelf is None or shelf[1] < best_shelf[1]):
+                if any(span_w >= w for (_, span_w) in shelf[2]):
+                    best_shelf = shelf
+
+        if best_shelf is None:
+            top = self._shelves[-1][0] + self._shelves[-1][1] if len(self._shelves) > 0 else 0
+            if top + h > self.h or w > self.w:
+                return None
+            best_shelf = [top, h, [(0, self.w)]]
+            self._shelves.append(best_shelf)
+
+        spans = best_shelf[2]
+        for i in range(0, len(spans)):
+            span_x, span_w = spans[i]
+            if span_w >= w:
+                if span_w == w:
+                    del spans[i]
+                else:
+                    spans[i] = (span_x + w, span_w - w)
+                return (span_x, best_shelf[0])
+
+    def free(self, x, y, w):
+        """frees a rect that was returned by allocate."""
+        for shelf_idx in range(0, len(self._shelves)):
+            shelf = self._shelves[shelf_idx]
+            if shelf[0] != y:
+                continue
+
+            spans = shelf[2]
+            spans.append((x, w))
+            spans.sort()
+
+            merged = [spans[0]]
+            for span_x, span_w in spans[1:]:
+                last_x, last_w = merged[-1]
+                if last_x + last_w == span_x:
+                    merged[-1] = (last_x, last_w + span_w)
+                else:
+                    merged.append((span_x, span_w))
+            shelf[2] = merged
+
+            # empty shelves at the top give their height back
+            while len(self._shelves) > 0 and self._shelves[-1][2] == [(0, self.w)]:
+                self._shelves.pop()
+            return
+
+        raise ValueError("no allocation at: {}".format((x, y, w)))
+
+
+class DynamicSheet(SpriteSheet):
+    """
+        Reserves a region of the atlas that images can be added to (and freed from) at runtime,
+        e.g. for generated icons or cached text. Only the added image's rect is uploaded to the GPU.
+    """
+
+    def __init__(self, sheet_id, size):
+        SpriteSheet.__init__(self, sheet_id, None)
+        self._size = size
+
+        self._allocator = ShelfAllocator(size[0], size[1])
+        self._origin = None       # top left corner of the region in the atlas
+        self._page = None
+        self._atlas_size = None
+
+        self._allocations = {}    # id(model) -> (x, y, w, model id), in the region's coords
+
+    def get_size(self, img_size):
+        return self._size
+
+    def draw_to_atlas(self, atlas, sheet, start_pos=(0, 0)):
+        self._origin = start_pos
+        self._page = sprites._CURRENT_ATLAS_PAGE
+        self._atlas_size = sprites._CURRENT_ATLAS_SIZE
+
+        # anything that was added before is gone now
+        for (_, _, _, model_id) in self._allocations.values():
+            sprites.get_model_table().free(model_id)
+        self._allocator = ShelfAllocator(self._size[0], self._size[1])
+        self._allocations.clear()
+
+    def add_image(self, surface):
+        """
+            copies the surface into the region and uploads it.
+            returns: an ImageModel for it, or None if there isn't enough room.
+        """
+        if self._origin is None:
+            raise ValueError("{} hasn't been added to an atlas yet".format(self.get_sheet_id()))
+
+        w, h = surface.get_size()
+        pos = self._allocator.allocate(w, h)
+        if pos is None:
+            return None
+
+        atlas_x = self._origin[0] + pos[0]
+        atlas_y = self._origin[1] + pos[1]
+        model = sprites.ImageModel(atlas_x, atlas_y, w, h, texture_size=self._atlas_size, page=self._page)
+        self._allocations[id(model)] = (pos[0], pos[1], w, model.model_id)
+
+        img_data = pygame.image.tostring(surface, "RGBA", True)
+        gl_y = self._atlas_size[1] - (atlas_y + h)
+        renderengine.get_instance().update_texture_region(self._page, atlas_x, gl_y, w, h, img_data)
+
+        return model
+
+    def free_image(self, model):
+        """frees the model's space in the region, so it can be reused. sprites shouldn't use the model after this."""
+        key = id(model)
+        if key not in self._allocations:
+            raise ValueError("model isn't in {}: {}".format(self.get_sheet_id(), model))
+        x, y, w, model_id = self._allocations.pop(key)
+        self._allocator.free(x, y, w)
+        sprites.get_model_table().free(model_id)
+
+
+class AtlasLayout:
+    """where each sheet goes in the atlas."""
+
+    def __init__(self, atlas_size, n_pages, sizes, pages, positions, img_sizes):
+        self.atlas_size = atlas_size  # (w, h) of every page
+        self.n_pages = n_pages
+        self.sizes = sizes            # sheet_id -> (w, h) of its region
+        self.pages = pages            # sheet_id -> page index
+        self.positions = positions    # sheet_id -> (x, y) of its region
+        self.img_sizes = img_sizes    # sheet_id -> (w, h) of its image, or (0, 0) if it doesn't have one
+
+    def to_json(self):
+        return {
+            "atlas_size": list(self.atlas_size),
+            "n_pages": self.n_pages,
+            "sheets": {s_id: {"size": list(self.sizes[s_id]),
+                              "page": self.pages[s_id],
+                              "pos": list(self.positions[s_id]),
+                              "img_size": list(self.img_sizes[s_id])} for s_id in self.sizes}
+        }
+
+    @staticmethod
+    def from_json(blob):
+        sheets = blob["sheets"]
+        return AtlasLayout(tuple(blob["atlas_size"]), int(blob["n_pages"]),
+                           {s_id: tuple(sheets[s_id]["size"]) for s_id in sheets},
+                           {s_id: int(sheets[s_id]["page"]) for s_id in sheets},
+                           {s_id: tuple(sheets[s_id]["pos"]) for s_id in sheets},
+                           {s_id: tuple(sheets[s_id]["img_size"]) for s_id in sheets})
+
+
+class AtlasCache:
+    """
+        Saves a packed atlas to disk, so that later launches can skip decoding the sheets' images and packing
+        them. The pages are saved as a raw RGBA blob (already flipped the way GL wants it) that's memory-mapped
+        back in, along with a json file of the layout. Only the latest atlas is kept.
+    """
+
+    VERSION = 1
+
+    _BLOB_EXT = ".rgba"
+    _LAYOUT_EXT = ".json"
+
+    def __init__(self, directory, key):
+        self.directory = directory
+        self.key = key
+
+    def _get_path(self, ext):
+        return os.path.join(self.directory, self.key + ext)
+
+    def load_layout(self):
+        """returns: the cached AtlasLayout, or None if there isn't one for this key."""
+        path = self._get_path(AtlasCache._LAYOUT_EXT)
+        if not os.path.exists(path):
+            return None
+        try:
+            return AtlasLayout.from_json(util.Utils.load_json_from_path(path))
+        except Exception:
+            print("WARN: ignoring malformed atlas cache: {}".format(path))
+            traceback.print_exc()
+            return None
+
+    def load_pages(self, layout):
+        """returns: list of read-only arrays of each page's data, or None if the blob is missing or the wrong size."""
+        path = self._get_path(AtlasCache._BLOB_EXT)
+        w, h = layout.atlas_size
+        shape = (layout.n_pages, h, w, 4)
+        try:
+            if os.path.getsize(path) != shape[0] * shape[1] * shape[2] * shape[3]:
+                print("WARN: ignoring atlas cache with the wrong size: {}".format(path))
+                return None
+            blob = numpy.memmap(path, dtype=numpy.uint8, mode="r", shape=shape)
+        except (OSError, ValueError):
+            return None
+        return [blob[i] for i in range(0, layout.n_pages)]
+
+    def save(self, layout, pages):
+        """pages: list of each page's data in string RGBA format, bottom row first."""
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            for filename in os.listdir(self.directory):
+                if filename.endswith(AtlasCache._BLOB_EXT) or filename.endswith(AtlasCache._LAYOUT_EXT):
+                    os.remove(os.path.join(self.directory, filename))
+
+            # the layout goes last, so a blob without one is never used
+            blob_path = self._get_path(AtlasCache._BLOB_EXT)
+            with open(blob_path + ".tmp", "wb") as f:
+                for page in pages:
+                    f.write(page)
+            os.replace(blob_path + ".tmp", blob_path)
+
+            util.Utils.save_json_to_path(layout.to_json(), self._get_path(AtlasCache._LAYOUT_EXT))
+            print("INFO: saved sprite atlas to cache: {}".format(self.key))
+        except OSError:
+            print("WARN: failed to save atlas cache: {}".format(self.directory))
+            traceback.print_exc()
+
+
+PACKER_SMALLEST_RECT = "smallest_rect"  # see Utils.pack_rects_into_smallest_rect, it's O(n^2) (or worse)
+PACKER_SKYLINE = "skyline"              # see Utils.pack_rects_skyline, fast enough for thousands of sheets
 
 
 _SINGLETON = None
 
 
-def create_instance():
+def create_instance(packer=PACKER_SMALLEST_RECT, power_of_two=False):
     global _SINGLETON
     if _SINGLETON is None:
-        _SINGLETON = SpriteAtlas()
+        _SINGLETON = SpriteAtlas(packer=packer, power_of_two=power_of_two)
         return _SINGLETON
     else:
         raise ValueError("SpriteAtlas has already been created")
@@ -124,8 +429,19 @@ def get_instance():
 
 class SpriteAtlas:
 
-    def __init__(self):
+    def __init__(self, packer=PACKER_SMALLEST_RECT, power_of_two=False):
+        """
+            packer: how sheets are arranged on each page, PACKER_SMALLEST_RECT or PACKER_SKYLINE.
+            power_of_two: whether the pages' dimensions must be powers of 2.
+        """
+        if packer not in (PACKER_SMALLEST_RECT, PACKER_SKYLINE):
+            raise ValueError("unknown packer: {}".format(packer))
+        self._packer = packer
+        self._power_of_two = power_of_two
+
         self._sheets = {}  # sheet_id -> SpriteSheet
+        self._last_layout = None
+        self._model_ids = []  # ids of the models the sheets created, freed when the atlas is rebuilt
 
         # some "built-in" sheets
         self.add_sheet(DefaultFont())
@@ -142,13 +458,72 @@ class SpriteAtlas:
             return None
 
     def create_atlas_surface(self):
+        """returns: the atlas as a single Surface."""
+        return self.create_atlas_pages(max_page_size=None)[0]
+
+    def create_atlas_pages(self, max_page_size=None):
+        """
+            max_page_size: (w, h) that each page must fit in, or None to put everything on one page.
+            returns: list of Surfaces, all the same size. sheets that don't fit on the
+                     first page spill over onto the next one (a sheet is never split).
+        """
         print("INFO: creating sprite atlas for {} sheets: [{}]".format(
             len(self._sheets), ", ".join([s_id for s_id in self._sheets])))
 
-        sizes = {}  # sheet_id -> (w, h)
-        all_non_empty_sizes = []
+        loaded_images = self._load_sheet_images()
+        img_sizes = {s_id: (loaded_images[s_id].get_size() if loaded_images[s_id] is not None else (0, 0))
+                     for s_id in self._sheets}
+
+        layout = self._create_layout(img_sizes, max_page_size)
+
+        page_surfaces = []
+        for _ in range(0, layout.n_pages):
+            page_surface = pygame.Surface(layout.atlas_size, pygame.SRCALPHA, 32)
+            page_surface.fill((255, 255, 255, 0))
+            page_surfaces.append(page_surface)
 
-        loaded_images = {}  # sheet_id -> Surface or None
+        self._draw_sheets(layout, page_surfaces, loaded_images)
+
+        return page_surfaces
+
+    def create_atlas_texture_data(self, max_page_size=None, cache_dir=None):
+        """
+            like create_atlas_pages, but returns the pages' image data instead of Surfaces.
+            cache_dir: directory to save the packed atlas in, or None to not cache it. if the sheets' images,
+                       classes and sizes are the same as last time, the atlas is memory-mapped from there
+                       instead, and only the sheets' models are recreated.
+            returns: (pages, width, height), where pages is a list of image data in string RGBA format (bottom
+                     row first), one per page. this is what RenderEngine.set_texture_pages takes.
+        """
+        cache = None
+        if cache_dir is not None:
+            cache = AtlasCache(cache_dir, self._get_cache_key(max_page_size))
+            layout = cache.load_layout()
+            pages = cache.load_pages(layout) if layout is not None else None
+            if pages is not None:
+                print("INFO: loaded sprite atlas for {} sheets from cache: {}".format(len(self._sheets), cache.key))
+
+                # the models still need creating, but there's nothing to draw. sheets get a blank image of the
+                # right size (for sheets that look at it) and no atlas.
+                blank_images = {}
+                for s_id in self._sheets:
+                    img_size = layout.img_sizes[s_id]
+                    blank_images[s_id] = pygame.Surface(img_size) if img_size[0] > 0 and img_size[1] > 0 else None
+                self._draw_sheets(layout, [None] * layout.n_pages, blank_images)
+                return pages, layout.atlas_size[0], layout.atlas_size[1]
+
+        page_surfaces = self.create_atlas_pages(max_page_size=max_page_size)
+        pages = [pygame.image.tostring(page, "RGBA", 1) for page in page_surfaces]
+        width, height = page_surfaces[0].get_size()
+
+        if cache is not None:
+            cache.save(self._last_layout, pages)
+
+        return pages, width, height
+
+    def _load_sheet_images(self):
+        """returns: sheet_id -> Surface, or None if the sheet doesn't have an image (or it failed to load)."""
+        loaded_images = {}
         for s_id in self._sheets:
             rel_path = self._sheets[s_id].get_filepath()
             if rel_path is None:
@@ -161,62 +536,207 @@ class SpriteAtlas:
                     print("ERROR: failed to load sprite sheet {} from path: {}".format(s_id, resource_path))
                     traceback.print_exc()
                     loaded_images[s_id] = None
+        return loaded_images
 
-        for s_id in self._sheets:
-            img_size = (0, 0)
-            if loaded_images[s_id] is not None:
-                img_size = loaded_images[s_id].get_size()
+    def _create_layout(self, img_sizes, max_page_size):
+        """
+            img_sizes: sheet_id -> size of the sheet's image, or (0, 0) if it doesn't have one.
+            returns: an AtlasLayout saying where each sheet goes.
+        """
+        sizes = {}  # sheet_id -> (w, h)
+        non_empty_sheets = []
 
-            s_size = self._sheets[s_id].get_size(img_size)
+        for s_id in self._sheets:
+            s_size = self._sheets[s_id].get_size(img_sizes[s_id])
             sizes[s_id] = s_size
             if s_size[0] > 0 and s_size[1] > 0:
-                all_non_empty_sizes.append(s_size)
+                non_empty_sheets.append(s_id)
             else:
                 print("WARN: sprite sheet {} has empty or invalid size: {}".format(s_id, s_size))
 
-        packed_rects, atlas_size = util.Utils.pack_rects_into_smallest_rect(all_non_empty_sizes)
-
-        packed_rects_set = set()
-        for r in packed_rects:
-            packed_rects_set.add(tuple(r))
+        page_sheets = self._assign_sheets_to_pages(non_empty_sheets, sizes, max_page_size)
 
+        pages = {}      # sheet_id -> page index
         positions = {}  # sheet_id -> (x, y)
+        page_bounds = []
+        for page_idx, sheet_ids in enumerate(page_sheets):
+            packed = self._pack_page([sizes[s_id] for s_id in sheet_ids], max_page_size)
+            if packed is None:
+                raise ValueError("sprite sheets don't fit on a page of size {}: {}".format(max_page_size, sheet_ids))
+            packed_rects, page_bound = packed
+            page_bounds.append(page_bound)
+
+            packed_rects_set = set()
+            for r in packed_rects:
+                packed_rects_set.add(tuple(r))
+
+            for s_id in sheet_ids:
+                for r in packed_rects_set:
+                    if r[2] == sizes[s_id][0] and r[3] == sizes[s_id][1]:
+                        pages[s_id] = page_idx
+                        positions[s_id] = (r[0], r[1])
+                        packed_rects_set.remove(r)
+                        break
+
         for s_id in self._sheets:
-            my_rect = None
+            if s_id not in positions:
+                pages[s_id] = 0
+                positions[s_id] = (0, 0)  # "draw" invalid sheets at (0, 0)
 
-            for r in packed_rects_set:
-                if r[2] == sizes[s_id][0] and r[3] == sizes[s_id][1]:
-                    positions[s_id] = (r[0], r[1])
-                    my_rect = r
-                    break
+        # every page in a texture array has the same size
+        atlas_size = (max([b[0] for b in page_bounds], default=1), max([b[1] for b in page_bounds], default=1))
 
-            if my_rect is not None:
-                packed_rects_set.remove(my_rect)
-            else:
-                positions[s_id] = (0, 0)  # "draw" invalid sheets at (0, 0)
+        layout = AtlasLayout(atlas_size, max(1, len(page_sheets)), sizes, pages, positions, img_sizes)
+        self._last_layout = layout
+        return layout
 
+    def _draw_sheets(self, layout, page_surfaces, images):
+        """draws each sheet onto its page, which creates its models. page_surfaces can be Nones (see AtlasCache)."""
         all_sheets = [s_id for s_id in self._sheets]
         all_sheets.sort(key=lambda s_id: self._sheets[s_id].get_draw_order())
 
         # XXX this is a big hack that tells all the ImageModels we're about to create what size
         # their texture is. They need to know because their GL texture coordinates use an "upward"
         # y-axis (and everything in my code uses the opposite), so they need to flip themselves.
-        sprites._CURRENT_ATLAS_SIZE = atlas_size
-
-        atlas_surface = pygame.Surface(atlas_size, pygame.SRCALPHA, 32)
-        atlas_surface.fill((255, 255, 255, 0))
-
-        for s_id in all_sheets:
-            pos = positions[s_id]
-            img = loaded_images[s_id]
-            size = sizes[s_id]
-            print("INFO:   drawing {} [{}x{}] to ({}, {})".format(s_id, size[0], size[1], pos[0], pos[1]))
-            self._sheets[s_id].draw_to_atlas(atlas_surface, img, start_pos=pos)
-
+        sprites._CURRENT_ATLAS_SIZE = layout.atlas_size
+
+        model_table = sprites.get_model_table()
+        model_table.start_recording()
+        try:
+            for s_id in all_sheets:
+                pos = layout.positions[s_id]
+                size = layout.sizes[s_id]
+                page_idx = layout.pages[s_id]
+                print("INFO:   drawing {} [{}x{}] to ({}, {}) on page {}".format(
+                    s_id, size[0], size[1], pos[0], pos[1], page_idx))
+
+                sprites._CURRENT_ATLAS_PAGE = page_idx  # same hack as above
+                self._sheets[s_id].draw_to_atlas(page_surfaces[page_idx], images[s_id], start_pos=pos)
+        finally:
+            new_model_ids = model_table.stop_recording()
+
+        # the sheets have replaced their old models, so their ids can be reused
+        for model_id in self._model_ids:
+            model_table.free(model_id)
+        self._model_ids = new_model_ids
+
+        sprites._CURRENT_ATLAS_PAGE = 0
         sprites.CURRENT_ATLAS_SIZE = None  # clean it up for good measure ~
+        sprites.clear_text_caches()  # they refer to the old models
 
-        return atlas_surface
-
-
+    def _get_cache_key(self, max_page_size):
+        """
+            returns: a hash of everything that goes into the atlas. that's the sheets' image files, and each
+            sheet's class, code and the size it asks for, since sheets can generate sprites of their own.
+        """
+        hasher = hashlib.sha1()
+
+        def _add(val):
+            hasher.update(val if isinstance(val, bytes) else repr(val).encode("utf-8"))
+            hasher.update(b"\0")
+
+        def _add_code(code):
+            # (marshal's output depends on refcounts, so it can't be used for this)
+            _add(code.co_code)
+            _add(code.co_names)
+            for const in code.co_consts:
+                if isinstance(const, types.CodeType):
+                    _add_code(const)
+                elif isinstance(const, frozenset):
+                    _add(sorted(repr(c) for c in const))  # its order depends on string hashing
+                else:
+                    _add(const)
+
+        _add(AtlasCache.VERSION)
+        _add(max_page_size)
+        _add(self._packer)
+        _add(self._power_of_two)
+        for s_id in self._sheets:
+            sheet = self._sheets[s_id]
+            _add(s_id)
+            _add(type(sheet).__module__ + "." + type(sheet).__qualname__)
+            _add(sheet.get_draw_order())
+            _add(sheet.get_size((0, 0)))
+            for cls in type(sheet).__mro__:
+                for method_name in ("get_size", "draw_to_atlas"):
+                    if method_name in cls.__dict__:
+                        _add_code(cls.__dict__[method_name].__code__)
+
+            rel_path = sheet.get_filepath()
+            _add(rel_path)
+            if rel_path is not None:
+                try:
+                    with open(util.Utils.resource_path(rel_path), "rb") as f:
+                        _add(hashlib.sha1(f.read()).digest())
+                except OSError:
+                    _add(None)  # it'll fail to load, which is fine to cache too
+
+        return hasher.hexdigest()
+
+    def _assign_sheets_to_pages(self, sheet_ids, sizes, max_page_size):
+        """returns: list of lists of sheet ids, one per page. biggest sheets are placed first."""
+        if max_page_size is None:
+            return [list(sheet_ids)]
+
+        max_w, max_h = max_page_size
+        page_sheets = []
+        for s_id in sorted(sheet_ids, key=lambda s: sizes[s][0] * sizes[s][1], reverse=True):
+            if sizes[s_id][0] > max_w or sizes[s_id][1] > max_h:
+                raise ValueError("sprite sheet {} is bigger than the max page size: {} > {}".format(
+                    s_id, sizes[s_id], max_page_size))
+
+            for sheet_ids_on_page in page_sheets:
+                if self._pack_page([sizes[other] for other in sheet_ids_on_page] + [sizes[s_id]],
+                                   max_page_size) is not None:
+                    sheet_ids_on_page.append(s_id)
+                    break
+            else:
+                page_sheets.append([s_id])
+
+        return page_sheets
+
+    def _pack_page(self, rect_sizes, max_page_size):
+        """returns: (list of rects (x, y, w, h), (w, h) of the page), or None if they don't fit in max_page_size."""
+        if self._packer == PACKER_SKYLINE:
+            try:
+                return util.Utils.pack_rects_skyline(rect_sizes, max_size=max_page_size,
+                                                     power_of_two=self._power_of_two)
+            except ValueError:
+                return None
+
+        rects, bound = util.Utils.pack_rects_into_smallest_rect(rect_sizes)
+        if self._power_of_two:
+            bound = (util.Utils.next_power_of_2(bound[0]), util.Utils.next_power_of_2(bound[1]))
+        if max_page_size is not None and (bound[0] > max_page_size[0] or bound[1] > max_page_size[1]):
+            return None
+        return rects, bound
+
+
+def benchmark_packers(counts=(10, 100, 1000, 10000), max_rect_size=64, max_smallest_rect_count=100, seed=12345):
+    """
+        packs random sets of rects with each packer, and measures how long it takes and how much of the
+        bound is actually used.
+        max_smallest_rect_count: bigger sets are skipped for PACKER_SMALLEST_RECT, it'd take minutes.
+        returns: (packer, count) -> {"time": secs, "efficiency": area of the rects / area of the bound}
+    """
+    rand = random.Random(seed)
+    results = {}
+    for count in counts:
+        rect_sizes = [(rand.randint(1, max_rect_size), rand.randint(1, max_rect_size)) for _ in range(count)]
+        rects_area = sum(w * h for (w, h) in rect_sizes)
+
+        for packer in (PACKER_SMALLEST_RECT, PACKER_SKYLINE):
+            if packer == PACKER_SMALLEST_RECT and count > max_smallest_rect_count:
+                continue
+            start_time = time.perf_counter()
+            if packer == PACKER_SKYLINE:
+                _, bound = util.Utils.pack_rects_skyline(rect_sizes)
+            else:
+                _, bound = util.Utils.pack_rects_into_smallest_rect(rect_sizes)
+            elapsed = time.perf_counter() - start_time
 
+            results[(packer, count)] = {"time": elapsed, "efficiency": rects_area / (bound[0] * bound[1])}
+            print("INFO: {} rects with {}: packed in {:.4f}s into {}x{} ({:.1f}% used)".format(
+                count, packer, elapsed, bound[0], bound[1], 100 * rects_area / (bound[0] * bound[1])))
 
+    return results
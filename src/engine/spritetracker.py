@@ -0,0 +1,109 @@
+import os
+import traceback
+
+import numpy
+
+
+class SpriteTracker:
+    """
+        Finds sprites that were added to the render engine and then forgotten about. Games are expected to
+        republish (i.e. call RenderEngine.update on) all their sprites every frame, so a sprite that hasn't
+        been republished for a while was probably dropped without being removed, and is still being drawn.
+
+        Stale sprites are reported along with the stack they were first published from, and can optionally
+        be removed automatically. Sprite handles are meant to be published once and then changed in place,
+        so they're never reported or expired.
+    """
+
+    _ENGINE_FILES = ("renderengine.py", "spritetracker.py")
+
+    def __init__(self, report_after=300, expire_after=None, check_interval=60, capture_stacks=True):
+        """
+            report_after: the number of frames a sprite can go without being republished before it's reported,
+                          or None to never report them.
+            expire_after: the number of frames after which it's removed from the engine, or None to never
+                          remove them.
+            check_interval: how often (in frames) to look for stale sprites.
+            capture_stacks: whether to remember where each sprite was first published from. this is slow,
+                            it's meant for tracking leaks down, not for leaving on.
+        """
+        if report_after is None and expire_after is None:
+            raise ValueError("nothing to do, report_after and expire_after are both None")
+        self.report_after = report_after
+        self.expire_after = expire_after
+        self.check_interval = max(1, int(check_interval))
+        self.capture_stacks = capture_stacks
+
+        self._last_published = []  # sprite id -> frame it was last published on, or -1 if it isn't tracked
+        self._stacks = {}          # sprite id -> StackSummary of where it was first published
+        self._reported = set()     # ids that have been reported since they were last published
+
+        self._frame = 0
+        self._n_expired = 0
+
+    def on_published(self, sprite):
+        if sprite.is_handle():
+            return
+        uid = sprite.uid()
+        last_published = self._last_published
+        if uid >= len(last_published):
+            last_published.extend([-1] * (uid + 1 - len(last_published)))
+
+        if last_published[uid] < 0 and self.capture_stacks:
+            self._stacks[uid] = self._get_caller_stack()
+        last_published[uid] = self._frame
+        if uid in self._reported:
+            self._reported.remove(uid)
+
+    def on_removed(self, uid):
+        if uid < len(self._last_published):
+            self._last_published[uid] = -1
+        self._stacks.pop(uid, None)
+        self._reported.discard(uid)
+
+    def clear(self):
+        self._last_published.clear()
+        self._stacks.clear()
+        self._reported.clear()
+
+    def begin_frame(self, frame, engine):
+        """called before the layers are rebuilt. reports (and maybe removes) stale sprites every check_interval frames."""
+        self._frame = frame
+        if frame % self.check_interval != 0:
+            return
+
+        for uid, age in self.get_stale_sprites():
+            if uid not in engine.sprite_lookup:
+                self.on_removed(uid)  # removed without the engine telling us, e.g. by a layer being dropped
+                continue
+            sprite = engine.sprite_lookup[uid]
+            if self.expire_after is not None and age >= self.expire_after:
+                engine.remove(sprite)
+                self._n_expired += 1
+                print("INFO: removed {} after {} frames without being republished".format(sprite, age))
+            elif self.report_after is not None and uid not in self._reported:
+                self._reported.add(uid)
+                print("WARN: {} hasn't been republished for {} frames, it may have been leaked".format(sprite, age))
+                if uid in self._stacks:
+                    print("WARN:   it was first published from:\n" + "".join(self._stacks[uid].format()).rstrip())
+
+    def get_stale_sprites(self):
+        """returns: list of (sprite id, number of frames since it was last published) for the stale sprites."""
+        thresholds = [t for t in (self.report_after, self.expire_after) if t is not None]
+        last_published = numpy.array(self._last_published, dtype=numpy.int64)
+        ages = self._frame - last_published
+        uids = numpy.flatnonzero((last_published >= 0) & (ages >= min(thresholds)))
+        return [(int(uid), int(ages[uid])) for uid in uids]
+
+    def get_num_tracked(self):
+        return len(self._last_published) - self._last_published.count(-1)
+
+    def get_num_expired(self):
+        return self._n_expired
+
+    def _get_caller_stack(self):
+        stack = traceback.extract_stack()
+        # drop the frames inside the engine, so the stack ends where the game published the sprite
+        while len(stack) > 1 and os.path.basename(stack[-1].filename) in SpriteTracker._ENGINE_FILES:
+            stack.pop()
+        return stack
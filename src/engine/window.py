@@ -27,6 +27,9 @@ class WindowState:
 
         self._cached_fullscreen_size = None
 
+        self._pending_window_size = None
+        self._pending_since = 0
+
     def _get_mods(self):
         mods = pygame.OPENGL | pygame.DOUBLEBUF | pygame.HWSURFACE | pygame.RESIZABLE
 
@@ -78,9 +81,29 @@ class WindowState:
 
     def set_window_size(self, w, h):
         # print("INFO: set window size to: ({}, {})".format(w, h))
+        self._pending_window_size = None
         self._window_size = (w, h)
         self._update_display_mode()
 
+    def request_window_size(self, w, h):
+        """
+            resizes the window once the size has stopped changing (see apply_pending_window_size).
+            dragging a window's edge sends a burst of VIDEORESIZE events, and changing the display
+            mode for each of them would be slow (and on some platforms, recreates the gl context).
+        """
+        self._pending_window_size = (w, h)
+        self._pending_since = pygame.time.get_ticks()
+
+    def apply_pending_window_size(self, settle_time_ms=150):
+        """returns: True if the window was resized."""
+        if self._pending_window_size is None:
+            return False
+        elif pygame.time.get_ticks() - self._pending_since < settle_time_ms:
+            return False
+        else:
+            self.set_window_size(*self._pending_window_size)
+            return True
+
     def is_fullscreen(self):
         return self._is_fullscreen
 
@@ -89,6 +112,7 @@ class WindowState:
             return
         else:
             self._cached_fullscreen_size = None
+            self._pending_window_size = None
 
             self._is_fullscreen = val
             self._update_display_mode()
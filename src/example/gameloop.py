@@ -1,6 +1,6 @@
 import pygame
-import math
 import random
+import numpy
 
 from src.utils.util import Utils
 import src.engine.sounds as sounds
@@ -64,7 +64,7 @@ class DemoJunk:
     cube_color = (0, 0, 0)
     cube_line_thickness = 1
 
-    cube_line_sprites = []
+    cube_line_batch = None
 
     fps_text_sprite = None
     title_text_sprite = None
@@ -85,8 +85,8 @@ class DemoJunk:
             yield spr
         if DemoJunk.triangle_sprite is not None:
             yield DemoJunk.triangle_sprite
-        for spr in DemoJunk.cube_line_sprites:
-            yield spr
+        if DemoJunk.cube_line_batch is not None:
+            yield DemoJunk.cube_line_batch
 
         if DemoJunk.fps_text_sprite is not None:
             yield DemoJunk.fps_text_sprite
@@ -279,14 +279,13 @@ def run():
 
         if not ignore_resize_events_this_tick and len(all_resize_events) > 0:
             last_resize_event = all_resize_events[-1]
+            window.get_instance().request_window_size(last_resize_event.w, last_resize_event.h)
 
-            print("INFO: resizing to {}, {}".format(last_resize_event.w, last_resize_event.h))
-
-            window.get_instance().set_window_size(last_resize_event.w, last_resize_event.h)
-
+        if window.get_instance().apply_pending_window_size():
             display_w, display_h = window.get_instance().get_display_size()
-            new_pixel_scale = _calc_pixel_scale((last_resize_event.w, last_resize_event.h))
+            print("INFO: resizing to {}, {}".format(display_w, display_h))
 
+            new_pixel_scale = _calc_pixel_scale((display_w, display_h))
             renderengine.get_instance().resize(display_w, display_h, px_scale=new_pixel_scale)
 
         input_state.update(DemoJunk.tick_count)
@@ -366,8 +365,8 @@ def update_crappy_demo_scene(fps_for_display):
     if DemoJunk.triangle_sprite is None:
         DemoJunk.triangle_sprite = sprites.TriangleSprite(DemoJunk.POLYGON_LAYER, color=(0, 0, 0))
 
-    while len(DemoJunk.cube_line_sprites) < 12:
-        DemoJunk.cube_line_sprites.append(sprites.LineSprite(DemoJunk.POLYGON_LAYER, thickness=DemoJunk.cube_line_thickness))
+    if DemoJunk.cube_line_batch is None:
+        DemoJunk.cube_line_batch = sprites.LineBatch(DemoJunk.POLYGON_LAYER, thickness=DemoJunk.cube_line_thickness)
 
     anim_tick = DemoJunk.tick_count // 16
 
@@ -484,33 +483,25 @@ def update_crappy_demo_scene(fps_for_display):
                                                                all_borders=DemoJunk.demo_sheet.border_models)
         DemoJunk.text_box_sprite = DemoJunk.text_box_sprite.update(new_rect=info_text_rect, new_scale=2)
 
-    if len(DemoJunk.cube_line_sprites) == 12:
+    if DemoJunk.cube_line_batch is not None:
         cube_center = DemoJunk.cube_center
         cube_angle = DemoJunk.cube_angle * 2 * 3.141529 / 360
         cube_length = DemoJunk.cube_length
         cube_color = DemoJunk.cube_color
 
-        cube_top_pts = []
-        cube_btm_pts = []
-
-        for i in range(0, 4):
-            dx = cube_length / 2 * math.cos(cube_angle + i * 3.141529 / 2)
-            dy = cube_length / 2 * math.sin(cube_angle + i * 3.141529 / 2) / 2  # foreshortened in the y-axis
-            cube_btm_pts.append(Utils.add(cube_center, (dx, dy)))
-            cube_top_pts.append(Utils.add(cube_center, (dx, dy - cube_length)))
-
-        for i in range(0, 12):
-            if i < 4:  # bottom lines
-                p1 = cube_btm_pts[i % 4]
-                p2 = cube_btm_pts[(i + 1) % 4]
-            elif i < 8:  # top lines
-                p1 = cube_top_pts[i % 4]
-                p2 = cube_top_pts[(i + 1) % 4]
-            else:  # bottom to top lines
-                p1 = cube_btm_pts[i % 4]
-                p2 = cube_top_pts[i % 4]
-
-            DemoJunk.cube_line_sprites[i].update(new_p1=p1, new_p2=p2, new_color=cube_color)
+        angles = cube_angle + numpy.arange(0, 4) * 3.141529 / 2
+        dx = cube_length / 2 * numpy.cos(angles)
+        dy = cube_length / 2 * numpy.sin(angles) / 2  # foreshortened in the y-axis
+        cube_btm_pts = numpy.stack([cube_center[0] + dx, cube_center[1] + dy], axis=1)
+        cube_top_pts = cube_btm_pts - (0, cube_length)
+
+        # bottom lines, then top lines, then bottom to top lines
+        p1s = numpy.concatenate([cube_btm_pts, cube_top_pts, cube_btm_pts])
+        p2s = numpy.concatenate([numpy.roll(cube_btm_pts, -1, axis=0),
+                                 numpy.roll(cube_top_pts, -1, axis=0),
+                                 cube_top_pts])
+
+        DemoJunk.cube_line_batch = DemoJunk.cube_line_batch.update(new_p1s=p1s, new_p2s=p2s, new_color=cube_color)
 
         player_dist = Utils.dist(DemoJunk.entity_positions[0], cube_center)
         if player_dist > 100:
@@ -1,4 +1,5 @@
 import pygame
+import datetime
 import math
 import random
 
@@ -9,6 +10,7 @@ import src.engine.inputs as inputs
 
 import src.engine.sprites as sprites
 import src.engine.renderengine as renderengine
+import src.engine.capture as capture
 import src.engine.layers as layers
 import src.engine.spritesheets as spritesheets
 
@@ -19,6 +21,12 @@ import src.game.gamestate as gamestate
 DEFAULT_SCREEN_SIZE = (800, 600)
 MINIMUM_SCREEN_SIZE = (800, 600)
 
+RENDER_ENGINE_CACHE_PATH = "config/render_engine.json"  # remembers the fastest backend for each GPU + driver
+SHADER_CACHE_DIR = "config/shaders"
+ATLAS_CACHE_DIR = "config/atlas"  # the packed sprite atlas, so it doesn't need rebuilding every launch
+
+MAX_ATLAS_PAGE_SIZE = 2048  # sheets spill over onto more pages past this
+
 
 def init(name_of_game):
     print("INFO: pygame version: " + pygame.version.ver)
@@ -35,23 +43,28 @@ def init(name_of_game):
     window.get_instance().set_caption(name_of_game)
     window.get_instance().show()
 
-    render_eng = renderengine.create_instance()
+    render_eng = renderengine.create_instance(benchmark=True, cache_path=RENDER_ENGINE_CACHE_PATH,
+                                              shader_cache_dir=SHADER_CACHE_DIR)
     render_eng.init(*DEFAULT_SCREEN_SIZE)
     render_eng.set_min_size(*MINIMUM_SCREEN_SIZE)
 
-    sprite_atlas = spritesheets.create_instance()
+    sprite_atlas = spritesheets.create_instance(packer=spritesheets.PACKER_SKYLINE)
 
     spriteref.MAIN_SHEET = sprite_atlas.add_sheet(spriteref.MainSheet())
 
-    atlas_surface = sprite_atlas.create_atlas_surface()
+    if render_eng.get_max_texture_pages() > 1:
+        page_size = min(MAX_ATLAS_PAGE_SIZE, render_eng.get_max_texture_size())
+        max_page_size = (page_size, page_size)
+    else:
+        max_page_size = None  # everything goes on one page
+    texture_data, width, height = sprite_atlas.create_atlas_texture_data(max_page_size=max_page_size,
+                                                                         cache_dir=ATLAS_CACHE_DIR)
 
     # uncomment to save out the full texture atlas
-    # pygame.image.save(atlas_surface, "texture_atlas.png")
+    # for i, page in enumerate(sprite_atlas.create_atlas_pages(max_page_size=max_page_size)):
+    #     pygame.image.save(page, "texture_atlas_{}.png".format(i))
 
-    texture_data = pygame.image.tostring(atlas_surface, "RGBA", 1)
-    width = atlas_surface.get_width()
-    height = atlas_surface.get_height()
-    render_eng.set_texture(texture_data, width, height)
+    render_eng.set_texture_pages(texture_data, width, height)
 
     COLOR = True
     SORTS = True
@@ -61,6 +74,7 @@ def init(name_of_game):
 
     render_eng.add_layer(layers.ImageLayer(spriteref.LAYER_UI_BG, 12, SORTS, COLOR))
     render_eng.add_layer(layers.ImageLayer(spriteref.LAYER_UI_FG, 15, SORTS, COLOR))
+    render_eng.add_layer(layers.TextLayer(spriteref.LAYER_UI_TEXT, 16, SORTS, COLOR))
     render_eng.add_layer(layers.ImageLayer(spriteref.LAYER_UI_TOOLTIP, 20, SORTS, COLOR))
 
     import src.game.towers as towers  # bleh
@@ -167,14 +181,13 @@ def run():
 
         if not ignore_resize_events_this_tick and len(all_resize_events) > 0:
             last_resize_event = all_resize_events[-1]
+            window.get_instance().request_window_size(last_resize_event.w, last_resize_event.h)
 
-            print("INFO: resizing to {}, {}".format(last_resize_event.w, last_resize_event.h))
-
-            window.get_instance().set_window_size(last_resize_event.w, last_resize_event.h)
-
+        if window.get_instance().apply_pending_window_size():
             display_w, display_h = window.get_instance().get_display_size()
-            new_pixel_scale = _calc_pixel_scale((last_resize_event.w, last_resize_event.h))
+            print("INFO: resizing to {}, {}".format(display_w, display_h))
 
+            new_pixel_scale = _calc_pixel_scale((display_w, display_h))
             renderengine.get_instance().resize(display_w, display_h, px_scale=new_pixel_scale)
 
         input_state.update(gs.get_instance().tick_count)
@@ -185,6 +198,22 @@ def run():
             import src.utils.profiling as profiling
             profiling.get_instance().toggle()
 
+        if gs.get_instance().is_dev() and input_state.was_pressed(pygame.K_F2):
+            _toggle_recording()
+
+        if gs.get_instance().is_dev() and input_state.was_pressed(pygame.K_F3):
+            # per-layer cpu vs. gpu times, printed when it's toggled off (or when the fps drops)
+            render_eng = renderengine.get_instance()
+            if render_eng.get_timings() is not None:
+                render_eng.get_timings().dump()
+            render_eng.set_timings_enabled(render_eng.get_timings() is None)
+
+        if gs.get_instance().is_dev() and input_state.was_pressed(pygame.K_F6):
+            # reports sprites that stop being republished without being removed (i.e. leaks)
+            render_eng = renderengine.get_instance()
+            render_eng.set_sprite_tracking_enabled(render_eng.get_sprite_tracker() is None)
+            print("INFO: sprite tracking {}".format("enabled" if render_eng.get_sprite_tracker() else "disabled"))
+
         if input_state.was_pressed(pygame.K_F5):
             current_scale = gs.get_instance().px_scale
             options = gs.get_instance().px_scale_options
@@ -223,6 +252,20 @@ def run():
             if clock.get_fps() < 55 and gs.get_instance().is_dev() and not slo_mo_mode:
                 print("WARN: fps drop: {} ({} sprites)".format(round(clock.get_fps() * 10) / 10.0,
                                                                renderengine.get_instance().count_sprites()))
+                if renderengine.get_instance().get_timings() is not None:
+                    renderengine.get_instance().get_timings().dump()
 
     print("INFO: quitting game")
+    renderengine.get_instance().stop_recording()
     pygame.quit()
+
+
+def _toggle_recording():
+    render_eng = renderengine.get_instance()
+    if render_eng.is_recording():
+        render_eng.stop_recording()
+    else:
+        date_str = datetime.datetime.now().strftime("%Y-%m-%d--%H-%M-%S")
+        # gif frame delays are in hundredths of a second, so 30 fps is the closest we can get
+        render_eng.start_recording("recordings/recording--{}.gif".format(date_str), fmt=capture.FORMAT_GIF,
+                                   every_nth_frame=2)
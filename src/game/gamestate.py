@@ -1114,11 +1114,9 @@ class HoverInfoBox(UiElement):
 
     def all_sprites(self):
         if self.box_bg_sprite is not None:
-            for spr in self.box_bg_sprite.all_sprites():
-                yield spr
+            yield self.box_bg_sprite
         if self.text_sprite is not None:
-            for spr in self.text_sprite.all_sprites():
-                yield spr
+            yield self.text_sprite
 
     def update(self, game_state):
         hover_text = game_state.get_current_hover_text()
@@ -1144,7 +1142,7 @@ class HoverInfoBox(UiElement):
                           ui_blight_bar_model.width() * 2 - border * 4,
                           box_height * 2]
             if self.box_bg_sprite is None:
-                self.box_bg_sprite = sprites.BorderBoxSprite(spriteref.LAYER_UI_BG, inner_rect, scale=2,
+                self.box_bg_sprite = sprites.NineSliceSprite(spriteref.LAYER_UI_BG, inner_rect, scale=2,
                                                              top_left=spriteref.MAIN_SHEET.box_borders[0],
                                                              top=spriteref.MAIN_SHEET.box_borders[1],
                                                              top_right=spriteref.MAIN_SHEET.box_borders[2],
@@ -1154,9 +1152,9 @@ class HoverInfoBox(UiElement):
             self.box_bg_sprite = self.box_bg_sprite.update(new_rect=inner_rect)
 
             if self.text_sprite is None:
-                self.text_sprite = sprites.TextSprite(spriteref.LAYER_UI_FG, 0, 0, "abc", scale=1)
+                self.text_sprite = sprites.TextBlockSprite(spriteref.LAYER_UI_TEXT, 0, 0, "abc", scale=1)
             self.text_sprite = self.text_sprite.update(new_x=inner_rect[0], new_y=inner_rect[1],
-                                                       new_text=hover_text.text, new_color_lookup=hover_text.colors)
+                                                       new_text=hover_text.text, new_color_spans=hover_text.spans)
 
 
 class ResourceLabelElement(UiElement):
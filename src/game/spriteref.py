@@ -9,6 +9,7 @@ LAYER_SCENE_FG = "scene_fg"
 
 LAYER_UI_BG = "ui_bg"
 LAYER_UI_FG = "ui_fg"
+LAYER_UI_TEXT = "ui_text"
 LAYER_UI_TOOLTIP = "ui_tooltip"
 
 
@@ -1,3 +1,4 @@
+import collections
 import math
 import random
 import os
@@ -199,7 +200,7 @@ class Utils:
                     res.append((new_rect[0] + new_rect[2], r[1]))
                 else:
                     res.append((r[0] + r[2], new_rect[1]))
-            if new_rect[1] < r[1] + r[3] < new_rect[3]:
+            if new_rect[1] < r[1] + r[3] < new_rect[1] + new_rect[3]:
                 if r[0] < new_rect[0]:
                     res.append((r[0], new_rect[1] + new_rect[3]))
                 else:
@@ -256,6 +257,132 @@ class Utils:
 
         return res, total_bound
 
+    @staticmethod
+    def pack_rects_skyline(rect_sizes, max_size=None, power_of_two=False):
+        """
+        A much faster alternative to pack_rects_into_smallest_rect. Rects are placed tallest first, each one
+        as low (then as far left) as it'll go on the "skyline" of the rects placed so far. A few bin widths
+        are tried, and the one with the smallest bound wins.
+        :param rect_sizes: list of non-empty sizes (w, h)
+        :param max_size: (w, h) the bound must fit in, or None for no limit.
+        :param power_of_two: whether the bound's dimensions must be powers of 2.
+        :return: (
+                    list of rects (x, y, w, h), in the same order as rect_sizes,
+                    (w, h) the total bound size
+                 )
+                 or raises a ValueError if they can't be made to fit in max_size.
+        """
+        for s in rect_sizes:
+            if s[0] <= 0 or s[1] <= 0:
+                raise ValueError("invalid rect size: {}".format(s))
+        if len(rect_sizes) == 0:
+            return [], (0, 0)
+
+        order = sorted(range(0, len(rect_sizes)), key=lambda i: (rect_sizes[i][1], rect_sizes[i][0]), reverse=True)
+        min_w = max(s[0] for s in rect_sizes)
+        max_w = max_size[0] if max_size is not None else None
+        max_h = max_size[1] if max_size is not None else None
+
+        def _round(val):
+            return Utils.next_power_of_2(val) if power_of_two else val
+
+        if max_w is not None and _round(min_w) > max_w:
+            raise ValueError("can't fit rects into {}, one is {} wide".format(max_size, min_w))
+
+        # the bin is unbounded vertically, so every width works. near-square bounds tend to win.
+        area = sum(s[0] * s[1] for s in rect_sizes)
+        if power_of_two:
+            widths = set()
+            w = _round(min_w)
+            # the narrowest width is always tried, even if it's much wider than a square bin would be
+            max_tried_w = max(w, 4 * _round(math.ceil(math.sqrt(area))))
+            while (max_w is None or w <= max_w) and w <= max_tried_w:
+                widths.add(w)
+                w *= 2
+        else:
+            widths = set(max(min_w, math.ceil(math.sqrt(area) * f)) for f in (1.0, 1.1, 1.25, 1.5, 2.0))
+            if max_w is not None:
+                widths = set(min(w, max_w) for w in widths)
+
+        best = None  # (bound area, positions, bound)
+        for bin_w in sorted(widths):
+            positions, used_w, used_h = Utils._pack_skyline(rect_sizes, order, bin_w)
+            bound = (_round(used_w), _round(used_h))
+            if max_h is not None and bound[1] > max_h:
+                continue
+            if best is None or bound[0] * bound[1] < best[0]:
+                best = (bound[0] * bound[1], positions, bound)
+
+        if best is None:
+            raise ValueError("can't fit {} rects into {}".format(len(rect_sizes), max_size))
+
+        _, positions, bound = best
+        return [[positions[i][0], positions[i][1], rect_sizes[i][0], rect_sizes[i][1]]
+                for i in range(0, len(rect_sizes))], bound
+
+    @staticmethod
+    def _pack_skyline(rect_sizes, order, bin_w):
+        """returns: (list of (x, y) for each rect, used width, used height)"""
+        skyline = [[0, 0, bin_w]]  # segments of [x, y, w] from left to right, y is the lowest free row there
+        positions = [None] * len(rect_sizes)
+        used_w = 0
+        used_h = 0
+
+        for rect_idx in order:
+            w, h = rect_sizes[rect_idx]
+
+            best_idx = None
+            best_y = None
+            best_x = None
+            for i in range(0, len(skyline)):
+                x = skyline[i][0]
+                if x + w > bin_w:
+                    break
+                # the rect sits on the highest segment under it
+                y = 0
+                remaining = w
+                j = i
+                while remaining > 0:
+                    y = max(y, skyline[j][1])
+                    if best_y is not None and y >= best_y:
+                        break
+                    remaining -= skyline[j][2]
+                    j += 1
+                else:
+                    best_idx, best_y, best_x = i, y, x
+
+            if best_idx is None:
+                # only possible if i messed this up (the bin is as wide as the widest rect)
+                raise ValueError("can't fit {} anywhere on the skyline: {}".format((w, h), skyline))
+
+            positions[rect_idx] = (best_x, best_y)
+            used_w = max(used_w, best_x + w)
+            used_h = max(used_h, best_y + h)
+
+            # raise the skyline under the new rect
+            new_segment = [best_x, best_y + h, w]
+            i = best_idx
+            while i < len(skyline) and skyline[i][0] < best_x + w:
+                seg_end = skyline[i][0] + skyline[i][2]
+                if seg_end <= best_x + w:
+                    del skyline[i]
+                else:
+                    skyline[i] = [best_x + w, skyline[i][1], seg_end - (best_x + w)]
+                    break
+            skyline.insert(best_idx, new_segment)
+
+            # merge neighbors at the same height, so the skyline stays short
+            start = max(0, best_idx - 1)
+            i = start
+            while i < min(len(skyline) - 1, best_idx + 2):
+                if skyline[i][1] == skyline[i + 1][1]:
+                    skyline[i][2] += skyline[i + 1][2]
+                    del skyline[i + 1]
+                else:
+                    i += 1
+
+        return positions, used_w, used_h
+
     @staticmethod
     def linear_interp(v1, v2, a):
         if isinstance(v1, numbers.Number):
@@ -592,6 +719,35 @@ class Utils:
                 return Utils.string_checksum(str(blob), m=m)
 
 
+class LRUCache:
+    """A dict that only keeps its max_size most recently used entries."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = collections.OrderedDict()  # least recently used first
+
+    def get(self, key, default=None):
+        if key in self._items:
+            self._items.move_to_end(key)
+            return self._items[key]
+        return default
+
+    def put(self, key, value):
+        self._items[key] = value
+        self._items.move_to_end(key)
+        if len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def clear(self):
+        self._items.clear()
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+
 if __name__ == "__main__":
     sizes = [(5, 5), (2, 3), (7, 2), (1, 5), (9, 4), (3, 16), (3, 3), (3, 4)]
     packed, bound = Utils.pack_rects_into_smallest_rect(sizes)
@@ -611,4 +767,7 @@ if __name__ == "__main__":
             line.append(c)
         print(" ".join(line))
 
-
+    # long, thin rects are wider than any near-square power of 2 bin, so only their own width fits
+    for thin_sizes in ([(100, 1)], [(300, 2), (2, 2)]):
+        _, thin_bound = Utils.pack_rects_skyline(thin_sizes, power_of_two=True)
+        print("packed {} into {} (power of 2)".format(thin_sizes, thin_bound))